@@ -0,0 +1,256 @@
+'''Process-wide admission control for the upstream services, shared by every session and agent in the process.
+
+- SingleFlight coalesces identical requests that are in flight at the same time into one upstream call, so
+  several analysts asking about the same news at once cost one graph query (see functions.get_context).
+- RateLimiter keeps the Gemini calls of each api key and model within its requests per minute and input tokens
+  per minute, with token buckets, instead of sending them and sleeping on ResourceExhausted. Quota belongs to
+  the key's project, so sessions using different keys do not share limits. Callers wait in priority order, so
+  interactive chat goes ahead of batch agent runs.
+
+Waits are recorded as 'rate_limit_wait' spans (count, total and max wait per model in the metrics) and the
+number of callers waiting on each model, over every key, as a 'rate_limit_queue_depth_<model>' gauge.
+'''
+import os
+import json
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+from collections import Counter
+from concurrent.futures import Future
+
+from tracing import span, set_gauge
+
+# Lower values are admitted first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+# Gemini API limits per model as (requests per minute, input tokens per minute). These are the tier 1 limits at
+# the time of writing, set GEMINI_RATE_LIMITS (JSON, e.g. '{"gemini-2.0-flash": [2000, 4000000]}') to your
+# project's. Models without limits are not limited, null limits one of the two.
+DEFAULT_GEMINI_RATE_LIMITS = {
+    'gemini-2.0-flash': (2000, 4000000),
+    'gemini-2.0-flash-lite': (4000, 4000000),
+    'gemini-1.5-pro-latest': (1000, 4000000),
+    'gemini-2.5-pro-exp-03-25': (5, 1000000),
+}
+GEMINI_RATE_LIMITS = {**DEFAULT_GEMINI_RATE_LIMITS, **json.loads(os.environ.get('GEMINI_RATE_LIMITS', '{}'))}
+
+# Callers give up (with RateLimitExceeded, so the retry policy can fail over) after waiting this long, or after
+# the rest of their retry deadline if that is shorter.
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.environ.get('RATE_LIMIT_MAX_WAIT_SECONDS', 60))
+
+# How often callers behind others in the queue check whether it is their turn.
+_QUEUE_POLL_SECONDS = 0.05
+# Longest single sleep, so that a caller with a higher priority arriving meanwhile is let through promptly.
+_MAX_SLEEP_SECONDS = 0.25
+
+
+class SingleFlight:
+    '''Runs at most one call per key at a time: callers asking for a key that is already being fetched wait for
+    that call and share its result (or its exception) instead of making their own. Safe to share between threads.'''
+
+    def __init__(self):
+        self._calls = {}  # key -> Future of the call in flight
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        '''Returns (fn(*args, **kwargs), shared), shared being True if the result came from another caller's call.'''
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class RateLimitExceeded(Exception):
+    '''Raised when a caller waited its max wait without being admitted.
+
+    Not a server error: the model may be perfectly healthy, so circuit breakers do not count it as a failure and
+    it is not retried (the wait already used the deadline), but call_with_failover moves on to the next model.
+    '''
+
+
+class TokenBucket:
+    '''Holds up to per_minute units and refills at per_minute per minute. Not thread safe, RateLimiter locks it.'''
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        '''Seconds until amount units are available (a request larger than the bucket waits for a full bucket).'''
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    '''Requests per minute and input tokens per minute limits for one model, admitted in priority order (then
+    first come, first served). Safe to share between threads and event loops.'''
+
+    def __init__(self, name, requests_per_minute=None, tokens_per_minute=None, max_wait=RATE_LIMIT_MAX_WAIT_SECONDS):
+        self.name = name
+        self.max_wait = max_wait
+        self._requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._queue = []  # heap of (priority, sequence) tickets of the callers waiting
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def limited(self):
+        return self._requests is not None or self._tokens is not None
+
+    def queue_depth(self):
+        with self._lock:
+            return len(self._queue)
+
+    def _enqueue(self, priority):
+        ticket = (priority, next(self._sequence))
+        with self._lock:
+            heapq.heappush(self._queue, ticket)
+            _change_queue_depth(self.name, 1)
+        return ticket
+
+    def _leave(self, ticket):
+        with self._lock:
+            if ticket in self._queue:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                _change_queue_depth(self.name, -1)
+
+    def _try_admit(self, ticket, tokens):
+        '''0 if the ticket is admitted (its request and tokens taken), otherwise the seconds to wait before trying again.'''
+        with self._lock:
+            if self._queue[0] != ticket:
+                return _QUEUE_POLL_SECONDS
+            now = time.monotonic()
+            wait = max(self._requests.wait_time(1, now) if self._requests else 0.0,
+                       self._tokens.wait_time(tokens, now) if self._tokens else 0.0)
+            if wait > 0:
+                return wait
+            if self._requests:
+                self._requests.take(1)
+            if self._tokens:
+                self._tokens.take(tokens)
+            heapq.heappop(self._queue)
+            _change_queue_depth(self.name, -1)
+            return 0.0
+
+    def _max_wait(self, max_wait):
+        return self.max_wait if max_wait is None else max(0.0, min(self.max_wait, max_wait))
+
+    def _next_sleep(self, delay, started, max_wait):
+        waited = time.monotonic() - started
+        if waited + delay > max_wait:
+            raise RateLimitExceeded(f"rate limit for {self.name}: not admitted within {max_wait:g}s")
+        return min(delay, _MAX_SLEEP_SECONDS)
+
+    def acquire(self, tokens=0, priority=PRIORITY_BATCH, max_wait=None):
+        '''Blocks until one request of tokens input tokens may be sent. Returns the seconds waited.
+
+        Raises RateLimitExceeded after max_wait seconds (e.g. the rest of the caller's retry deadline, see
+        retry_policy.remaining_deadline), or the limiter's own max_wait if that is shorter or max_wait is None.
+        '''
+        if not self.limited:
+            return 0.0
+        max_wait = self._max_wait(max_wait)
+        started = time.monotonic()
+        ticket = self._enqueue(priority)
+        with span('rate_limit_wait', model=self.name, interactive=priority == PRIORITY_INTERACTIVE, tokens=tokens):
+            try:
+                while (delay := self._try_admit(ticket, tokens)):
+                    time.sleep(self._next_sleep(delay, started, max_wait))
+            except BaseException:
+                self._leave(ticket)
+                raise
+        return time.monotonic() - started
+
+    async def acquire_async(self, tokens=0, priority=PRIORITY_BATCH, max_wait=None):
+        '''Async version of acquire, waits with asyncio.sleep.'''
+        if not self.limited:
+            return 0.0
+        max_wait = self._max_wait(max_wait)
+        started = time.monotonic()
+        ticket = self._enqueue(priority)
+        with span('rate_limit_wait', model=self.name, interactive=priority == PRIORITY_INTERACTIVE, tokens=tokens):
+            try:
+                while (delay := self._try_admit(ticket, tokens)):
+                    await asyncio.sleep(self._next_sleep(delay, started, max_wait))
+            except BaseException:
+                self._leave(ticket)
+                raise
+        return time.monotonic() - started
+
+
+_queue_depths = Counter()  # model name -> callers waiting on it, over every api key
+_queue_depths_lock = threading.Lock()
+
+
+def _change_queue_depth(model_name, change):
+    with _queue_depths_lock:
+        _queue_depths[model_name] += change
+        set_gauge(f"rate_limit_queue_depth_{model_name}", _queue_depths[model_name])
+
+
+_rate_limiters = {}  # (api key, model name) -> RateLimiter
+_rate_limiters_lock = threading.Lock()
+
+
+def _limiter_key(model_name, api_key):
+    return (api_key or os.environ.get('GOOGLE_API_KEY'), model_name)
+
+
+def get_rate_limiter(model_name, api_key=None):
+    '''Returns the process-wide RateLimiter for a model used with an api key (GOOGLE_API_KEY if None), with its
+    limits from GEMINI_RATE_LIMITS.'''
+    key = _limiter_key(model_name, api_key)
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            requests_per_minute, tokens_per_minute = GEMINI_RATE_LIMITS.get(model_name) or (None, None)
+            limiter = _rate_limiters[key] = RateLimiter(model_name, requests_per_minute, tokens_per_minute)
+        return limiter
+
+
+def set_rate_limiter(model_name, limiter, api_key=None):
+    '''Replaces the process-wide RateLimiter for a model and api key, e.g. RateLimiter(model_name) to not limit it.'''
+    with _rate_limiters_lock:
+        _rate_limiters[_limiter_key(model_name, api_key)] = limiter
+
+
+def estimate_tokens(*texts):
+    '''Estimated tokens of the texts of a request, with the process-wide token counter.'''
+    # token_estimation imports functions, which imports this module, so it is imported on first use.
+    from token_estimation import get_token_counter
+    count = get_token_counter()
+    return sum(count(text) for text in texts if text)
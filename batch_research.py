@@ -0,0 +1,175 @@
+'''Runs research objectives from a JSONL file through graph_research_agent.
+
+Each input line is a JSON object with the objective in 'objective' (or 'body' / 'title') and an optional id
+in 'id' (or 'request_id'); lines without an id are identified by their line number. Results are appended to
+the output JSONL as soon as each objective finishes, and objectives already in the output are skipped, so a
+crashed or interrupted run picks up where it stopped when started again with the same arguments. Objectives
+are read from the input as workers free up, so the input can be any size.
+
+Objectives similar to ones researched before are refreshed from the earlier answer (see research_store.py)
+unless --no-refresh is given.
+
+Usage:
+    python batch_research.py objectives.jsonl results.jsonl [--workers 8] [--max-iterations 10] [--retry-failed] [--no-refresh]
+'''
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+from graph_research_agent import graph_research_agent_async
+
+
+def read_objectives(path):
+    '''Yields (id, objective, record) for every line of the input JSONL, without reading the whole file.'''
+    with open(path) as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"skipping line {line_number}, invalid json: {e}")
+                continue
+            if isinstance(record, str):
+                record = {'objective': record}
+            objective = record.get('objective') or record.get('body') or record.get('title')
+            if not objective:
+                print(f"skipping line {line_number}, no objective")
+                continue
+            objective_id = str(record.get('id') or record.get('request_id') or f"line-{line_number}")
+            yield objective_id, objective, record
+
+
+def read_completed(path, retry_failed=False):
+    '''Returns the ids already in the output JSONL (the checkpoint). With retry_failed, failed ones are not counted.'''
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by a crash
+            if not isinstance(result, dict) or result.get('id') is None:
+                continue
+            if retry_failed and result.get('error'):
+                continue
+            completed.add(str(result['id']))
+    return completed
+
+
+def end_partial_line(path):
+    '''Ends the output with a newline if a crash cut its last line short, so the next result starts a line of its own.'''
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb+') as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b'\n':
+            f.write(b'\n')
+
+
+class Throughput:
+    '''Objectives / tokens completed since the start of the run.'''
+
+    def __init__(self):
+        self.done = 0
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.started_at = time.monotonic()
+
+    def record(self, stats, failed):
+        self.done += 1
+        self.failed += int(failed)
+        self.prompt_tokens += stats.get('prompt_tokens', 0)
+
+    def report(self):
+        minutes = max(time.monotonic() - self.started_at, 1e-9) / 60
+        return (f"{self.done} done ({self.failed} failed), "
+                f"{self.done / minutes:.2f} objectives/min, {self.prompt_tokens / minutes:,.0f} prompt tokens/min")
+
+
+async def run_batch(input_path, output_path, workers=8, max_iterations=10, api_key=None, retry_failed=False, refresh=True):
+    completed = read_completed(output_path, retry_failed=retry_failed)
+    end_partial_line(output_path)
+    print(f"{len(completed)} objectives already completed, running the rest with {workers} workers")
+
+    throughput = Throughput()
+    # Bounded, so the input is read only a little ahead of the workers and never held in memory as a whole.
+    queue = asyncio.Queue(maxsize=workers * 2)
+
+    with open(output_path, 'a') as output:
+
+        async def run_one(objective_id, objective):
+            stats = {}
+            started_at = time.time()
+            started = time.monotonic()
+            try:
+                content = await graph_research_agent_async(objective, max_iterations=max_iterations, api_key=api_key, stats=stats, refresh=refresh)
+                error = None if content else "agent finished without content"
+            except Exception as e:
+                content, error = None, f"{type(e).__name__}: {e}"
+
+            result = {
+                'id': objective_id,
+                'objective': objective,
+                'content': content,
+                'error': error,
+                'started_at': started_at,
+                'duration_seconds': round(time.monotonic() - started, 3),
+                'stats': stats,
+            }
+            # Written and flushed per objective, this file is also the checkpoint.
+            output.write(json.dumps(result, default=str) + '\n')
+            output.flush()
+            os.fsync(output.fileno())
+
+            throughput.record(stats, failed=error is not None)
+            print(f"[{objective_id}] {'failed: ' + error if error else 'done'} in {result['duration_seconds']}s | {throughput.report()}")
+
+        async def worker():
+            while (item := await queue.get()) is not None:
+                await run_one(*item)
+
+        async def feed():
+            for objective_id, objective, _ in read_objectives(input_path):
+                if objective_id not in completed:
+                    await queue.put((objective_id, objective))
+            for _ in range(workers):
+                await queue.put(None)  # one stop marker per worker
+
+        tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+        try:
+            await asyncio.gather(feed(), *tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    print(f"finished: {throughput.report()}")
+    return throughput
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='JSONL file of objectives')
+    parser.add_argument('output', help='JSONL file results are appended to (also used to resume)')
+    parser.add_argument('--workers', type=int, default=8, help='objectives researched at the same time')
+    parser.add_argument('--max-iterations', type=int, default=10)
+    parser.add_argument('--api-key', default=os.environ.get('GOOGLE_API_KEY'), help='defaults to GOOGLE_API_KEY')
+    parser.add_argument('--retry-failed', action='store_true', help='run objectives that failed in a previous run again')
+    parser.add_argument('--no-refresh', dest='refresh', action='store_false', help='research every objective from scratch, never refresh an earlier answer')
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        sys.exit("a Google api key is required, pass --api-key or set GOOGLE_API_KEY")
+
+    asyncio.run(run_batch(args.input, args.output, workers=args.workers, max_iterations=args.max_iterations,
+                          api_key=args.api_key, retry_failed=args.retry_failed, refresh=args.refresh))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''Benchmark of the process-wide admission control (admission.py).
+
+Coalescing: --sessions threads ask the fake graph api the same question at the same moment, as several
+analysts would about the same breaking news, and the upstream requests and latency are compared with the same
+number of different questions.
+
+Rate limiting: batch callers keep a model's requests per minute limit saturated while interactive callers
+arrive, and their waits are compared (interactive callers should only wait for the next free request).
+
+Usage:
+    python benchmarks/bench_admission.py [--sessions 8] [--graph-latency 0.5] [--rpm 600] [--seconds 5]
+'''
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeGraphServer, install_fake_graph_api
+
+import functions
+from admission import PRIORITY_BATCH, PRIORITY_INTERACTIVE, RateLimiter
+
+
+def concurrent_queries(server, queries):
+    '''Runs get_context for every query at the same moment, one thread each. Returns (upstream requests, seconds).'''
+    barrier = threading.Barrier(len(queries))
+
+    def ask(query):
+        barrier.wait()
+        functions.get_context(query, use_cache=False)
+
+    threads = [threading.Thread(target=ask, args=(query,)) for query in queries]
+    requests = server.requests
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return server.requests - requests, time.perf_counter() - start
+
+
+async def limiter_waits(rpm, seconds, batch_callers=8, interactive_every=0.5):
+    '''Waits of batch and interactive callers on a RateLimiter kept saturated by the batch callers.'''
+    limiter = RateLimiter('bench', requests_per_minute=rpm, max_wait=seconds * 10)
+    waits = {PRIORITY_BATCH: [], PRIORITY_INTERACTIVE: []}
+    deadline = time.monotonic() + seconds
+
+    async def caller(priority, pause):
+        while time.monotonic() < deadline:
+            waits[priority].append(await limiter.acquire_async(0, priority))
+            await asyncio.sleep(pause)
+
+    await asyncio.gather(*(caller(PRIORITY_BATCH, 0) for _ in range(batch_callers)), caller(PRIORITY_INTERACTIVE, interactive_every))
+    return waits
+
+
+def describe(waits):
+    waits = sorted(waits)
+    return f"{len(waits):>6} {statistics.median(waits) * 1000:>10.1f} {waits[int(len(waits) * 0.95)] * 1000:>10.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=8)
+    parser.add_argument('--graph-latency', type=float, default=0.5)
+    parser.add_argument('--rpm', type=int, default=600, help='requests per minute of the limited model')
+    parser.add_argument('--seconds', type=float, default=5.0, help='how long to keep the limiter saturated')
+    args = parser.parse_args()
+
+    server = FakeGraphServer(latency=args.graph_latency).start()
+    install_fake_graph_api(server)
+    print(f"{'graph queries':<22} {'upstream':>9} {'seconds':>9}")
+    for name, queries in (('identical', ["What is the latest on the NVDA supply chain?"] * args.sessions),
+                          ('different', [f"What is the latest on the NVDA supply chain, part {i}?" for i in range(args.sessions)])):
+        requests, seconds = concurrent_queries(server, queries)
+        print(f"{name:<22} {requests:>9} {seconds:>9.2f}")
+    server.stop()
+
+    waits = asyncio.run(limiter_waits(args.rpm, args.seconds))
+    print(f"\n{'rate limiter waits':<22} {'calls':>6} {'p50 (ms)':>10} {'p95 (ms)':>10}")
+    print(f"{'batch':<22} {describe(waits[PRIORITY_BATCH])}")
+    print(f"{'interactive':<22} {describe(waits[PRIORITY_INTERACTIVE])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+'''Benchmark of prompt tokens used by get_context results: the old str(response.json()) repr versus the
+compact GraphContext rendering.
+
+Payloads are read from JSON files (recorded get_similar_entity_and_relationships responses). The bundled
+fixture is a synthetic payload; point --payloads at a directory of recorded responses for real numbers.
+Tokens are counted with the process-wide token counter (the ratio estimator), so it runs offline.
+
+Usage:
+    python benchmarks/bench_context_payload.py [--payloads benchmarks/fixtures]
+'''
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graph_context import GraphContext
+from token_estimation import get_token_counter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--payloads', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'),
+                        help='directory of recorded JSON payloads')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.payloads, '*.json')))
+    if not paths:
+        sys.exit(f"no payloads found in {args.payloads}")
+
+    count_tokens = get_token_counter()
+    total_repr, total_compact = 0, 0
+    print(f"{'payload':<40} {'repr tokens':>12} {'compact tokens':>15} {'saved':>7} {'render (ms)':>12}")
+    for path in paths:
+        with open(path) as f:
+            payload = json.load(f)
+
+        repr_tokens = count_tokens(str(payload))
+
+        start = time.perf_counter()
+        rendered = str(GraphContext.from_payload(payload))
+        render_ms = (time.perf_counter() - start) * 1000
+        compact_tokens = count_tokens(rendered)
+
+        total_repr += repr_tokens
+        total_compact += compact_tokens
+        print(f"{os.path.basename(path):<40} {repr_tokens:>12} {compact_tokens:>15} {1 - compact_tokens / repr_tokens:>7.1%} {render_ms:>12.2f}")
+
+    print(f"{'total':<40} {total_repr:>12} {total_compact:>15} {1 - total_compact / total_repr:>7.1%}")
+
+
+if __name__ == '__main__':
+    main()
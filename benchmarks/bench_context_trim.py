@@ -0,0 +1,103 @@
+'''Benchmark of the per-iteration context trimming cost in graph_research_agent.
+
+Compares the original approach (format the whole history into one prompt as a list repr and re-count it
+after every dropped entry) with AgentContext (a list of turns, each counted once on append, trimmed by
+arithmetic). Both count with the process-wide token counter (the ratio estimator), so it runs offline; the
+original approach was slower still with tiktoken.
+
+Usage:
+    python benchmarks/bench_context_trim.py [--entry-tokens 2000] [--repeats 3]
+'''
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graph_research_agent import AgentContext, system_instructions, iteration_instructions, user_turn, model_turn, function_response, MAX_PROMPT_TOKENS, MIN_HISTORY_ENTRIES
+from token_estimation import get_token_counter
+
+count_tokens = get_token_counter()
+
+
+def make_entry(i, entry_tokens):
+    # Roughly the shape of a query_graph result: lots of short facts with citation ids.
+    fact = f"{{'id': {1000 + i}, 'entity': 'NVIDIA', 'relationship': 'SUPPLIES', 'target': 'TSMC', 'description': 'supply agreement for advanced packaging'}}, "
+    repeats = max(1, entry_tokens // max(1, count_tokens(fact)))
+    return "{'entities': [" + fact * repeats + "]}"
+
+
+SYSTEM_INSTRUCTION = system_instructions.format(objective="What is the latest on the NVDA supply chain?")
+NOTEPAD = "plan: query suppliers, then customers"
+
+# The single prompt the agent used to send, with the history as a list repr.
+ORIGINAL_TEMPLATE = SYSTEM_INSTRUCTION + '''
+
+**YOUR HISTORY:**
+{history}
+
+**NOTEPAD:**
+{notepad}
+
+''' + iteration_instructions
+
+
+def fields(iteration):
+    return dict(current_iteration=iteration, max_iterations=10, current_date=time.strftime("%Y-%m-%d"))
+
+
+def original_trim(history, iteration):
+    history_for_llm = list(history)
+    prompt = ORIGINAL_TEMPLATE.format(history=history_for_llm, notepad=NOTEPAD, **fields(iteration))
+    while count_tokens(prompt) > MAX_PROMPT_TOKENS and len(history_for_llm) > MIN_HISTORY_ENTRIES:
+        history_for_llm = history_for_llm[1:]
+        prompt = ORIGINAL_TEMPLATE.format(history=history_for_llm, notepad=NOTEPAD, **fields(iteration))
+    return prompt
+
+
+def make_turns(history):
+    # Each query_graph result is a model turn calling query_graph and a user turn with its function response.
+    turns = []
+    for i, entry in enumerate(history):
+        turns.append(model_turn([{'type': 'function_call', 'name': 'query_graph', 'arguments': {'query': f'NVDA suppliers {i}'}}]))
+        turns.append(user_turn(function_response('query_graph', entry), iteration_instructions.format(**fields(i))))
+    return turns
+
+
+def incremental_trim(context, iteration):
+    contents, _ = context.build_contents(system_instruction=SYSTEM_INSTRUCTION, notepad=NOTEPAD)
+    return contents
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entry-tokens', type=int, default=2000, help='approximate tokens per history entry')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'entries':>8} {'original (ms)':>15} {'incremental (ms)':>18} {'append once (ms)':>18} {'speedup':>9}")
+    for n in (10, 50, 200):
+        history = [make_entry(i, args.entry_tokens) for i in range(n)]
+
+        start = time.perf_counter()
+        context = AgentContext()
+        context.extend(make_turns(history))
+        append_ms = (time.perf_counter() - start) * 1000
+
+        original, incremental = [], []
+        for r in range(args.repeats):
+            start = time.perf_counter()
+            original_trim(history, r)
+            original.append((time.perf_counter() - start) * 1000)
+
+            start = time.perf_counter()
+            incremental_trim(context, r)
+            incremental.append((time.perf_counter() - start) * 1000)
+
+        orig_ms, inc_ms = min(original), min(incremental)
+        print(f"{n:>8} {orig_ms:>15.1f} {inc_ms:>18.1f} {append_ms:>18.1f} {orig_ms / max(inc_ms, 1e-6):>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
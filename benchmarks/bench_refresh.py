@@ -0,0 +1,95 @@
+'''Benchmark of refreshing a previous research answer versus researching the objective from scratch.
+
+Each objective is researched once from scratch, then asked again. The previous run is made to end earlier than
+it did, so that --new-fraction of the fixture records are newer than it (as if it ran a while ago); the refresh
+then only searches that window. The fake model follows a shorter script when it is asked to update an answer.
+
+Usage:
+    python benchmarks/bench_refresh.py [--new-fraction 0.1] [--graph-latency 0.2] [--gemini-tps 150]
+'''
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import dataclasses
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FIXTURES_DIR, FakeGraphServer, ScriptedGemini, install_fake_graph_api, install_fake_gemini
+
+from graph_context import GraphContext
+from graph_research_agent import graph_research_agent_async
+from research_store import ResearchStore, set_research_store
+
+OBJECTIVES = [
+    "What is the latest on the NVDA supply chain?",
+    "How exposed is TSMC to advanced packaging bottlenecks?",
+]
+
+REFRESH_SCRIPT = [
+    [('query_graph', {'query': '{objective}'})],
+    [('finish_response', {'content': '## Answer\nThe supply chain is concentrated in a few suppliers [100000][200011], with new capacity announced since [200012].'})],
+]
+
+
+class RefreshingGemini(ScriptedGemini):
+    '''Follows REFRESH_SCRIPT when the prompt asks it to update a previous answer.'''
+
+    def turn(self, prompt, tools, tool_config):
+        script = self.agent_script
+        if '**PREVIOUS ANSWER:**' in prompt:
+            self.agent_script = REFRESH_SCRIPT
+        try:
+            return super().turn(prompt, tools, tool_config)
+        finally:
+            self.agent_script = script
+
+
+def cutoff_timestamp(new_fraction):
+    '''The timestamp after which new_fraction of the fixture records fall.'''
+    with open(os.path.join(FIXTURES_DIR, 'graph_payload_sample.json')) as f:
+        context = GraphContext.from_payload(json.load(f))
+    timestamps = sorted(ts for ts in context.timestamps if isinstance(ts, int))
+    return timestamps[min(len(timestamps) - 1, int(len(timestamps) * (1 - new_fraction)))] - 1
+
+
+async def research(objective, store, server):
+    stats = {}
+    requests = server.requests
+    start = time.perf_counter()
+    await graph_research_agent_async(objective, max_iterations=10, api_key='fake', stats=stats)
+    stats['seconds'] = time.perf_counter() - start
+    stats['graph_requests'] = server.requests - requests
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--new-fraction', type=float, default=0.1, help='fraction of the records newer than the previous run')
+    parser.add_argument('--graph-latency', type=float, default=0.2)
+    parser.add_argument('--gemini-tps', type=float, default=150.0)
+    args = parser.parse_args()
+
+    server = FakeGraphServer(latency=args.graph_latency).start()
+    install_fake_graph_api(server)
+    install_fake_gemini(RefreshingGemini(tokens_per_second=args.gemini_tps))
+    store = ResearchStore(path=None)
+    set_research_store(store)
+    cutoff = cutoff_timestamp(args.new_fraction)
+
+    print(f"{'objective':<56} {'run':<8} {'seconds':>8} {'llm calls':>10} {'graph req':>10} {'prompt tokens':>14}")
+    for objective in OBJECTIVES:
+        full = asyncio.run(research(objective, store, server))
+        # pretend the previous run ended at the cutoff
+        store.save(dataclasses.replace(store.find(objective), id=None, end_timestamp=cutoff))
+        refresh = asyncio.run(research(objective, store, server))
+        for name, stats in (('full', full), ('refresh', refresh)):
+            print(f"{objective[:56]:<56} {name:<8} {stats['seconds']:>8.2f} {stats['llm_calls']:>10} {stats['graph_requests']:>10} {stats['prompt_tokens']:>14}")
+
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+'''Benchmark of startup costs: how long a fresh process takes to import the app's modules (the cold start of
+a Cloud Run / Streamlit container), and how long the chat page takes to render on its first run and on reruns.
+
+Imports are timed in fresh interpreters, so nothing is shared between repeats. The page is run with
+streamlit's AppTest without a GOOGLE API key, which covers everything a rerun does before a chat message.
+
+Usage:
+    python benchmarks/bench_startup.py [--repeats 5] [--reruns 20]
+'''
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ['functions', 'graph_research_agent', 'google.generativeai', 'streamlit']
+
+IMPORT_SCRIPT = '''
+import sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+'''
+
+
+def import_seconds(module, repeats):
+    timings = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT.format(root=ROOT, module=module)],
+                                capture_output=True, text=True, check=True).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(timings)
+
+
+def page_seconds(reruns):
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(os.path.join(ROOT, 'streamlit_app.py'), default_timeout=60)
+    start = time.perf_counter()
+    app.run()
+    first = time.perf_counter() - start
+
+    timings = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        app.run()
+        timings.append(time.perf_counter() - start)
+    return first, statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5, help='fresh interpreters per import timing')
+    parser.add_argument('--reruns', type=int, default=20, help='page reruns to time')
+    args = parser.parse_args()
+
+    print(f"{'import':<22} {'median (ms)':>12}")
+    for module in MODULES:
+        print(f"{module:<22} {import_seconds(module, args.repeats) * 1000:>12.1f}")
+
+    first, rerun = page_seconds(args.reruns)
+    print(f"\n{'page':<22} {'ms':>12}")
+    print(f"{'first run':<22} {first * 1000:>12.1f}")
+    print(f"{'rerun (median)':<22} {rerun * 1000:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+'''Benchmark of token counters: accuracy against exact Gemini counts versus time per call.
+
+Prompts are read from --prompts (a directory of recorded prompts, one .txt file each) or built from the
+fixture payloads: chat answer prompts and agent history turns, at a few sizes up to ~50k tokens.
+
+Accuracy is measured against Gemini count_tokens when GOOGLE_API_KEY is set. Without it tiktoken is used as
+the reference, so the errors then only compare the estimators with each other.
+
+Unlike the rest of the benchmarks this one needs tiktoken's gpt-4o encoding, which is downloaded on first use:
+set TIKTOKEN_CACHE_DIR to a directory that has it cached to run it offline.
+
+The calibrated ratio is fitted on half of the prompts and evaluated on the other half, its fitted bytes per
+token is printed so it can be set as GEMINI_BYTES_PER_TOKEN.
+
+Usage:
+    python benchmarks/bench_token_count.py [--prompts recorded_prompts/] [--model gemini-2.0-flash] [--repeats 5]
+'''
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FIXTURES_DIR
+
+import functions
+from graph_context import GraphContext
+from graph_research_agent import get_tiktoken_token_count, render_turn, user_turn, function_response
+from token_estimation import RatioTokenEstimator, CachingTokenCounter, GeminiTokenCounter
+
+OBJECTIVES = [
+    "What is the latest on the NVDA supply chain?",
+    "Which companies compete with ASML in lithography?",
+]
+
+
+def fixture_prompts():
+    prompts = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, '*.json'))):
+        with open(path) as f:
+            context = GraphContext.from_payload(json.load(f))
+        rendered = str(context)
+        for objective in OBJECTIVES:
+            prompts.append(functions.build_answer_prompt(objective, context))
+        for copies in (1, 5, 20):
+            prompts.append(render_turn(user_turn(*(function_response('query_graph', rendered) for _ in range(copies)))))
+    return prompts
+
+
+def recorded_prompts(directory):
+    prompts = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.txt'))):
+        with open(path, encoding='utf-8') as f:
+            prompts.append(f.read())
+    if not prompts:
+        raise SystemExit(f"no .txt prompts found in {directory}")
+    return prompts
+
+
+def measure(counter, prompts, reference, repeats):
+    '''Mean / max absolute error (as a fraction of the reference) and mean microseconds per call.'''
+    counts = [counter(prompt) for prompt in prompts]
+    errors = [abs(count - ref) / ref for count, ref in zip(counts, reference) if ref]
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for prompt in prompts:
+            counter(prompt)
+    micros = (time.perf_counter() - start) / (repeats * len(prompts)) * 1e6
+    return statistics.mean(errors), max(errors), micros
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--prompts', help='directory of recorded prompts (.txt), defaults to prompts built from the fixtures')
+    parser.add_argument('--model', default='gemini-2.0-flash', help='model for exact Gemini counts')
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    prompts = recorded_prompts(args.prompts) if args.prompts else fixture_prompts()
+
+    gemini = GeminiTokenCounter(args.model) if os.environ.get('GOOGLE_API_KEY') else None
+    reference_name = f"gemini {args.model}" if gemini else "tiktoken gpt-4o (no GOOGLE_API_KEY)"
+    reference = [(gemini or get_tiktoken_token_count)(prompt) for prompt in prompts]
+
+    train, test = prompts[::2], prompts[1::2]
+    train_reference, test_reference = reference[::2], reference[1::2]
+    calibrated = RatioTokenEstimator.calibrate(list(zip(train, train_reference)))
+
+    cached = CachingTokenCounter(get_tiktoken_token_count)
+    for prompt in test:
+        cached(prompt)
+
+    counters = [
+        ('ratio (default)', RatioTokenEstimator(), test, test_reference),
+        (f'ratio (calibrated {calibrated.bytes_per_token:.2f})', calibrated, test, test_reference),
+        ('tiktoken gpt-4o', get_tiktoken_token_count, test, test_reference),
+        ('tiktoken, cached', cached, test, test_reference),
+    ]
+    if gemini:
+        # a network call per count, so only timed once
+        counters.append(('gemini count_tokens', gemini, test, test_reference))
+
+    print(f"{len(prompts)} prompts, {min(reference)}-{max(reference)} tokens, reference: {reference_name}")
+    print(f"{'counter':<28} {'mean error':>11} {'max error':>10} {'us / call':>11}")
+    for name, counter, sample, sample_reference in counters:
+        repeats = 1 if counter is gemini else args.repeats
+        mean_error, max_error, micros = measure(counter, sample, sample_reference, repeats)
+        print(f"{name:<28} {mean_error:>10.1%} {max_error:>10.1%} {micros:>11.1f}")
+    print(f"\nexport GEMINI_BYTES_PER_TOKEN={calibrated.bytes_per_token:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+'''Local stand-ins for the graph output api and Gemini, so the chat path and the research agent can be
+benchmarked offline without Google credentials or the Cloud Run service.
+
+    server = FakeGraphServer(payload_dir, latency=0.2).start()
+    install_fake_graph_api(server)
+    install_fake_gemini(ScriptedGemini(tokens_per_second=150))
+'''
+import os
+import re
+import sys
+import glob
+import gzip
+import json
+import time
+import random
+import asyncio
+import threading
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import functions
+from retrieval_cache import RetrievalCache, set_retrieval_cache
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+################################### GRAPH API ###################################
+
+class FakeGraphServer:
+    '''Replays recorded get_similar_entity_and_relationships payloads over HTTP with configurable latency.
+
+    The payload for a query is picked deterministically from the payload files, so repeated queries get the
+    same response, like the real service. Records with a timestamp outside the requested start / end timestamps
+    are left out.
+    '''
+
+    def __init__(self, payload_dir=FIXTURES_DIR, latency=0.2, jitter=0.05, host='127.0.0.1', port=0):
+        paths = sorted(glob.glob(os.path.join(payload_dir, '*.json')))
+        if not paths:
+            raise ValueError(f"no payloads found in {payload_dir}")
+        self.payloads = []
+        for path in paths:
+            with open(path) as f:
+                self.payloads.append(json.load(f))
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like Cloud Run
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != '/get_similar_entity_and_relationships':
+                    self.send_error(404)
+                    return
+                fake.requests += 1
+                params = parse_qs(url.query)
+                query = params.get('query_content', [''])[0]
+                payload = fake.payloads[hash(query) % len(fake.payloads)]
+                start = int(params.get('start_timestamp', [0])[0])
+                end = int(params.get('end_timestamp', [2 ** 62])[0])
+                body = json.dumps(window_payload(payload, start, end)).encode('utf-8')
+
+                time.sleep(max(0.0, fake.latency + random.uniform(-fake.jitter, fake.jitter)))
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='fake-graph-server', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def window_payload(payload, start_timestamp, end_timestamp):
+    '''The payload with only the records whose timestamp (if they have one) is within the window.'''
+    return {
+        key: [r for r in value if not isinstance(r.get('timestamp'), int) or start_timestamp <= r['timestamp'] <= end_timestamp]
+        if isinstance(value, list) else value
+        for key, value in payload.items()
+    }
+
+
+def install_fake_graph_api(server, cache=False):
+    '''Points get_context at the fake server (no identity token needed) and, unless cache=True, disables the retrieval cache.'''
+    functions.set_graph_api_client(functions.GraphApiClient(base_url=server.url, token_provider=lambda audience: 'fake-token'))
+    set_retrieval_cache(RetrievalCache(path=None) if cache else RetrievalCache(ttl=0, path=None))
+
+
+################################### GEMINI ###################################
+
+def _text_part(text):
+    return SimpleNamespace(text=text, function_call=None)
+
+
+def _function_call_part(name, args):
+    return SimpleNamespace(text='', function_call=SimpleNamespace(name=name, args=args))
+
+
+def _response(parts, prompt_tokens, response_tokens):
+    candidate = SimpleNamespace(content=SimpleNamespace(parts=parts))
+    usage = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=response_tokens)
+    return SimpleNamespace(parts=parts, candidates=[candidate], usage_metadata=usage)
+
+
+def _collect_text(value):
+    '''All the text in generate_content contents (strings, dicts with 'text' / 'parts', lists of those).'''
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        return '\n'.join(_collect_text(v) for k, v in value.items() if k in ('text', 'parts', 'content', 'response', 'function_response', 'result'))
+    if isinstance(value, (list, tuple)):
+        return '\n'.join(_collect_text(v) for v in value)
+    return ''
+
+
+def _estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+# What the fake agent does on each iteration. '{objective}' is replaced with the objective from the prompt.
+DEFAULT_AGENT_SCRIPT = [
+    [('text', "## Plan\nStart with a broad query on the objective."), ('query_graph', {'query': '{objective}'})],
+    [('query_graph_batch', {'queries': [{'query': '{objective} suppliers'}, {'query': '{objective} customers'}, {'query': '{objective} risks'}]})],
+    [('write_to_notepad', {'content': 'Suppliers and customers covered [100000][200011].'})],
+    [('finish_response', {'content': '## Answer\nThe supply chain is concentrated in a few suppliers [100000][200011].'})],
+]
+
+DEFAULT_CHAT_ANSWER = "```markdown\n## Answer\n" + "The retrieved context shows supply agreements and capacity expansion [100000][200011]. " * 12 + "\n```"
+
+_ITERATION_PATTERN = re.compile(r'iteration (\d+) out of')
+_OBJECTIVE_PATTERN = re.compile(r'\*\*USER OBJECTIVE:\*\*\s*\n(.*?)\n\s*\n', re.DOTALL)
+
+
+class ScriptedGemini:
+    '''Factory for fake Gemini models (see functions.set_gemini_model_factory).
+
+    Agent prompts get the scripted turn for their iteration (read from the prompt), forced finish prompts get
+    finish_response, and plain prompts get chat_answer. Latency is first_token_latency plus the prompt at
+    prompt_tokens_per_second plus the response at tokens_per_second.
+    '''
+
+    def __init__(self, agent_script=None, chat_answer=DEFAULT_CHAT_ANSWER, tokens_per_second=150.0,
+                 first_token_latency=0.4, prompt_tokens_per_second=20000.0, stream_chunk_tokens=20):
+        self.agent_script = agent_script or DEFAULT_AGENT_SCRIPT
+        self.chat_answer = chat_answer
+        self.tokens_per_second = tokens_per_second
+        self.first_token_latency = first_token_latency
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.stream_chunk_tokens = stream_chunk_tokens
+        self.calls = 0
+
+    def __call__(self, model_name, tools=None, tool_config=None, api_key=None, **kwargs):
+        return FakeModel(self, model_name, tools, tool_config, **kwargs)
+
+    def turn(self, prompt, tools, tool_config):
+        '''The parts of the response to a prompt.'''
+        self.calls += 1
+        if not tools:
+            return [_text_part(self.chat_answer)]
+
+        objective_match = _OBJECTIVE_PATTERN.search(prompt)
+        objective = objective_match.group(1).strip() if objective_match else 'the objective'
+        # the conversation holds every iteration's turn so far, the last one is the current iteration
+        iterations = _ITERATION_PATTERN.findall(prompt)
+        forced = tool_config is not None or not iterations
+        iteration = int(iterations[-1]) if iterations else len(self.agent_script)
+        script = self.agent_script[-1:] if forced else self.agent_script
+        step = script[min(iteration, len(script)) - 1]
+
+        parts = []
+        for kind, value in step:
+            if kind == 'text':
+                parts.append(_text_part(value))
+            else:
+                args = json.loads(json.dumps(value).replace('{objective}', objective.replace('"', "'")))
+                parts.append(_function_call_part(kind, args))
+        return parts
+
+    def latency(self, prompt_tokens, response_tokens):
+        return self.first_token_latency + prompt_tokens / self.prompt_tokens_per_second, response_tokens / self.tokens_per_second
+
+
+class FakeModel:
+    def __init__(self, gemini, model_name, tools=None, tool_config=None, **kwargs):
+        self.gemini = gemini
+        self.model_name = model_name
+        self.tools = tools
+        self.tool_config = tool_config
+        self.system_instruction = kwargs.get('system_instruction')
+
+    def _prepare(self, contents):
+        prompt = _collect_text(self.system_instruction) + '\n' + _collect_text(contents)
+        parts = self.gemini.turn(prompt, self.tools, self.tool_config)
+        prompt_tokens = _estimate_tokens(prompt)
+        response_tokens = sum(_estimate_tokens(p.text or json.dumps(getattr(p.function_call, 'args', {}))) for p in parts)
+        return parts, prompt_tokens, response_tokens
+
+    def generate_content(self, contents=None, stream=False, **kwargs):
+        parts, prompt_tokens, response_tokens = self._prepare(contents)
+        first_token, generation = self.gemini.latency(prompt_tokens, response_tokens)
+        time.sleep(first_token)
+        if stream:
+            return FakeStream(parts, prompt_tokens, response_tokens, generation, self.gemini.stream_chunk_tokens)
+        time.sleep(generation)
+        return _response(parts, prompt_tokens, response_tokens)
+
+    async def generate_content_async(self, contents=None, **kwargs):
+        parts, prompt_tokens, response_tokens = self._prepare(contents)
+        first_token, generation = self.gemini.latency(prompt_tokens, response_tokens)
+        await asyncio.sleep(first_token + generation)
+        return _response(parts, prompt_tokens, response_tokens)
+
+    async def count_tokens_async(self, contents=None, **kwargs):
+        return SimpleNamespace(total_tokens=_estimate_tokens(_collect_text(self.system_instruction) + '\n' + _collect_text(contents)))
+
+
+class FakeStream:
+    '''Iterates a text response in chunks of stream_chunk_tokens tokens, at the configured token rate.'''
+
+    def __init__(self, parts, prompt_tokens, response_tokens, generation_seconds, chunk_tokens):
+        self.parts = parts
+        self.usage_metadata = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=response_tokens)
+        self.generation_seconds = generation_seconds
+        self.chunk_chars = chunk_tokens * 4
+
+    def __iter__(self):
+        text = ''.join(p.text for p in self.parts)
+        chunks = [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)] or ['']
+        for chunk in chunks:
+            time.sleep(self.generation_seconds / len(chunks))
+            yield _response([_text_part(chunk)], 0, 0)
+
+
+def install_fake_gemini(gemini):
+    functions.set_gemini_model_factory(gemini)
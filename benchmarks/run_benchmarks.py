@@ -0,0 +1,167 @@
+'''Offline benchmark suite: the research agent end to end, the context trimmer, prompt building and the
+chat path, against the local stand-ins in benchmarks/fakes.py. Reports p50 / p95 latency and throughput.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--runs 20] [--concurrency 4] [--graph-latency 0.2] [--gemini-tps 150]
+                                        [--json results.json] [--baseline baseline.json --tolerance 0.2]
+
+With --baseline the p95 of each benchmark is compared to a previous --json output and the script exits
+with status 1 if any got slower by more than the tolerance, so it can gate CI.
+
+Token counting uses the ratio estimator (token_estimation.get_token_counter), so the suite needs no tokenizer
+files and runs fully offline.
+'''
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FIXTURES_DIR, FakeGraphServer, ScriptedGemini, install_fake_graph_api, install_fake_gemini
+
+import functions
+from graph_context import GraphContext
+from retrieval_policy import chat_retrieval_size
+from graph_research_agent import AgentContext, graph_research_agent_async, system_instructions, iteration_instructions, user_turn, model_turn, function_response
+
+OBJECTIVES = [
+    "What is the latest on the NVDA supply chain?",
+    "How exposed is TSMC to advanced packaging bottlenecks?",
+    "Summarise HBM supply agreements between memory makers and AI accelerator vendors.",
+    "Which companies compete with ASML in lithography?",
+]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = (len(values) - 1) * p
+    lower, upper = int(index), min(int(index) + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+
+def summarise(name, latencies, wall_seconds):
+    return {
+        'name': name,
+        'runs': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'throughput_per_s': round(len(latencies) / wall_seconds, 3) if wall_seconds else 0.0,
+    }
+
+
+def bench_sync(name, fn, runs):
+    latencies = []
+    started = time.perf_counter()
+    for i in range(runs):
+        start = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - start)
+    return summarise(name, latencies, time.perf_counter() - started)
+
+
+async def bench_async(name, fn, runs, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            await fn(i)
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(runs)))
+    return summarise(name, latencies, time.perf_counter() - started)
+
+
+def load_payload():
+    with open(os.path.join(FIXTURES_DIR, 'graph_payload_sample.json')) as f:
+        return json.load(f)
+
+
+def run_all(args):
+    server = FakeGraphServer(latency=args.graph_latency).start()
+    install_fake_graph_api(server)
+    install_fake_gemini(ScriptedGemini(tokens_per_second=args.gemini_tps, first_token_latency=args.gemini_first_token))
+
+    payload = load_payload()
+    rendered_payload = str(GraphContext.from_payload(payload))
+    results = []
+
+    # Context trimmer: one contents build per iteration of a long run, with a new query_graph exchange each time.
+    context = AgentContext()
+    system_instruction = system_instructions.format(objective=OBJECTIVES[0])
+    def trim(i):
+        context.append(model_turn([{'type': 'function_call', 'name': 'query_graph', 'arguments': {'query': OBJECTIVES[0]}}]))
+        context.append(user_turn(function_response('query_graph', rendered_payload), iteration_instructions.format(current_iteration=i, max_iterations=args.runs, current_date='2025-03-22')))
+        context.build_contents(system_instruction=system_instruction, notepad='')
+    results.append(bench_sync('context_trim', trim, args.runs))
+
+    # Prompt building: parse + compact render of a payload and the chat answer prompt.
+    results.append(bench_sync('prompt_build', lambda i: functions.build_answer_prompt(OBJECTIVES[i % len(OBJECTIVES)], GraphContext.from_payload(payload)), args.runs))
+
+    # Chat path: retrieval, prompt, streamed answer with fence stripping.
+    def chat(i):
+        query = OBJECTIVES[i % len(OBJECTIVES)]
+        context_data = functions.get_context(query, **chat_retrieval_size(query))
+        chunks = functions.call_gemini_complete(functions.build_answer_prompt(query, context_data), stream=True)
+        ''.join(functions.strip_markdown_fences(chunks))
+    results.append(bench_sync('chat_path', chat, args.runs))
+
+    # Research agent end to end, several objectives at once on one event loop.
+    async def agent(i):
+        # refresh=False: every run researches from scratch, rather than refreshing the previous run's answer
+        await graph_research_agent_async(OBJECTIVES[i % len(OBJECTIVES)], max_iterations=10, api_key='fake', refresh=False)
+    results.append(asyncio.run(bench_async('agent_e2e', agent, args.runs, args.concurrency)))
+
+    server.stop()
+    return results
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {row['name']: row for row in json.load(f)}
+    regressions = []
+    for row in results:
+        before = baseline.get(row['name'])
+        if before and before['p95_ms'] and row['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{row['name']}: p95 {before['p95_ms']}ms -> {row['p95_ms']}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4, help='agent runs in flight at once')
+    parser.add_argument('--graph-latency', type=float, default=0.2, help='seconds per fake graph api request')
+    parser.add_argument('--gemini-tps', type=float, default=150.0, help='fake Gemini output tokens per second')
+    parser.add_argument('--gemini-first-token', type=float, default=0.4, help='fake Gemini seconds to first token')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='previous --json output to compare p95 latencies against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 slowdown versus the baseline')
+    args = parser.parse_args()
+
+    results = run_all(args)
+
+    print(f"{'benchmark':<14} {'runs':>5} {'p50 (ms)':>10} {'p95 (ms)':>10} {'per second':>11}")
+    for row in results:
+        print(f"{row['name']:<14} {row['runs']:>5} {row['p50_ms']:>10.1f} {row['p95_ms']:>10.1f} {row['throughput_per_s']:>11.2f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        if regressions:
+            print("performance regressions:\n" + '\n'.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
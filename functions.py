@@ -1,15 +1,166 @@
 import os
 import json
+import time
+import random
+import asyncio
+import weakref
+import functools
+import threading
+import contextvars
 import requests
-from datetime import datetime
+import urllib3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# The Google SDKs (google.generativeai in particular) take a while to import and are not needed to render the
+# page, so they are imported where they are first used. prewarm() loads them ahead of the first request.
+
+from graph_context import GraphContext
+from retrieval_cache import get_retrieval_cache, make_cache_key
+from retry_policy import RetryPolicy, call_with_failover, remaining_deadline
+from admission import PRIORITY_INTERACTIVE, SingleFlight, estimate_tokens, get_rate_limiter
+from tracing import span, start_span, end_span, annotate
+
+GRAPH_OUTPUT_API_URL = 'https://graph-output-api-427867203106.asia-southeast1.run.app'
+
+# Tokens are refreshed in the background once they are within this many seconds of expiry...
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+# ...and refreshed in the foreground (blocking) once they are within this many seconds of expiry.
+TOKEN_MIN_VALIDITY_SECONDS = 30
+
+
+def _load_service_account_info():
+    '''Reads and parses the service account credentials from st.secrets.
+
+    Returns:
+        dict: The parsed service account info, ready for the google.oauth2 constructors.
+
+    Raises:
+        Exception: If the credentials are not available.
+    '''
+    # If running under Streamlit, st.secrets is automatically available.
+    import streamlit as st
+    credentials_json = st.secrets["SERVICE_ACCOUNT_CREDENTIALS"]
+
+    if not credentials_json:
+        raise Exception("Service account credentials not found in secrets or environment variable.")
+
+    credentials_info = json.loads(credentials_json)
+    credentials_info['private_key'] = credentials_info['private_key'].replace('\\n', '\n') #HAVE TO REPLACE
+    return credentials_info
+
+
+class IdentityTokenProvider:
+    '''Holds the service account credentials for one audience and hands out cached identity tokens.
+
+    A token is reused until it gets close to expiry. Inside the refresh margin the current token is still
+    returned and a single background thread refreshes it, so callers only ever block when there is no
+    usable token at all (first call, or the background refresh failed for long enough).
+    '''
+
+    def __init__(self, audience, credentials_info, refresh_margin=TOKEN_REFRESH_MARGIN_SECONDS, min_validity=TOKEN_MIN_VALIDITY_SECONDS):
+        self.audience = audience
+        self.refresh_margin = refresh_margin
+        self.min_validity = min_validity
+
+        import google.auth.transport.requests
+        from google.oauth2 import service_account
+
+        self._credentials = service_account.IDTokenCredentials.from_service_account_info(
+            credentials_info,
+            target_audience=audience
+        )
+        self._auth_request = google.auth.transport.requests.Request(session=requests.Session())
+
+        self._token = None
+        self._expires_at = 0.0
+        self._state_lock = threading.Lock()    # guards _token / _expires_at / _background_refresh
+        self._refresh_lock = threading.Lock()  # serialises calls into credentials.refresh()
+        self._background_refresh = None
+
+    def _refresh(self):
+        with self._refresh_lock:
+            # Another thread may have refreshed while we were waiting for the lock.
+            with self._state_lock:
+                if self._token and time.time() < self._expires_at - self.refresh_margin:
+                    return self._token
+
+            # Refresh to obtain a new token (this call does not require manual reauthentication)
+            self._credentials.refresh(self._auth_request)
+            if not self._credentials.token:
+                raise Exception("Error fetching identity token.")
+
+            expiry = self._credentials.expiry  # naive UTC datetime
+            if expiry is not None:
+                expires_at = expiry.replace(tzinfo=timezone.utc).timestamp()
+            else:
+                expires_at = time.time() + 3600  # google identity tokens are valid for 1 hour
+
+            with self._state_lock:
+                self._token = self._credentials.token
+                self._expires_at = expires_at
+                return self._token
+
+    def _refresh_in_background(self):
+        try:
+            self._refresh()
+        except Exception as e:
+            print(f"Background identity token refresh failed for {self.audience}: {e}")
+        finally:
+            with self._state_lock:
+                self._background_refresh = None
+
+    def get_token(self):
+        '''Returns a valid identity token, only blocking if the cached token is missing or about to expire.'''
+        with span('identity_token') as token_span:
+            now = time.time()
+            with self._state_lock:
+                token, expires_at = self._token, self._expires_at
+                if token and now < expires_at - self.refresh_margin:
+                    token_span.set(cache_hit=True)
+                    return token
+
+                if token and now < expires_at - self.min_validity:
+                    # Still usable, refresh ahead of time without making the caller wait.
+                    token_span.set(cache_hit=True, background_refresh=True)
+                    if self._background_refresh is None:
+                        self._background_refresh = threading.Thread(
+                            target=self._refresh_in_background,
+                            name="identity-token-refresh",
+                            daemon=True,
+                        )
+                        self._background_refresh.start()
+                    return token
+
+            token_span.set(cache_hit=False)
+            return self._refresh()
+
+
+_identity_token_providers = {}
+_identity_token_providers_lock = threading.Lock()
+
+
+def get_identity_token_provider(audience):
+    '''Returns the process-wide IdentityTokenProvider for the audience, creating it on first use.'''
+    provider = _identity_token_providers.get(audience)
+    if provider is not None:
+        return provider
+
+    with _identity_token_providers_lock:
+        provider = _identity_token_providers.get(audience)
+        if provider is None:
+            provider = IdentityTokenProvider(audience, _load_service_account_info())
+            _identity_token_providers[audience] = provider
+        return provider
 
-import google.auth.transport.requests
-import google.oauth2.id_token
-from google.oauth2 import service_account
-import google.generativeai as genai
 
 def get_identity_token(audience):
     '''Fetches an identity token for the specified audience. Used for when we need to access other cloud run instances by setting header = {"Authorization": f"Bearer {token}"}
+
+    Tokens are cached per audience for the whole process and refreshed in the background shortly before they expire,
+    so this is cheap to call on every request.
+
     Args:
         audience (str): The audience for the token. This is just the url of the service.
 
@@ -19,96 +170,550 @@ def get_identity_token(audience):
     Raises:
         Exception: If the token cannot be fetched.
     '''
+    return get_identity_token_provider(audience).get_token()
 
-        # If running under Streamlit, st.secrets is automatically available.
-    import streamlit as st
-    credentials_json = st.secrets["SERVICE_ACCOUNT_CREDENTIALS"]
 
-    if not credentials_json:
-        raise Exception("Service account credentials not found in secrets or environment variable.")
-    
-    credentials_info = json.loads(credentials_json)
-    credentials_info['private_key'] = credentials_info['private_key'].replace('\\n', '\n') #HAVE TO REPLACE
+# Timeouts (seconds) and retry settings for calls to the graph output api.
+GRAPH_API_CONNECT_TIMEOUT = float(os.environ.get('GRAPH_API_CONNECT_TIMEOUT', 5))
+GRAPH_API_READ_TIMEOUT = float(os.environ.get('GRAPH_API_READ_TIMEOUT', 120))
+GRAPH_API_MAX_RETRIES = int(os.environ.get('GRAPH_API_MAX_RETRIES', 3))
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+
+class GraphApiClient:
+    '''Shared HTTP client for the graph output api.
+
+    Wraps a single requests.Session so that connections to the Cloud Run endpoint are pooled and kept alive
+    between calls, sets connect/read timeouts on every request, asks for compressed responses, and retries
+    429/5xx responses and connection errors with jittered exponential backoff.
+    '''
+
+    def __init__(self, base_url=GRAPH_OUTPUT_API_URL, connect_timeout=GRAPH_API_CONNECT_TIMEOUT, read_timeout=GRAPH_API_READ_TIMEOUT,
+                 max_retries=GRAPH_API_MAX_RETRIES, backoff_base=0.5, backoff_max=8.0, pool_maxsize=32, token_provider=None):
+        self.base_url = base_url.rstrip('/')
+        # callable(audience) -> bearer token, defaults to the cached service account identity token
+        self.token_provider = token_provider or get_identity_token
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.session = requests.Session()
+        # Retries are handled in get() so that backoff and Retry-After handling are in one place.
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # urllib3 only advertises the encodings it can decode (br needs the brotli package installed).
+        self.session.headers.update(urllib3.util.make_headers(keep_alive=True, accept_encoding=True))
+
+    def _backoff(self, attempt, response=None):
+        '''Seconds to wait before the next attempt, honouring a Retry-After header if the server sent one.'''
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.backoff_max)
+                except ValueError:
+                    pass
+        # "Full jitter" exponential backoff.
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def get(self, path, params=None):
+        '''Authenticated GET against the graph output api.
+
+        Args:
+            path (str): The endpoint path, e.g. '/get_similar_entity_and_relationships'.
+            params (dict): Query string parameters.
+
+        Returns:
+            requests.Response: The successful response.
+
+        Raises:
+            requests.HTTPError: For non retryable errors, or when retries are exhausted.
+            requests.ConnectionError / requests.Timeout: When retries are exhausted.
+        '''
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        with span('graph_api_request', path=path) as request_span:
+            return self._get_with_retries(url, params, request_span)
+
+    def _get_with_retries(self, url, params, request_span):
+        attempt = 0
+        while True:
+            headers = {"Authorization": f"Bearer {self.token_provider(self.base_url)}"}
+            try:
+                response = self.session.get(url, headers=headers, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    request_span.set(retries=attempt)
+                    raise
+                wait = self._backoff(attempt)
+                print(f"graph api request failed: {e}, retrying in {wait:.2f}s")
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= self.max_retries:
+                    request_span.set(status_code=response.status_code, retries=attempt, response_bytes=len(response.content))
+                    response.raise_for_status()
+                    return response
+                wait = self._backoff(attempt, response)
+                print(f"graph api returned {response.status_code}, retrying in {wait:.2f}s")
+
+            time.sleep(wait)
+            attempt += 1
+
+
+_graph_api_client = None
+_graph_api_client_lock = threading.Lock()
+
+
+def get_graph_api_client():
+    '''Returns the process-wide GraphApiClient, creating it on first use.'''
+    global _graph_api_client
+    if _graph_api_client is None:
+        with _graph_api_client_lock:
+            if _graph_api_client is None:
+                _graph_api_client = GraphApiClient()
+    return _graph_api_client
+
+
+def set_graph_api_client(client):
+    '''Replaces the process-wide GraphApiClient, e.g. with one pointed at a local stand-in for benchmarks.'''
+    global _graph_api_client
+    with _graph_api_client_lock:
+        _graph_api_client = client
+
+
+# Upper bounds on the number of per api key transports and configured models kept alive.
+MAX_CACHED_GEMINI_CLIENTS = 32
+MAX_CACHED_GEMINI_MODELS = 128
+
+_gemini_clients = OrderedDict()  # api_key -> GenerativeServiceClient
+_gemini_models = OrderedDict()   # (api_key, model_name, tools, tool_config) -> GenerativeModel
+_gemini_lock = threading.Lock()
+
+# When set, callable(model_name, tools, tool_config, api_key, **kwargs) -> model used instead of genai.GenerativeModel
+# (e.g. a scripted stand-in for offline benchmarks).
+_gemini_model_factory = None
+
+
+def set_gemini_model_factory(factory):
+    '''Makes get_gemini_model / get_gemini_model_async return factory(model_name, tools, tool_config, api_key, **kwargs). None restores Gemini.'''
+    global _gemini_model_factory
+    _gemini_model_factory = factory
+
+
+def _cache_key_part(value):
+    '''Turns tools / tool_config (nested dicts and lists) into something hashable.'''
+    if value is None:
+        return None
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def _get_gemini_client(api_key):
+    '''Returns the generative service client (and its underlying transport) for an api key. Must hold _gemini_lock.'''
+    client = _gemini_clients.get(api_key)
+    if client is None:
+        from google.ai import generativelanguage as glm
+        client = glm.GenerativeServiceClient(client_options={'api_key': api_key})
+        _gemini_clients[api_key] = client
+        if len(_gemini_clients) > MAX_CACHED_GEMINI_CLIENTS:
+            _gemini_clients.popitem(last=False)
+    else:
+        _gemini_clients.move_to_end(api_key)
+    return client
+
+
+def _new_gemini_model(model_name, tools, tool_config, system_instruction):
+    import google.generativeai as genai
+    return genai.GenerativeModel(model_name, tools=tools, tool_config=tool_config, system_instruction=system_instruction)
+
+
+def get_gemini_model(model_name='gemini-2.0-flash', tools=None, tool_config=None, api_key=None, system_instruction=None):
+    '''Returns a configured GenerativeModel, reusing it (and its client) across calls.
+
+    Models are cached by (api key, model name, tools, tool_config, system_instruction). Each model is bound to a client created for its own api key rather than the process global one set by genai.configure, so
+    sessions using different keys at the same time cannot clobber each other.
+
+    Args:
+        model_name (str): The Gemini model name.
+        tools (list): Optional tool declarations, as accepted by genai.GenerativeModel.
+        tool_config (dict): Optional tool config, as accepted by genai.GenerativeModel.
+        api_key (str): The Google api key. Defaults to the GOOGLE_API_KEY environment variable.
+        system_instruction (str): Optional system instruction.
+
+    Returns:
+        genai.GenerativeModel: The configured model.
+    '''
+    if _gemini_model_factory is not None:
+        return _gemini_model_factory(model_name, tools, tool_config, api_key, system_instruction=system_instruction)
+
+    api_key = api_key or os.environ['GOOGLE_API_KEY']
+    key = (api_key, model_name, _cache_key_part(tools), _cache_key_part(tool_config), system_instruction)
+
+    with _gemini_lock:
+        model = _gemini_models.get(key)
+        if model is not None:
+            _gemini_models.move_to_end(key)
+            return model
 
-    credentials = service_account.IDTokenCredentials.from_service_account_info(
-        credentials_info,
-        target_audience=audience
-    )
-    # Refresh to obtain a new token (this call does not require manual reauthentication)
-    credentials.refresh(google.auth.transport.requests.Request())
+        model = _new_gemini_model(model_name, tools, tool_config, system_instruction)
+        # Bind to the per key client instead of the default client built from genai.configure().
+        model._client = _get_gemini_client(api_key)
 
-    if credentials.token:
-        return credentials.token
- 
-    raise Exception("Error fetching identity token.")
+        _gemini_models[key] = model
+        if len(_gemini_models) > MAX_CACHED_GEMINI_MODELS:
+            _gemini_models.popitem(last=False)
+        return model
 
 
-def call_gemini_complete(prompt: str, model_name: str = 'gemini-2.0-flash') -> str:
+# Async gRPC clients are tied to the event loop they were created on, so async models are cached per loop.
+_gemini_async_models = weakref.WeakKeyDictionary()  # event loop -> OrderedDict(model cache key -> GenerativeModel)
+
+
+def get_gemini_model_async(model_name='gemini-2.0-flash', tools=None, tool_config=None, api_key=None, system_instruction=None):
+    '''Like get_gemini_model, but the model is bound to an async client for the running event loop, for use with
+    generate_content_async. Must be called from a coroutine.'''
+    if _gemini_model_factory is not None:
+        return _gemini_model_factory(model_name, tools, tool_config, api_key, system_instruction=system_instruction)
+
+    api_key = api_key or os.environ['GOOGLE_API_KEY']
+    key = (api_key, model_name, _cache_key_part(tools), _cache_key_part(tool_config), system_instruction)
+    loop = asyncio.get_running_loop()
+
+    with _gemini_lock:
+        models = _gemini_async_models.get(loop)
+        if models is None:
+            models = _gemini_async_models[loop] = OrderedDict()
+
+        model = models.get(key)
+        if model is not None:
+            models.move_to_end(key)
+            return model
+
+        # Share the async transport between models of the same api key on this loop.
+        async_client = next((m._async_client for (k, *_), m in models.items() if k == api_key), None)
+        if async_client is None:
+            from google.ai import generativelanguage as glm
+            async_client = glm.GenerativeServiceAsyncClient(client_options={'api_key': api_key})
+
+        model = _new_gemini_model(model_name, tools, tool_config, system_instruction)
+        model._client = _get_gemini_client(api_key)
+        model._async_client = async_client
+
+        models[key] = model
+        if len(models) > MAX_CACHED_GEMINI_MODELS:
+            models.popitem(last=False)
+        return model
+
+
+# Shared retry policy for the chat path: exponential backoff with jitter, honouring retry hints, 2 minute deadline.
+GEMINI_RETRY_POLICY = RetryPolicy(max_retries=3, base_delay=1.0, max_delay=30.0, deadline=120.0)
+
+
+def call_gemini_complete(prompt: str, model_name: str = 'gemini-2.0-flash', api_key: str = None, stream: bool = False, fallback_models: list = None,
+                         priority: int = PRIORITY_INTERACTIVE):
     """
-    Calls the Gemini model synchronously without any retry logic.
-    It configures the client on each call using the GOOGLE_API_KEY from environment.
+    Calls the Gemini model synchronously, retrying quota / server errors with GEMINI_RETRY_POLICY.
+    Uses the cached model for the api key (defaults to GOOGLE_API_KEY from environment).
+    If model_name keeps failing (or its circuit breaker is open) the fallback_models are tried in order.
+    Each attempt first waits for the model's rate limiter (see admission.py), at the given priority.
+
+    With stream=True, returns an iterator over the text chunks as the model generates them instead of the final text.
     """
     
-    # Set up the client with the provided Google API key
-    genai.configure(api_key=os.environ['GOOGLE_API_KEY'])
-    model = genai.GenerativeModel(model_name)
-    
     messages = [{"role": "user", "parts": [{'text': prompt}]}]
-    response = model.generate_content(messages)
+    prompt_tokens = estimate_tokens(prompt)
+
+    def generate(model_name):
+        annotate(model=model_name)
+        get_rate_limiter(model_name, api_key).acquire(prompt_tokens, priority, max_wait=remaining_deadline())
+        model = get_gemini_model(model_name, api_key=api_key)
+        # With stream=True the first chunk is fetched here, so errors starting the stream are retried too.
+        return model.generate_content(messages, stream=stream)
+
+    with span('call_gemini_complete', model=model_name, stream=stream) as call_span:
+        response = call_with_failover(GEMINI_RETRY_POLICY, generate, [model_name, *(fallback_models or [])], api_key=api_key)
+        if stream:
+            # for streams this span measures the time to the first chunk, the rest is the gemini_stream span
+            return _iter_response_text(response, call_span.attributes.get('model', model_name))
+
+        record_usage(call_span, response)
     
     # Return the final text from the response
     return response.candidates[0].content.parts[-1].text
 
 
-def get_context(query: str, **params_for_query) -> dict:
+def record_usage(target_span, response):
+    """Copies the prompt / response token counts of a generate_content response onto a span."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage:
+        target_span.set(prompt_tokens=usage.prompt_token_count, response_tokens=usage.candidates_token_count)
+
+
+def _iter_response_text(response, model_name=None):
+    """Yields the text of each chunk of a streamed generate_content response, recording the stream as a span."""
+    stream_span = start_span('gemini_stream', model=model_name, chunks=0)
+    error = None
+    try:
+        for chunk in response:
+            stream_span.add('chunks')
+            for candidate in chunk.candidates[:1]:
+                for part in candidate.content.parts:
+                    if part.text:
+                        yield part.text
+        record_usage(stream_span, response)
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        end_span(stream_span, error)
+
+
+def strip_markdown_fences(chunks, fence_language='markdown'):
+    """
+    Incrementally strips a leading ```markdown and a trailing ``` (and surrounding whitespace) from streamed text.
+
+    Only as much text as is needed to make the decision is held back: the start until it can no longer be the
+    opening fence, and the last few characters in case they are the closing fence.
+
+    Args:
+        chunks (iterable[str]): The text chunks, e.g. from call_gemini_complete(..., stream=True).
+        fence_language (str): The language tag of the opening fence.
+
+    Yields:
+        str: The text chunks with the fences removed.
     """
-    Retrieves context from the Cloud Run endpoint.
-    - It first gets an identity token.
-    - Then it calls the get_similar_entity_and_relationships endpoint with the required parameters.
+    opening_fence = '```' + fence_language
+    closing_fence = '```'
+
+    head = ''            # text seen before we know whether it starts with the opening fence
+    started = False
+    leading_strip = True # still stripping leading whitespace
+    tail = ''            # text held back in case it is the closing fence
+
+    for chunk in chunks:
+        if not started:
+            head += chunk
+            stripped = head.lstrip()
+            if len(stripped) < len(opening_fence) and opening_fence.startswith(stripped):
+                continue
+            started = True
+            chunk = stripped[len(opening_fence):] if stripped.startswith(opening_fence) else stripped
+
+        if leading_strip:
+            chunk = chunk.lstrip()
+            if not chunk:
+                continue
+            leading_strip = False
+
+        tail += chunk
+        # Hold back enough characters to contain the closing fence, plus the whitespace around it.
+        emit_upto = max(0, len(tail.rstrip()) - len(closing_fence))
+        while emit_upto and tail[emit_upto - 1].isspace():
+            emit_upto -= 1
+        if emit_upto:
+            yield tail[:emit_upto]
+            tail = tail[emit_upto:]
+
+    if not started:
+        tail = head.lstrip()
+        if tail.startswith(opening_fence):
+            tail = tail[len(opening_fence):]
+
+    tail = tail.rstrip()
+    if tail.endswith(closing_fence):
+        tail = tail[:-len(closing_fence)]
+    tail = tail.strip() if leading_strip else tail.rstrip()
+    if tail:
+        yield tail
+
+
+def build_answer_prompt(query: str, context_data) -> str:
+    """Builds the chat prompt that answers the user's query from the retrieved graph context."""
+    return f'''The user has provided a query. Content has been retrieved from a graph database based on its relevance to the query. Analyze the content and provide an answer to the users query.
+
+        - Your response must be intelligent, logical, and answer the users query fully.
+        - Ensure that you cite the information id's using square brackets in your response. For example: "this is some information [1234]". This is essential for the user to be able to verify the information.
+        - The user does not have access to the content retrieved from the graph database, so you must provide all relevant information in your response. i.e dont say according to [1234] the answer is X. You must actually provide the specific answer in full.
+        - Your output format must be structured markdown. No preliminary comments or markdown tags are allowed, your response must directly answer the users query and be in markdown format.
+
+        QUERY: {query}
+
+        CONTENT:
+        {context_data}
+
+        - Your response must be intelligent, logical, and answer the users query fully.
+        - Ensure that you cite the information id's using square brackets in your response. For example: "this is some information [1234]". This is essential for the user to be able to verify the information.
+        - The user does not have access to the content retrieved from the graph database, so you must provide all relevant information in your response. i.e dont say according to [1234] the answer is X. You must actually provide the specific answer in full.
+        - Your output format must be structured markdown. No preliminary comments or markdown tags are allowed, your response must directly answer the users query and be in markdown format.
+        '''
+
+
+def build_graph_query_params(query: str, **params_for_query) -> dict:
+    """
+    Builds the query string parameters for the get_similar_entity_and_relationships endpoint,
+    resolving start_date / end_date ('%Y-%m-%d') into timestamps clamped to now.
     """
-    GRAPH_OUTPUT_API_URL = 'https://graph-output-api-427867203106.asia-southeast1.run.app'
     try:
-        # Get identity token for authentication
-        token = get_identity_token(audience=GRAPH_OUTPUT_API_URL)
-        headers = {"Authorization": f"Bearer {token}"}
+        current_timestamp = int(datetime.now().timestamp())
         
-        try:
-            current_timestamp = int(datetime.now().timestamp())
-            
-            start_date = params_for_query.get('start_date', '2024-06-01')
-            start_timestamp = int(datetime.strptime(start_date, '%Y-%m-%d').timestamp())
-
-            end_date = params_for_query.get('end_date')
-            if not end_date:
-                end_timestamp = current_timestamp
-            else:
-                end_timestamp = int(datetime.strptime(end_date, '%Y-%m-%d').timestamp())
+        start_date = params_for_query.get('start_date', '2024-06-01')
+        start_timestamp = int(datetime.strptime(start_date, '%Y-%m-%d').timestamp())
 
-            if end_timestamp > current_timestamp:
-                end_timestamp = current_timestamp
-            if start_timestamp > end_timestamp:
-                start_timestamp = start_timestamp = int(datetime.strptime('2024-06-01', '%Y-%m-%d').timestamp())
-        except Exception as e:
-            print(f"Error parsing date: {e}, using default dates.")
-            start_timestamp = int(datetime.strptime('2024-06-01', '%Y-%m-%d').timestamp())
-            end_timestamp = int(datetime.now().timestamp())
-        
-        params = {
-            'project': params_for_query.get('project', 'FINCATCH'),
-            'query_content': query,
-            'context_window': params_for_query.get('context_window', 100000),
-            'k': params_for_query.get('k', 100),
-            'index': True,
-            'start_timestamp': start_timestamp, #1717171200, #Saturday, June 1, 2024 12:00:00 AM GMT+08:00
-            'end_timestamp': end_timestamp #1742400000 #Thursday, March 20, 2025 12:00:00 AM GMT+08:00
-        }
-        # Adjust the URL as necessary for your deployment.
-        url = f"{GRAPH_OUTPUT_API_URL}/get_similar_entity_and_relationships"
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
+        end_date = params_for_query.get('end_date')
+        if not end_date:
+            end_timestamp = current_timestamp
+        else:
+            end_timestamp = int(datetime.strptime(end_date, '%Y-%m-%d').timestamp())
+
+        if end_timestamp > current_timestamp:
+            end_timestamp = current_timestamp
+        if start_timestamp > end_timestamp:
+            start_timestamp = start_timestamp = int(datetime.strptime('2024-06-01', '%Y-%m-%d').timestamp())
+    except Exception as e:
+        print(f"Error parsing date: {e}, using default dates.")
+        start_timestamp = int(datetime.strptime('2024-06-01', '%Y-%m-%d').timestamp())
+        end_timestamp = int(datetime.now().timestamp())
+    
+    return {
+        'project': params_for_query.get('project', 'FINCATCH'),
+        'query_content': query,
+        'context_window': params_for_query.get('context_window', 100000),
+        'k': params_for_query.get('k', 100),
+        'index': True,
+        'start_timestamp': start_timestamp, #1717171200, #Saturday, June 1, 2024 12:00:00 AM GMT+08:00
+        'end_timestamp': end_timestamp #1742400000 #Thursday, March 20, 2025 12:00:00 AM GMT+08:00
+    }
+
+
+def graph_query_cache_key(params: dict) -> str:
+    """Retrieval cache key for a set of get_similar_entity_and_relationships parameters."""
+    return make_cache_key(params['project'], params['query_content'], params['start_timestamp'], params['end_timestamp'],
+                          params['k'], params['context_window'])
+
+
+# Identical graph queries in flight at the same time (by their retrieval cache key) share one request.
+_graph_single_flight = SingleFlight()
+
+
+def get_context(query: str, use_cache: bool = True, **params_for_query) -> GraphContext:
+    """
+    Retrieves context from the Cloud Run endpoint, as a GraphContext (str() of it is the compact prompt rendering).
+    - Results are served from the retrieval cache (keyed on project, normalized query, start/end day, k and context_window) when possible.
+    - Otherwise, if the same query is already being fetched (for another session or agent), its response is shared.
+    - Otherwise it calls the get_similar_entity_and_relationships endpoint with the required parameters through the shared GraphApiClient,
+      which takes care of the identity token, connection reuse, timeouts and retries.
+    """
+    try:
+        params = build_graph_query_params(query, **params_for_query)
+
+        with span('get_context', k=params['k'], context_window=params['context_window']) as context_span:
+            payload = None
+            cache_key = graph_query_cache_key(params)
+            if use_cache:
+                cache = get_retrieval_cache()
+                payload = cache.get(cache_key)
+            context_span.set(cache_hit=payload is not None)
+
+            if payload is None:
+                def fetch():
+                    # Authentication, pooling, timeouts and retries are handled by the shared client.
+                    response = get_graph_api_client().get('/get_similar_entity_and_relationships', params=params)
+                    payload = response.json()
+                    if use_cache:
+                        cache.set(cache_key, payload)
+                    return payload
+
+                payload, coalesced = _graph_single_flight.do(cache_key, fetch)
+                context_span.set(coalesced=coalesced)
         
-        return str(response.json())
+        return GraphContext.from_payload(payload, query=query, start_timestamp=params['start_timestamp'], end_timestamp=params['end_timestamp'])
     
     except Exception as e:
         print(f"error get_context: {e}")
-        return f"error get_context: {e}. In your response, mention that an error occured getting contet with the exact error message to the user."
+        return GraphContext.from_error(f"error get_context: {e}. In your response, mention that an error occured getting contet with the exact error message to the user.", query=query)
+
+
+# Thread pool the async code runs blocking graph api requests on. Bounded by the http connection pool size,
+# so any number of concurrent agents share a fixed number of threads and connections.
+GRAPH_API_MAX_CONCURRENCY = 32
+_graph_api_executor = ThreadPoolExecutor(max_workers=GRAPH_API_MAX_CONCURRENCY, thread_name_prefix='graph_api')
+
+
+async def get_context_async(query: str, use_cache: bool = True, **params_for_query) -> GraphContext:
+    """
+    Async version of get_context. The request runs on a small shared thread pool (the graph api client is
+    synchronous), so awaiting it never blocks the event loop and does not need a thread per caller.
+    """
+    loop = asyncio.get_running_loop()
+    # copy_context so the request is traced under the caller's span
+    call = functools.partial(contextvars.copy_context().run, get_context, query, use_cache=use_cache, **params_for_query)
+    return await loop.run_in_executor(_graph_api_executor, call)
+
+
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+
+def _get_background_loop():
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='async-background-loop', daemon=True).start()
+            _background_loop = loop
+        return _background_loop
+
+
+def run_sync(coro):
+    """
+    Runs a coroutine on the process-wide background event loop and blocks until it returns its result.
+
+    Sync callers share one long lived loop (and so the async Gemini clients cached for it) instead of
+    creating a new loop, and new connections, per call with asyncio.run.
+    """
+    loop = _get_background_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        raise RuntimeError("run_sync cannot be called from the background event loop, await the coroutine instead.")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def run_async(coro):
+    """
+    Schedules a coroutine on the process-wide background event loop without waiting for it.
+
+    Returns:
+        concurrent.futures.Future: Its result; cancelling it cancels the coroutine.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_background_loop())
+
+
+def prewarm(audience=GRAPH_OUTPUT_API_URL):
+    '''Does the slow one-off startup work ahead of the first request, so that request does not pay for it.
+
+    Imports the Gemini SDK, creates the graph api client and fetches the first identity token for audience.
+    Failures are reported and left for the first request to retry.
+
+    Args:
+        audience (str): The audience of the identity token to fetch.
+
+    Returns:
+        dict: Seconds taken by each step, or 'failed: <error>' for the steps that failed.
+    '''
+    def import_gemini():
+        import google.generativeai
+        from google.ai import generativelanguage
+
+    timings = {}
+    for name, step in (('gemini_sdk', import_gemini), ('graph_api_client', get_graph_api_client), ('identity_token', lambda: get_identity_token(audience))):
+        start = time.perf_counter()
+        try:
+            step()
+            timings[name] = round(time.perf_counter() - start, 3)
+        except Exception as e:
+            print(f"prewarm: {name} failed: {e}")
+            timings[name] = f"failed: {e}"
+    print(f"prewarm: {timings}")
+    return timings
@@ -0,0 +1,224 @@
+import json
+from dataclasses import dataclass, field
+
+# Record fields that carry the citation id(s) shown to the model as [1234], in order of preference.
+CITATION_ID_FIELDS = ('citation_id', 'citation_ids', 'information_id', 'information_ids', 'id', 'ids')
+# Record fields that carry the time of the underlying information, in order of preference.
+TIMESTAMP_FIELDS = ('timestamp', 'published_timestamp', 'created_timestamp', 'date', 'published_at', 'created_at')
+
+
+def record_citation_ids(record):
+    '''Returns the citation ids of a single entity / relationship record as a list of strings.'''
+    for name in CITATION_ID_FIELDS:
+        value = record.get(name)
+        if value is None or value == '':
+            continue
+        if isinstance(value, (list, tuple, set)):
+            return [str(v) for v in value]
+        return [str(value)]
+    return []
+
+
+def record_timestamp(record):
+    '''Returns the timestamp (or date) of a record, or None if it has none.'''
+    for name in TIMESTAMP_FIELDS:
+        value = record.get(name)
+        if value not in (None, ''):
+            return value
+    return None
+
+
+def _cell(value):
+    '''Renders one value for a tab separated row.'''
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list, tuple)):
+        value = json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=str)
+    return str(value).replace('\t', ' ').replace('\r', ' ').replace('\n', ' ')
+
+
+def render_records(name, records):
+    '''Renders a list of records as a tab separated table: the keys once in a header, then one row per record.'''
+    columns = []
+    for record in records:
+        for key in record:
+            if key not in columns:
+                columns.append(key)
+    lines = [f"## {name} ({len(records)})", '\t'.join(columns)]
+    lines.extend('\t'.join(_cell(record.get(column)) for column in columns) for record in records)
+    return '\n'.join(lines)
+
+
+@dataclass
+class GraphContext:
+    '''Typed result of a get_context call.
+
+    sections holds every list of records in the payload by its key (e.g. 'entities', 'relationships'),
+    metadata holds the other top level values. str() renders the compact, prompt ready form.
+    '''
+    query: str = ''
+    sections: dict = field(default_factory=dict)
+    metadata: dict = field(default_factory=dict)
+    start_timestamp: int = None
+    end_timestamp: int = None
+    error: str = None
+
+    @classmethod
+    def from_payload(cls, payload, query='', start_timestamp=None, end_timestamp=None):
+        '''Builds a GraphContext from the JSON payload of get_similar_entity_and_relationships.'''
+        context = cls(query=query, start_timestamp=start_timestamp, end_timestamp=end_timestamp)
+        if isinstance(payload, list):
+            payload = {'results': payload}
+        elif not isinstance(payload, dict):
+            payload = {'result': payload}
+
+        for key, value in payload.items():
+            if isinstance(value, list) and all(isinstance(item, dict) for item in value):
+                context.sections[key] = value
+            else:
+                context.metadata[key] = value
+        return context
+
+    @classmethod
+    def from_error(cls, error, query=''):
+        return cls(query=query, error=error)
+
+    def to_payload(self):
+        '''Returns the JSON serialisable payload the context was built from.'''
+        return {**self.metadata, **self.sections}
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def entities(self):
+        return [record for name, records in self.sections.items() if 'entit' in name.lower() for record in records]
+
+    @property
+    def relationships(self):
+        return [record for name, records in self.sections.items() if 'relation' in name.lower() for record in records]
+
+    def records(self):
+        '''Yields (section name, record) for every record in the context.'''
+        for name, records in self.sections.items():
+            for record in records:
+                yield name, record
+
+    @property
+    def citation_ids(self):
+        '''Every citation id in the context, in order of first appearance.'''
+        return list(dict.fromkeys(cid for _, record in self.records() for cid in record_citation_ids(record)))
+
+    @property
+    def timestamps(self):
+        return [ts for _, record in self.records() if (ts := record_timestamp(record)) is not None]
+
+    def is_empty(self):
+        return not any(self.sections.values())
+
+    def render(self):
+        '''Compact prompt rendering: one tab separated table per section, with duplicate records removed.'''
+        if self.error is not None:
+            return self.error
+
+        parts = [f"{key}: {_cell(value)}" for key, value in self.metadata.items()]
+        for name, records in self.sections.items():
+            unique = list({json.dumps(record, sort_keys=True, default=str): record for record in records}.values())
+            parts.append(render_records(name, unique))
+        return '\n'.join(parts)
+
+    def __str__(self):
+        return self.render()
+
+
+# Maximum number of repeated citation ids listed in the note that replaces already seen records.
+MAX_LISTED_REPEATS = 30
+
+
+class EvidenceStore:
+    '''The de-duplicated evidence retrieved during one agent run, keyed by citation id.
+
+    Records without a citation id are keyed by their content instead.
+    '''
+
+    def __init__(self):
+        self._records = {}  # (section, citation ids or content) -> (section, record), in order of retrieval
+
+    def __len__(self):
+        return len(self._records)
+
+    @staticmethod
+    def _key(section, record):
+        ids = record_citation_ids(record)
+        return (section, tuple(ids) if ids else json.dumps(record, sort_keys=True, default=str))
+
+    def add(self, context):
+        '''Adds a retrieval result to the store.
+
+        Returns:
+            tuple[GraphContext, list[str]]: A GraphContext with only the records not seen before in this run,
+            and the citation ids of the records that were repeats.
+        '''
+        if not context.ok:
+            return context, []
+
+        new_sections, repeated = {}, []
+        for section, record in context.records():
+            key = self._key(section, record)
+            if key in self._records:
+                repeated.extend(record_citation_ids(record))
+                continue
+            self._records[key] = (section, record)
+            new_sections.setdefault(section, []).append(record)
+
+        new_context = GraphContext(query=context.query, sections=new_sections, metadata=context.metadata,
+                                   start_timestamp=context.start_timestamp, end_timestamp=context.end_timestamp)
+        return new_context, list(dict.fromkeys(repeated))
+
+    def render_new(self, context):
+        '''Adds a retrieval result and renders only its unseen records, with a short note listing the repeats.'''
+        new_context, repeated = self.add(context)
+        if not context.ok:
+            return str(context)
+
+        parts = [str(new_context)] if not new_context.is_empty() else ["No new results for this query."]
+        if repeated:
+            listed = ', '.join(repeated[:MAX_LISTED_REPEATS])
+            more = f" and {len(repeated) - MAX_LISTED_REPEATS} more" if len(repeated) > MAX_LISTED_REPEATS else ''
+            parts.append(f"({len(repeated)} results already retrieved earlier were omitted, citation ids: {listed}{more})")
+        return '\n'.join(parts)
+
+    def as_context(self):
+        '''All the evidence gathered so far as a single GraphContext.'''
+        sections = {}
+        for section, record in self._records.values():
+            sections.setdefault(section, []).append(record)
+        return GraphContext(sections=sections)
+
+    def render_within(self, max_tokens, count_tokens):
+        '''Renders as much of the evidence as fits in max_tokens (as counted by count_tokens), the most recently
+        retrieved first, with a note listing the citation ids of the older records left out.'''
+        records = list(self._records.values())
+        kept = len(records)
+        while True:
+            sections = {}
+            for section, record in records[len(records) - kept:]:
+                sections.setdefault(section, []).append(record)
+            parts = [str(GraphContext(sections=sections))] if kept else []
+            omitted = list(dict.fromkeys(cid for _, record in records[:len(records) - kept] for cid in record_citation_ids(record)))
+            if len(records) > kept:
+                listed = ', '.join(omitted[:MAX_LISTED_REPEATS])
+                more = f" and {len(omitted) - MAX_LISTED_REPEATS} more" if len(omitted) > MAX_LISTED_REPEATS else ''
+                parts.append(f"({len(records) - kept} earlier results were left out for space, citation ids: {listed}{more})")
+            rendered = '\n'.join(parts)
+            tokens = count_tokens(rendered)
+            if kept == 0 or tokens <= max_tokens:
+                return rendered
+            # shrink in proportion to the overshoot, by at least one record
+            kept = min(kept - 1, int(kept * max(0, max_tokens) / tokens * 0.95))
+            kept = max(0, kept)
+
+    @property
+    def citation_ids(self):
+        return list(dict.fromkeys(cid for section, record in self._records.values() for cid in record_citation_ids(record)))
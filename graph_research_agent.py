@@ -1,91 +1,426 @@
 import os
 import time
-import copy
+import json
+import asyncio
+import re
+import bisect
+import functools
+from collections.abc import Mapping, Sequence
 
-import google.generativeai as genai
-from google.api_core.exceptions import ResourceExhausted, InternalServerError
+from functions import get_gemini_model_async, run_sync, record_usage
+from tracing import span, annotate, current_span
+from retry_policy import RetryPolicy, call_with_failover_async, remaining_deadline, retryable_errors
+from token_estimation import EXACT_COUNT_MARGIN, GeminiTokenCounter, get_token_counter
+from admission import PRIORITY_BATCH, get_rate_limiter
 
-import tiktoken
-ENCODING = tiktoken.encoding_for_model('gpt-4o')
 
-def get_tiktoken_token_count(content):
-    return len(ENCODING.encode(content))
+@functools.lru_cache(maxsize=None)
+def get_encoding():
+    '''The tiktoken gpt-4o encoding, loaded on first use rather than at import (it may have to be downloaded).
 
-def call_gemini_complete(prompt = None, model_name = 'gemini-2.0-flash', tools = None, tool_config = None, max_retries=3):
-    #have to selectively choose which model to use.
+    Only used by get_tiktoken_token_count, which can still be installed with token_estimation.set_token_counter.'''
+    import tiktoken
+    return tiktoken.encoding_for_model('gpt-4o')
 
-    # model_name = 'gemini-2.0-flash-thinking-exp'
-    # model_name = 'gemini-2.0-flash'
+def get_tiktoken_token_count(content):
+    return len(get_encoding().encode(content))
+
+MAX_PROMPT_TOKENS = 50000
+MIN_HISTORY_ENTRIES = 3
+
+# Once the history passes COMPACTION_THRESHOLD_TOKENS its older turns are condensed into an evidence summary,
+# keeping about COMPACTION_KEEP_TOKENS of the most recent turns as they are.
+COMPACTION_THRESHOLD_TOKENS = int(MAX_PROMPT_TOKENS * 0.6)
+COMPACTION_KEEP_TOKENS = int(MAX_PROMPT_TOKENS * 0.25)
 
-    genai.configure(api_key=os.environ['GOOGLE_API_KEY'])
-    model = genai.GenerativeModel(model_name)
 
-    messages = [{"role": "user", "parts": [{'text': prompt}]}]
+def _plain(value):
+    '''Converts proto-plus maps / repeated fields (e.g. function_call.args) to plain dicts and lists.'''
+    if isinstance(value, Mapping):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, Sequence) and not isinstance(value, (str, bytes)):
+        return [_plain(item) for item in value]
+    return value
+
+
+def user_turn(*parts):
+    '''A user turn, each part either a text string or a function_response part dict.'''
+    return {'role': 'user', 'parts': [{'text': part} if isinstance(part, str) else part for part in parts]}
+
+
+def model_turn(returned):
+    '''The model turn for a parsed response (see _parse_response), so its function calls are passed back as real function_call parts.'''
+    parts = []
+    for parsed in returned:
+        if parsed.get('type') == 'text':
+            parts.append({'text': parsed['text']})
+        elif parsed.get('type') == 'function_call':
+            parts.append({'function_call': {'name': parsed['name'], 'args': parsed['arguments']}})
+    return {'role': 'model', 'parts': parts}
+
+
+def function_response(name, result):
+    return {'function_response': {'name': name, 'response': {'result': result}}}
+
+
+def render_turn(turn):
+    '''The text of a turn for token counting.'''
+    rendered = []
+    for part in turn['parts']:
+        if 'text' in part:
+            rendered.append(part['text'])
+        else:
+            rendered.append(json.dumps(part, ensure_ascii=False, default=str))
+    return os.linesep.join(rendered)
+
+
+class AgentContext:
+    '''The agent's conversation as an append-only list of typed turns, with incremental token accounting.
+
+    Every turn is counted once, when it is appended, and a running prefix sum of those counts is kept, so
+    building the contents for a request only costs the new turn. When the conversation no longer fits in the
+    token limit the oldest turns are dropped: the kept turns always start at a model turn (so no
+    function_response is left without its function_call) and are preceded by a user turn carrying the
+    notepad, which survives trimming.
+
+    Before it gets that far, compact() replaces the older turns with a single summary turn. The citation ids
+    retrieved in each turn are tracked so the summary can be checked to keep all of them.
+
+    Counts come from a fast estimator (see token_estimation.py). Near the limit build_contents_async checks the
+    estimate against an exact count, and the ratio between the two (scale) corrects every later decision.
+    '''
+
+    def __init__(self, token_limit=MAX_PROMPT_TOKENS, min_history=MIN_HISTORY_ENTRIES, count_tokens=None):
+        self.token_limit = token_limit
+        self.min_history = min_history
+        self.count_tokens = count_tokens or get_token_counter()
+        self.scale = 1.0          # exact / estimated tokens, learned from exact counts near the limit
+
+        self.turns = []
+        self.citation_ids = []    # citation ids retrieved in each turn
+        self.compactions = 0
+        self._model_turns = []    # indices of the model turns, the places the kept history may start
+        self._prefix_tokens = [0] # _prefix_tokens[i] == tokens used by turns[:i]
+
+        self._field_tokens = {}   # field name -> (last value, tokens)
+
+    def __len__(self):
+        return len(self.turns)
+
+    def append(self, turn, citation_ids = ()):
+        if turn['role'] == 'model':
+            self._model_turns.append(len(self.turns))
+        self.turns.append(turn)
+        self.citation_ids.append(list(citation_ids))
+        self._prefix_tokens.append(self._prefix_tokens[-1] + self.count_tokens(render_turn(turn)))
+
+    @property
+    def tokens(self):
+        '''Estimated tokens of the whole history.'''
+        return round(self._prefix_tokens[-1] * self.scale)
+
+    def compaction_point(self, threshold = COMPACTION_THRESHOLD_TOKENS, keep_tokens = COMPACTION_KEEP_TOKENS):
+        '''Index of the model turn before which the history should be compacted, or 0 if it is still under the threshold.'''
+        if self.tokens <= threshold:
+            return 0
+        end = self.trim_start((self.token_limit - keep_tokens) / self.scale)
+        # not worth a summary if the recent turns that have to be kept are most of the history
+        return end if self._prefix_tokens[end] * self.scale >= (threshold - keep_tokens) // 2 else 0
+
+    def compact(self, end, summary, compactions):
+        '''Replaces the turns before index end with a single user turn holding summary.
+
+        compactions is the value of self.compactions when the summary was started, if the history has been
+        compacted since then the summary is stale and is not applied.
+
+        Returns:
+            bool: Whether the history was compacted.
+        '''
+        if compactions != self.compactions or not 0 < end < len(self.turns):
+            return False
+        summary_turn = user_turn(compacted_history_instructions.format(summary=summary))
+        kept_tokens = [self._prefix_tokens[i + 1] - self._prefix_tokens[i] for i in range(end, len(self.turns))]
+        compacted_ids = list(dict.fromkeys(cid for ids in self.citation_ids[:end] for cid in ids))
+
+        self.turns = [summary_turn, *self.turns[end:]]
+        self.citation_ids = [compacted_ids, *self.citation_ids[end:]]
+        self._model_turns = [i - end + 1 for i in self._model_turns if i >= end]
+        self._prefix_tokens = [0, self.count_tokens(render_turn(summary_turn))]
+        for tokens in kept_tokens:
+            self._prefix_tokens.append(self._prefix_tokens[-1] + tokens)
+        self.compactions += 1
+        return True
+
+    def extend(self, turns):
+        for turn in turns:
+            self.append(turn)
+
+    def render(self, end = None):
+        '''The turns before index end as plain text, e.g. to be summarised.'''
+        return (os.linesep * 2).join(f"{turn['role']}: {render_turn(turn)}" for turn in self.turns[:end])
+
+    def count(self, text):
+        '''Token count of a piece of text, using the context's token counter.'''
+        return self.count_tokens(text)
+
+    def _count_field(self, name, value):
+        value = str(value)
+        cached = self._field_tokens.get(name)
+        if cached is not None and cached[0] == value:
+            return cached[1]
+        tokens = self.count_tokens(value)
+        self._field_tokens[name] = (value, tokens)
+        return tokens
+
+    def trim_start(self, fixed_tokens):
+        '''Index of the first turn to keep so that fixed_tokens + the kept turns fit in the token limit (both as estimated).'''
+        n = len(self.turns)
+        budget = self.token_limit / self.scale - fixed_tokens
+        # Smallest start such that _prefix_tokens[n] - _prefix_tokens[start] <= budget
+        start = bisect.bisect_left(self._prefix_tokens, self._prefix_tokens[n] - budget)
+        # but always leave the minimum number of turns in
+        latest = max(0, n - self.min_history)
+        start = min(start, latest)
+        if start <= 0:
+            return 0
+        # and start at a model turn: the next one if that still leaves the minimum, otherwise the one before
+        i = bisect.bisect_left(self._model_turns, start)
+        if i < len(self._model_turns) and self._model_turns[i] <= latest:
+            return self._model_turns[i]
+        i = bisect.bisect_right(self._model_turns, latest) - 1
+        return self._model_turns[i] if i >= 0 else 0
+
+    def min_tokens(self, notepad = ''):
+        '''Estimated tokens of the least history build_contents keeps: the last min_history turns (from a model
+        turn) and, if that drops any, the notepad turn in their place.'''
+        start = self.trim_start(float('inf'))
+        tokens = self._prefix_tokens[-1] - self._prefix_tokens[start]
+        if start:
+            tokens += self._count_field('trimmed_history', render_turn(user_turn(trimmed_history_instructions.format(notepad=notepad))))
+        return round(tokens * self.scale)
+
+    def build_contents(self, system_instruction = '', notepad = '', final_turn = None):
+        '''The generate_content contents for the next request: the turns that fit in the token limit (dropping the oldest first).
+
+        Args:
+            system_instruction (str): The system instruction sent with the request, it counts towards the token limit.
+            notepad (str): The agent's notepad, shown in place of the dropped turns.
+            final_turn (dict): A user turn to send after the history without keeping it in the history.
+
+        Returns:
+            tuple[list[dict], int]: The contents and their estimated token count (including the system instruction).
+        '''
+        with span('context_trim', history_entries=len(self.turns)) as trim_span:
+            fixed_tokens = self._count_field('system_instruction', system_instruction)
+            if final_turn is not None:
+                fixed_tokens += self.count_tokens(render_turn(final_turn))
+            trimmed_turn = user_turn(trimmed_history_instructions.format(notepad=notepad))
+            trimmed_tokens = self._count_field('trimmed_history', render_turn(trimmed_turn))
+
+            start = self.trim_start(fixed_tokens)
+            if start:
+                start = self.trim_start(fixed_tokens + trimmed_tokens)
+            contents = self.turns[start:] if not start else [trimmed_turn, *self.turns[start:]]
+            if final_turn is not None:
+                contents.append(final_turn)
+
+            prompt_tokens = fixed_tokens + self._prefix_tokens[-1] - self._prefix_tokens[start]
+            if start:
+                print(f"context management: dropping {start} of {len(self.turns)} history turns")
+                prompt_tokens += trimmed_tokens
+            prompt_tokens = round(prompt_tokens * self.scale)
+            trim_span.set(dropped_entries=start, prompt_tokens=prompt_tokens)
+            return contents, prompt_tokens
+
+    async def build_contents_async(self, system_instruction = '', notepad = '', final_turn = None, exact_count = None):
+        '''build_contents, checked with an exact count when the estimate is within EXACT_COUNT_MARGIN of the token limit.
+
+        Args:
+            exact_count: Optional async callable (contents, system_instruction) -> exact tokens or None, e.g.
+                GeminiTokenCounter.count_contents_async. Its ratio to the estimate is kept in self.scale, and the
+                contents are trimmed again if the exact count is over the limit.
+
+        Returns:
+            tuple[list[dict], int]: The contents and their token count (exact when it was checked).
+        '''
+        contents, prompt_tokens = self.build_contents(system_instruction, notepad, final_turn)
+        if exact_count is None or prompt_tokens < self.token_limit * (1 - EXACT_COUNT_MARGIN):
+            return contents, prompt_tokens
+
+        exact = await exact_count(contents, system_instruction)
+        if not exact:
+            return contents, prompt_tokens
+        annotate(estimated_tokens=prompt_tokens, exact_tokens=exact)
+        self.scale *= exact / max(prompt_tokens, 1)
+        if exact <= self.token_limit:
+            return contents, exact
+        return self.build_contents(system_instruction, notepad, final_turn)
+
+
+# Most of the token limit the evidence of a forced finish may take, the rest is left to the most recent history.
+FORCED_EVIDENCE_SHARE = 0.6
+
+
+async def build_forced_finish_contents(history, system_instruction, pending, evidence, notepad, exact_count = None):
+    '''Contents for a forced finish: the history that fits followed by a final turn with the evidence, within the token limit.
+
+    The evidence gets what is left after the system instruction, the rest of the final turn and the least history
+    that is kept (at most FORCED_EVIDENCE_SHARE of the limit), the most recently retrieved records first. If the
+    built prompt is still over the limit (e.g. by the exact count) the evidence is shrunk by the excess.
+
+    Returns:
+        tuple[list[dict], int]: The contents and their token count.
+    '''
+    current_date = time.strftime("%Y-%m-%d")
+
+    def final_turn(evidence_tokens):
+        rendered = evidence.render_within(evidence_tokens, history.count)
+        return user_turn(*pending, forced_finish_iteration_instructions.format(evidence=rendered, notepad=notepad, current_date=current_date))
+
+    fixed_tokens = round((history.count(system_instruction) + history.count(render_turn(final_turn(0)))) * history.scale)
+    available = history.token_limit - fixed_tokens - history.min_tokens(notepad)
+    evidence_tokens = max(0, min(available, history.token_limit * FORCED_EVIDENCE_SHARE)) / history.scale
+    while True:
+        contents, prompt_tokens = await history.build_contents_async(system_instruction=system_instruction, notepad=notepad, final_turn=final_turn(evidence_tokens), exact_count=exact_count)
+        if prompt_tokens <= history.token_limit or evidence_tokens <= 0:
+            break
+        evidence_tokens = max(0, evidence_tokens - (prompt_tokens - history.token_limit) / history.scale - 1)
+    if prompt_tokens > history.token_limit:
+        print(f"context management: forced finish prompt of {prompt_tokens} tokens is over the {history.token_limit} token limit")
+    annotate(evidence_tokens=round(evidence_tokens))
+    return contents, prompt_tokens
+
+
+# Model the agent runs on.
+AGENT_MODEL = 'gemini-2.0-flash'
+
+# Models to fail over to, in order, when the main model is unavailable (circuit open or retries exhausted).
+FALLBACK_MODELS = ['gemini-1.5-pro-latest']
+
+# Cheap model that condenses older history, failing over to AGENT_MODEL.
+COMPACTION_MODEL = 'gemini-2.0-flash-lite'
+
+
+def agent_retryable_errors():
+    # ValueError is raised for empty / blocked responses, which are usually fine on a second try.
+    return retryable_errors() + (ValueError,)
+
+
+def _parse_response(response):
+    '''Turns a generate_content response into the list of text / function_call dicts the agent works with.'''
+    if not response.parts:
+        raise ValueError(f"Empty response from model: {response}")
+
+    all_text = []
+    function_calls = []
+    for part in response.parts:
+        if text := part.text:
+            all_text.append(text)
+        elif fn := part.function_call:
+            function_calls.append(fn)
+        else:
+            print(f"Unexpected part: {part}")
+            continue
+    
+    to_return = []
+    if all_text:
+        to_return.append(
+            {
+                "type": "text",
+                "text": os.linesep.join(all_text)
+            }
+        )
+    for function_call in function_calls:
+        to_return.append(
+            {
+                "type": "function_call", 
+                "name": function_call.name, 
+                "arguments": _plain(function_call.args)
+            }
+        )
+
+    return to_return
+
+
+def _request_tokens(messages, system_instruction):
+    '''Estimated input tokens of a request, what the rate limiter charges for it.'''
+    count = get_token_counter()
+    return count(system_instruction or '') + sum(count(render_turn(turn)) for turn in messages)
+
+
+async def call_gemini_complete_async(prompt = None, model_name = 'gemini-2.0-flash', tools = None, tool_config = None, max_retries=3, api_key = None, fallback_models = None, deadline = 120.0, system_instruction = None, contents = None, priority = PRIORITY_BATCH, prompt_tokens = None):
+    '''Calls Gemini with exponential backoff + jitter on quota / server errors (honouring retry hints) within an overall deadline.
+    Each attempt first waits for the model's rate limiter (see admission.py), at batch priority unless told otherwise,
+    charging prompt_tokens (estimated from the request when not given, e.g. by AgentContext.build_contents).
+    If model_name keeps failing, or its circuit breaker is open, fallback_models are tried in order.
+    Either a single prompt or multi-turn contents (see AgentContext.build_contents) can be sent.
+    Backoff and rate limit waits are asyncio.sleep so they do not block a thread.'''
+    messages = contents if contents is not None else [user_turn(prompt)]
+    policy = RetryPolicy(max_retries=max_retries, deadline=deadline, retry_on=agent_retryable_errors())
+    request_tokens = prompt_tokens if prompt_tokens is not None else _request_tokens(messages, system_instruction)
+
+    async def generate(model_name):
+        annotate(model=model_name)
+        await get_rate_limiter(model_name, api_key).acquire_async(request_tokens, priority, max_wait=remaining_deadline())
+        model = get_gemini_model_async(model_name, api_key=api_key, tools=tools, tool_config=tool_config, system_instruction=system_instruction)
+        response = await model.generate_content_async(contents = messages)
+        record_usage(current_span(), response)
+        return _parse_response(response)
+
+    with span('call_gemini_complete', model=model_name):
+        return await call_with_failover_async(policy, generate, [model_name, *(fallback_models or [])], api_key=api_key)
     
-    current_iteration = 0
-    while current_iteration < max_retries + 1:
 
-        try:
 
-            response = model.generate_content(contents = messages, tools=tools, tool_config=tool_config)  # Removed kwargs because Google cannot handle kwargs that aren't applicable
+def _extractive_summary(turns):
+    '''Fallback summary of some turns: the agent's own notes, earlier summaries and the functions it called.'''
+    lines = []
+    for turn in turns:
+        for part in turn['parts']:
+            if 'function_call' in part:
+                call = part['function_call']
+                lines.append(f"- called {call['name']}: {json.dumps(call['args'], ensure_ascii=False, default=str)}")
+            elif 'text' in part and (turn['role'] == 'model' or part['text'].startswith(COMPACTED_HISTORY_HEADER)):
+                lines.append(part['text'])
+    return os.linesep.join(lines)
+
+
+async def summarize_history_async(history, end, objective, api_key = None):
+    '''Condenses history.turns[:end] into an evidence summary that keeps every citation id retrieved in them.
+
+    A cheap flash model writes the summary, if that fails an extractive one is used instead. Citation ids the
+    summary left out are listed after it, so no retrieved evidence is lost.
+    '''
+    citation_ids = list(dict.fromkeys(cid for ids in history.citation_ids[:end] for cid in ids))
+    with span('context_compaction', compacted_turns=end, citation_ids=len(citation_ids)) as compaction_span:
+        prompt = compaction_instructions.format(objective=objective, history=history.render(end))
+        try:
+            returned = await call_gemini_complete_async(prompt, model_name=COMPACTION_MODEL, api_key=api_key, fallback_models=[AGENT_MODEL], max_retries=1, deadline=60.0)
+            summary = os.linesep.join(parsed['text'] for parsed in returned if parsed.get('type') == 'text')
+        except Exception as e:
+            print(f"context compaction: summarising failed, using an extractive summary: {str(e)}")
+            summary = ''
 
-            if response.parts:
+        if not summary:
+            summary = _extractive_summary(history.turns[:end])
+            compaction_span.set(extractive=True)
 
-                all_text = []
-                function_call = None
-                for part in response.parts:
-                    if text := part.text:
-                        all_text.append(text)
-                    elif fn := part.function_call:
-                        function_call = fn
-                    else:
-                        print(f"Unexpected part: {part}")
-                        continue
-                
-                to_return = []
-                if all_text:
-                    to_return.append(
-                        {
-                            "type": "text",
-                            "text": os.linesep.join(all_text)
-                        }
-                    )
-                if function_call:
-                    to_return.append(
-                        {
-                            "type": "function_call", 
-                            "name": function_call.name, 
-                            "arguments": function_call.args
-                        }
-                    )
-
-                return to_return
-
-        except (ResourceExhausted, InternalServerError, ValueError) as e:
-            if current_iteration >= max_retries:
-                print(f"Failed to get response from model after current iteration: {current_iteration}")
-                raise e
-            print(f"Retryable error occured: {str(e)}, waiting 5 seconds and retrying.")
-            time.sleep(5)
-            current_iteration+=1
-            continue
-        except Exception as e:
-            print(f"Unexpected exception: {e}")
-            raise e
-    
-    raise Exception(f"Failed to get response from model after current iteration: {current_iteration}")
-    
+        missing = [cid for cid in citation_ids if f"[{cid}]" not in summary]
+        if missing:
+            summary += os.linesep * 2 + "Also retrieved earlier (still valid evidence that can be cited): " + ' '.join(f"[{cid}]" for cid in missing)
+        compaction_span.set(missing_citation_ids=len(missing))
+        return summary
 
 system_instructions  = '''You are a graph research assistant that can work step by step, call functions to gather information, and ultimately aims to achieve the users objective. 
 
 **INSTRUCTIONS:**
-- At each step your response and function responses will be fed back to you in order for you to proceed. The idea is for you to call the query_graph function, get the results, determine if you need to gather more information, call it again, aggregate the information, and when you are finally done, call the finish_response function to provide your final answer.
-- You are also given access to a persistent 'notepad' where you should write down important findings, plan, questions you have, or anything else you think is important. The notepad is persistent and will be available throughout, the history will go away, but the notepad content will not, and you can update it accordingly using the write_to_notepad function. Suggested to update every 5 iterations.
-- Your history, your responses, and function responses will be repeatedly passed back to you in order for you to proceed.
+- At each step your response and function responses will be fed back to you, as the conversation so far, in order for you to proceed. The idea is for you to call the query_graph function, get the results, determine if you need to gather more information, call it again, aggregate the information, and when you are finally done, call the finish_response function to provide your final answer.
+- You are also given access to a persistent 'notepad' where you should write down important findings, plan, questions you have, or anything else you think is important. The notepad is persistent and will be available throughout, the oldest history will go away, but the notepad content will not: it is shown in place of the history that was dropped. You can update it accordingly using the write_to_notepad function. Suggested to update every 5 iterations. Queries you plan in the notepad as lines starting with "Next query:" are fetched ahead of time, so they come back faster when you run them.
 - You do NOT have to call a function on every single iteration, it is completely okay for you to spend some time to think about the information you have gathered so far and decide if you need more information or if you are ready to finish. In this case, you responses will simply be fed back to you in order for you to proceed.
-- You have a maximum number of iterations in order to achieve the user's objective. You are currently on iteration {current_iteration} out of a maximum of {max_iterations}. You MUST call the finish_response function before the maximum number of iterations is reached.
+- You have a maximum number of iterations in order to achieve the user's objective. The current iteration is given at the end of each message. You MUST call the finish_response function before the maximum number of iterations is reached.
 - When you are finished with your research, you must call the finish_response function to provide your final answer. An explicit function call to the finish_response function is required to end the loop.
 - You must be factual, thorough, and aggregate information from the calls.
+- Results you already retrieved earlier in your research are not repeated by query_graph, a short note lists their citation ids instead. Those results are still valid evidence and can still be cited.
 - Citations:
     - Ensure that you cite the information id's using square brackets in your response. For example: "this is some information [1234]". This is essential for the user to be able to verify the information.
     - The user does not have access to the content retrieved from the graph database, so you must provide all relevant information in your response. i.e dont say according to [1234] the answer is X. You must actually provide the specific answer in full.
@@ -98,30 +433,60 @@ system_instructions  = '''You are a graph research assistant that can work step
 - You must aggregate citations from the responses you get from the functions you call, and make sure that the final response includes all the citations appropriately.
 - Use your best judgement everywhere applicable.
 
-**CURRENT DATE:**
-{current_date}
-
-**YOUR HISTORY:**
-{history}
-
 **USER OBJECTIVE:**
 {objective}
 
-**NOTEPAD:**
-{notepad}
-
 **FUNCTIONS:**
-You have access to 3 functions:
+You have access to 4 functions:
 1. query_graph
-- This function takes a query string as input, and queries our global financial knowledge graph to retrieve context that is meant to be relevant to the query. 
+- This function takes a query string as input, and queries our global financial knowledge graph to retrieve context that is meant to be relevant to the query. Results are sized to the room left in your context. If you need more results for the same query, call it again with page 2, 3, ...
 
-2. write_to_notepad
+2. query_graph_batch
+- This function takes a list of queries (each with a query string and optional start_date / end_date) and runs them all at the same time against the knowledge graph. Use it whenever you already know several things you want to look up, it is much faster than calling query_graph for each of them one after another.
+
+3. write_to_notepad
 - This function takes a content string as input, and adds it to your notepad. It will return a success message.
 
-3. finish_response
+4. finish_response
 - This function takes a content string and a citations array as input and doesnt return anything. Use this function to return your final results to the user, the loop will end after this.
 
-You may call 1 function at a time.'''
+You may call several query_graph functions (or one query_graph_batch) in the same response, they will be run concurrently and their results returned together. Call finish_response on its own.'''
+
+# Sent as the user turn that starts each iteration, after the stable system_instructions prefix and the conversation so far.
+iteration_instructions = '''**CURRENT DATE:**
+{current_date}
+
+**CURRENT ITERATION:**
+You are currently on iteration {current_iteration} out of a maximum of {max_iterations}.'''
+
+# Condenses the older history (see summarize_history_async).
+compaction_instructions = '''You are condensing the earlier part of a research assistant's history so that it fits in its context.
+
+**INSTRUCTIONS:**
+- Write a compact evidence summary of the history below: every distinct retrieved fact that could help achieve the objective, as short markdown bullet points, plus the assistant's key findings and open questions.
+- Keep the citation id of every fact in square brackets exactly as given, for example: "TSMC expanded CoWoS capacity [1234]". Never make up or change citation ids.
+- List the queries that were already run, so they are not repeated.
+- Output only the summary, no preliminary comments.
+
+**USER OBJECTIVE:**
+{objective}
+
+**HISTORY TO CONDENSE:**
+{history}'''
+
+COMPACTED_HISTORY_HEADER = '**SUMMARY OF YOUR EARLIER RESEARCH:**'
+
+# Replaces the older turns once they have been condensed.
+compacted_history_instructions = COMPACTED_HISTORY_HEADER + '''
+Your earlier history was condensed to stay within the context limit. The cited results are still valid evidence and can still be cited.
+
+{summary}'''
+
+# Sent in place of the oldest turns once they no longer fit in the context.
+trimmed_history_instructions = '''Your earlier history was dropped to stay within the context limit.
+
+**NOTEPAD:**
+{notepad}'''
 
 forced_finish_instructions  = '''You are a research assistant that can work step by step, call functions to gather information, and ultimately aims to achieve the users objective.
 
@@ -138,18 +503,9 @@ forced_finish_instructions  = '''You are a research assistant that can work step
 **INSTRUCTIONS:**
 - You must call the finish_response function to provide your final answer and citations based on the history and the users objective.
 
-**CURRENT DATE:**
-{current_date}
-
-**YOUR HISTORY:**
-{history}
-
 **USER OBJECTIVE:**
 {objective}
 
-**NOTEPAD:**
-{notepad}
-
 **FUNCTIONS:**
 You have access to ONE function which you MUST CALL NOW:
 
@@ -157,14 +513,40 @@ You have access to ONE function which you MUST CALL NOW:
 - This function takes a content string and a citations array as input and doesnt return anything. Use this function to return your final results to the user, the loop will end after this.
 '''
 
+# Added to the system instructions when a previous answer to the objective is being refreshed.
+refresh_instructions = '''**PREVIOUS ANSWER:**
+This objective was already researched on {previous_date} (as: {previous_objective}), with the knowledge graph up to {since_date}. Your task is to UPDATE that answer, not to research it again from scratch:
+- query_graph only searches from {since_date} onwards, so every result is new since the previous answer. Focus on what happened since then, the previous answer already covers what came before.
+- Keep what is still valid in the previous answer with its citations, correct or extend it with the new results, and make clear what changed since {since_date}.
+- If nothing relevant is new, return the previous answer and say that there were no significant developments since {since_date}.
+
+{answer}'''
+
+forced_finish_iteration_instructions = '''**YOU HAVE REACHED THE MAXIMUM NUMBER OF ITERATIONS AND MUST RETURN A 'finish_response' FUNCTION CALL NOW.**
+
+**EVIDENCE:**
+The most recent distinct results retrieved from the knowledge graph during your research, as many as fit (some of them may no longer be in your history):
+{evidence}
+
+**NOTEPAD:**
+{notepad}
+
+**CURRENT DATE:**
+{current_date}'''
+
 
 ################################### TOOLS ###################################
-from functions import get_context
-def query_graph(query, start_date = '2024-06-01', end_date = '2025-03-22', context_window = 10000, k = 50):
-    return get_context(query, start_date=start_date, end_date=end_date, context_window=context_window, k=k)
+from functions import get_context_async
+from graph_context import EvidenceStore, GraphContext
+from retrieval_cache import normalize_query
+from retrieval_policy import agent_retrieval_size, page_size
+from research_store import ResearchRun, cited_evidence, get_research_store
+
+# Dates searched by graph queries that do not give their own.
+DEFAULT_QUERY_WINDOW = {'start_date': '2024-06-01', 'end_date': '2025-03-22'}
 query_graph_schema = {
     "name": "query_graph",
-    "description": "This function takes a query string as input, queries the global financial knowledge graph to retrieve context relevant to the query, and returns the results. Will return 10000 tokens of context at a time, so ensure that you understand how to use this query effectively.",
+    "description": "This function takes a query string as input, queries the global financial knowledge graph to retrieve context relevant to the query, and returns the results. Will return up to 10000 tokens of context at a time (less when your context is getting full), so ensure that you understand how to use this query effectively. Ask for page 2, 3, ... of the same query to get further results.",
     "parameters": {
         "type": "object",
         "properties": {
@@ -180,6 +562,10 @@ query_graph_schema = {
                 "type": "string",
                 "description": "The end date for the context window. Default is '2025-03-22'. This cannot be a future date. Use this if you desire to have more targeted queries."
             },
+            "page": {
+                "type": "integer",
+                "description": "Which page of results to return, default 1. Page 2, 3, ... return further results for the same query, beyond those already returned."
+            },
             # "context_window": {
             #     "type": "integer",
             #     "description": "The size of the context window. Default is 10000."
@@ -194,6 +580,133 @@ query_graph_schema = {
 
 }
 
+# Maximum number of graph queries run at the same time for a single agent.
+MAX_CONCURRENT_QUERIES = 4
+
+def _merge_graph_results(queries, results, evidence = None):
+    rendered = [evidence.render_new(result) if evidence is not None else str(result) for result in results]
+    if len(rendered) == 1:
+        return rendered[0]
+
+    return os.linesep.join(
+        f"query_graph result {i} for query: {q['query']} ({q.get('start_date')} to {q.get('end_date')}):{os.linesep}{result}"
+        for i, (q, result) in enumerate(zip(queries, rendered), start=1)
+    )
+
+async def query_graph_async(query, start_date = '2024-06-01', end_date = '2025-03-22', context_window = 10000, k = 50, page = 1):
+    return await get_context_async(query, start_date=start_date, end_date=end_date, **page_size(k, context_window, page))
+
+async def run_graph_queries_async(queries, max_workers = MAX_CONCURRENT_QUERIES, prefetcher = None):
+    '''Runs several query_graph_async calls, at most max_workers at once, and returns their GraphContexts in order.
+    Queries the prefetcher already started are served from it.'''
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def run(kwargs):
+        if prefetcher is not None and (prefetched := prefetcher.take(kwargs)) is not None:
+            return await prefetched
+        async with semaphore:
+            return await query_graph_async(**kwargs)
+
+    return await asyncio.gather(*(run(kwargs) for kwargs in queries))
+
+# Most prefetches in flight at once for a single agent.
+MAX_PREFETCHES = 3
+
+# Notepad lines like "Next query: TSMC CoWoS capacity" are prefetched while the agent is still thinking.
+_PLANNED_QUERY_PATTERN = re.compile(r'^\s*(?:[-*]\s*)?next query:\s*(.+?)\s*$', re.IGNORECASE | re.MULTILINE)
+
+
+class GraphPrefetcher:
+    '''Speculative graph queries, started before the model asks for them.
+
+    The objective is fetched at the same time as the first model call, since the first thing the agent does is
+    nearly always query it. When the model then asks for a matching query (same normalized text, dates and
+    page) it is served from the prefetch, otherwise the prefetch is discarded at the end of the run. A prefetch
+    sized for a larger context window than the query now gets (the prompt filled up since it was started) is
+    dropped rather than served, so a hit never exceeds the current budget.
+    '''
+
+    def __init__(self, max_prefetches = MAX_PREFETCHES):
+        self.max_prefetches = max_prefetches
+        self.hits = 0
+        self._tasks = {}  # match key -> (task, context window it was sized for)
+        self._asked = set()  # match keys of the queries the model already ran
+
+    @staticmethod
+    def _key(kwargs):
+        query = normalize_query(kwargs['query']).strip(' ?.!')
+        return (query, kwargs.get('start_date', '2024-06-01'), kwargs.get('end_date', '2025-03-22'), int(kwargs.get('page') or 1))
+
+    def prefetch(self, kwargs):
+        '''Starts query_graph_async(**kwargs) in the background, unless it already ran, is running or too many are.'''
+        key = self._key(kwargs)
+        if key in self._tasks or key in self._asked or len(self._tasks) >= self.max_prefetches:
+            return
+        self._tasks[key] = (asyncio.create_task(query_graph_async(**kwargs)), kwargs.get('context_window', 10000))
+
+    def prefetch_planned(self, notepad, params):
+        '''Prefetches the queries planned in the notepad as "Next query: ..." lines, with the other query_graph params given.'''
+        for query in _PLANNED_QUERY_PATTERN.findall(notepad):
+            self.prefetch({'query': query, **params})
+
+    def take(self, kwargs):
+        '''The prefetched task for a query, or None. Each prefetch is served once, and only if it fits the
+        query's context window.'''
+        key = self._key(kwargs)
+        self._asked.add(key)
+        task, context_window = self._tasks.pop(key, (None, None))
+        if task is None:
+            return None
+        if context_window > kwargs.get('context_window', 10000):
+            task.cancel()
+            return None
+        self.hits += 1
+        annotate(prefetch_hits=self.hits)
+        return task
+
+    def discard(self):
+        for task, _ in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+
+
+query_graph_batch_schema = {
+    "name": "query_graph_batch",
+    "description": "Runs several query_graph queries against the global financial knowledge graph at the same time and returns all the results together. Prefer this over sequential query_graph calls when you know several things you want to look up.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "queries": {
+                "type": "array",
+                "description": "The queries to run, at most a handful at a time.",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "query": {
+                            "type": "string",
+                            "description": "The query string to search in the global financial knowledge graph."
+                        },
+                        "start_date": {
+                            "type": "string",
+                            "description": "The start date for the context window. Default is '2024-06-01'."
+                        },
+                        "end_date": {
+                            "type": "string",
+                            "description": "The end date for the context window. Default is '2025-03-22'. This cannot be a future date."
+                        },
+                        "page": {
+                            "type": "integer",
+                            "description": "Which page of results to return, default 1. Page 2, 3, ... return further results for the same query."
+                        },
+                    },
+                    "required": ["query"]
+                }
+            }
+        },
+        "required": ["queries"]
+    }
+}
+
 write_to_notepad_schema = {
     "name": "write_to_notepad",
     "description": "This function takes a content string as input and adds it to your notepad. It returns a success message.",
@@ -224,195 +737,364 @@ finish_response_schema = {
     }
 }
 
+agent_tools = [
+    {
+        'function_declarations': [query_graph_schema, query_graph_batch_schema, write_to_notepad_schema, finish_response_schema]
+    }
+]
+
 ######################################################################
 
-def graph_research_agent(objective, max_iterations = 10):
+def build_system_instruction(template, objective, previous = None):
+    '''The system instruction for objective from template, with the previous answer when refreshing a ResearchRun.'''
+    instruction = template.format(objective=objective)
+    if previous is None:
+        return instruction
+    refresh = refresh_instructions.format(
+        previous_date=time.strftime("%Y-%m-%d", time.localtime(previous.created_at)),
+        previous_objective=previous.objective,
+        since_date=refresh_window(previous)['start_date'],
+        answer=previous.answer,
+    )
+    return instruction + os.linesep*2 + refresh
+
+
+def refresh_window(previous = None):
+    '''start_date / end_date searched by default: everything since a previous run's end_timestamp (up to now), or
+    DEFAULT_QUERY_WINDOW for a run from scratch.'''
+    if previous is None or previous.end_timestamp is None:
+        return dict(DEFAULT_QUERY_WINDOW)
+    return {'start_date': time.strftime("%Y-%m-%d", time.localtime(previous.end_timestamp)), 'end_date': None}
+
+
+# Iterations a refresh gets at most, it only has to fold what is new into the previous answer.
+REFRESH_MAX_ITERATIONS = 4
+
+async def graph_research_agent_async(objective, max_iterations = 10, api_key = None, stats = None, prefetch = True, on_progress = None, refresh = True):
+    '''Runs the research agent for one objective and returns the final markdown answer (or None).
+
+    Every model and graph call is awaited, so many objectives can run at once on a single event loop.
+    If a stats dict is passed, 'iterations', 'llm_calls', 'graph_queries', 'prompt_tokens' (estimated), 'compactions'
+    and 'prefetch_hits' are accumulated in it.
+    With prefetch, graph queries the model is likely to ask for are started ahead of time (see GraphPrefetcher).
+    on_progress, if given, is called after every iteration with a dict of 'iteration', 'max_iterations', the
+    'queries' run in it, the 'notepad' and the 'prompt_tokens' used so far.
+    With refresh, the finished run is kept in the ResearchStore, and if a run of the same or a similar objective
+    is already there, only the window since that run is searched and the model updates its answer (at most
+    REFRESH_MAX_ITERATIONS iterations). 'refreshes' counts these runs in stats.
+    '''
+    if stats is None:
+        stats = {}
+    stats.setdefault('refreshes', 0)
+    research_store = get_research_store() if refresh else None
+    previous = None
+    if research_store is not None:
+        try:
+            previous = research_store.find(objective)
+        except Exception as e:
+            print(f"research store lookup failed: {str(e)}")
+    if previous is not None:
+        print(f"refreshing research run {previous.id} ({previous.objective}) from {refresh_window(previous)['start_date']}")
+        stats['refreshes'] += 1
+        max_iterations = min(max_iterations, REFRESH_MAX_ITERATIONS)
+
+    with span('graph_research_agent', max_iterations=max_iterations, refresh=previous is not None) as run_span:
+        content = await _graph_research_agent(objective, max_iterations, api_key, stats, prefetch, on_progress, previous, research_store)
+        run_span.set(**stats)
+        return content
+
+
+async def _graph_research_agent(objective, max_iterations, api_key, stats, prefetch = True, on_progress = None, previous = None, research_store = None):
+    for key in ('iterations', 'llm_calls', 'graph_queries', 'prompt_tokens', 'compactions', 'prefetch_hits'):
+        stats.setdefault(key, 0)
+
     #no longer allowed to set model, we just use gemini flash 2 thinking for all for now.
     #model is between 'gemini-exp-1206' and 'gemini-2.0-flash-exp'
     # model_name = 'gemini-2.0-flash-thinking-exp'
     # model = genai.GenerativeModel(model)
 
 
-    history = []
+    system_instruction = build_system_instruction(system_instructions, objective, previous)
+    history = AgentContext()
+    exact_counter = GeminiTokenCounter(AGENT_MODEL, api_key=api_key, tools=agent_tools) # only called near the token limit
+    evidence = EvidenceStore() # everything retrieved this run, de-duplicated by citation id
+    window = refresh_window(previous) # dates searched by queries that do not give their own
+    run_started = int(time.time())
+    covered = [None, None] # earliest start / latest end timestamp actually retrieved
+    if previous is not None:
+        # The previous run's evidence is merged with the new: repeats are not shown again and the final answer can cite both.
+        evidence.add(GraphContext.from_payload(previous.evidence))
+        covered = [previous.start_timestamp, previous.end_timestamp]
     notepad = ""
+    pending = [] # function responses and notes that go into the next user turn
+    pending_ids = [] # citation ids retrieved for the next user turn
+    compaction = None # (end, history.compactions, summary task) while older history is being condensed
+    prefetcher = GraphPrefetcher() if prefetch else None
     current_iteration = 0
     proper_finish = False
 
     content = None
     # citations = None
 
-    while current_iteration <= max_iterations and not proper_finish:
-        current_iteration += 1
-
-        print(f"----------------current_iteration: {current_iteration}----------------")
-
-        # BASIC CONTEXT MANAGEMENT
-        history_for_llm = copy.copy(history)
-        # Format prompt
-        prompt = system_instructions.format(history=history_for_llm, objective=objective, notepad=notepad, current_iteration=current_iteration, max_iterations=max_iterations, current_date = time.strftime("%Y-%m-%d"))
-        #manage context:
-        while get_tiktoken_token_count(prompt) > 50000 and len(history_for_llm) > 3:
-            #the only thing we can do is remove from history untill we are under token limit, but we have to leave 3 iterations in, that is the minimum
-            history_for_llm = history_for_llm[1:]
-            prompt = system_instructions.format(history=history_for_llm, objective=objective, notepad=notepad, current_iteration=current_iteration, max_iterations=max_iterations, current_date = time.strftime("%Y-%m-%d"))
-        
-
-        tools = [
-            {
-                'function_declarations': [query_graph_schema, write_to_notepad_schema, finish_response_schema]
-            }
-        ]
-
-        # Get response from model
-        returned = call_gemini_complete(prompt, tools=tools) #this is a dictionary
-        print(f"recieved llm response: {returned}")
-
-        # Add to history
-        history.extend(returned)
-
-        #no longer need to parse becayse already a dictionary
-        # #parse the response
-        # parsed = json_repair.loads(raw_text)
-
-        # Check if we have a function call
+    async def apply_compaction():
+        # The summary has been written while the last graph queries ran, swap it in for the turns it condenses.
+        nonlocal compaction
+        if compaction is None:
+            return
+        end, compactions, task = compaction
+        compaction = None
+        try:
+            summary = await task
+        except Exception as e:
+            print(f"context compaction failed: {str(e)}")
+            return
+        tokens = history.tokens
+        if history.compact(end, summary, compactions):
+            stats['compactions'] += 1
+            print(f"context compaction: condensed {end} history turns, {tokens} -> {history.tokens} tokens")
+
+    if prefetcher is not None:
+        # Start retrieving the objective itself now, overlapping the first model call, which nearly always asks for it.
+        prefetcher.prefetch({'query': objective, **window, 'page': 1, **agent_retrieval_size(history.token_limit)})
+
+    def query_window(q):
+        start_date = q.get('start_date') or window['start_date']
+        end_date = q.get('end_date') or window['end_date']
+        if previous is not None:
+            # a refresh only searches what is new since the previous run
+            start_date = max(start_date, window['start_date'])
+            if end_date and end_date <= start_date:
+                end_date = None
+        return start_date, end_date
+
+    def report_progress(queries = ()):
+        if on_progress is None:
+            return
         try:
+            on_progress({'iteration': current_iteration, 'max_iterations': max_iterations, 'queries': [q['query'] for q in queries],
+                         'notepad': notepad, 'prompt_tokens': stats['prompt_tokens']})
+        except Exception as e:
+            print(f"on_progress failed: {str(e)}")
+
+    # Cleaned up however the run ends, including when it is cancelled or a call raises.
+    try:
+        while current_iteration <= max_iterations and not proper_finish:
+            current_iteration += 1
+            with span('agent_iteration', iteration=current_iteration):
+                print(f"----------------current_iteration: {current_iteration}----------------")
+
+                # BASIC CONTEXT MANAGEMENT
+                # The conversation only grows by appending: this iteration's user turn carries the function responses
+                # to the last model turn plus the date and iteration. The stable instructions / objective / tools go
+                # separately as the system instruction, a stable prefix across iterations. The oldest turns are dropped once we
+                # are over the token limit, their place is taken by the notepad.
+                await apply_compaction()
+                history.append(user_turn(*pending, iteration_instructions.format(current_iteration=current_iteration, max_iterations=max_iterations, current_date = time.strftime("%Y-%m-%d"))), citation_ids=pending_ids)
+                pending, pending_ids = [], []
+                contents, prompt_tokens = await history.build_contents_async(system_instruction=system_instruction, notepad=notepad, exact_count=exact_counter.count_contents_async)
+                stats['iterations'] += 1
+                stats['llm_calls'] += 1
+                stats['prompt_tokens'] += prompt_tokens
+
+                # Get response from model
+                returned = await call_gemini_complete_async(contents=contents, model_name=AGENT_MODEL, tools=agent_tools, system_instruction=system_instruction, api_key=api_key, fallback_models=FALLBACK_MODELS, prompt_tokens=prompt_tokens) #this is a list of dictionaries
+                print(f"recieved llm response: {returned}")
 
-            for parsed in returned:
-        
-                if parsed.get("type") == "function_call":
+                # Add to history
+                history.append(model_turn(returned))
+
+                # Past the threshold, condense the older turns in the background, overlapping this iteration's graph queries.
+                if compaction is None and (end := history.compaction_point()):
+                    compaction = (end, history.compactions, asyncio.create_task(summarize_history_async(history, end, objective, api_key=api_key)))
+
+                # Check if we have a function call. Every function call gets a function response in the next user turn.
+                function_calls = [parsed for parsed in returned if parsed.get("type") == "function_call"]
+
+                # Run every graph query in this response concurrently, each query_graph / query_graph_batch call gets its own results.
+                graph_calls = [parsed for parsed in function_calls if parsed['name'] in ("query_graph", "query_graph_batch")]
+                graph_results = {}
+                iteration_queries = []
+                if graph_calls:
+                    try:
+                        call_queries = []
+                        for parsed in graph_calls:
+                            fn_args = parsed['arguments']
+                            queries = [fn_args] if parsed['name'] == "query_graph" else (fn_args.get('queries') or [])
+                            call_queries.append([
+                                {
+                                    'query': q['query'],
+                                    **dict(zip(('start_date', 'end_date'), query_window(q))),
+                                    'page': q.get('page', 1),
+                                }
+                                for q in queries
+                            ])
+                        all_queries = iteration_queries = [q for queries in call_queries for q in queries]
+                        # Only ask for as much context as fits in what is left of the prompt budget, shared between the queries.
+                        size = agent_retrieval_size(history.token_limit - prompt_tokens, len(all_queries))
+                        for q in all_queries:
+                            q.update(size)
+                        print(f"recieved function call(s) for query_graph with queries: {all_queries}")
+
+                        results = await run_graph_queries_async(all_queries, prefetcher=prefetcher)
+                        stats['graph_queries'] += len(all_queries)
+                        for result in results:
+                            if result.ok and result.start_timestamp is not None:
+                                covered[0] = result.start_timestamp if covered[0] is None else min(covered[0], result.start_timestamp)
+                                covered[1] = result.end_timestamp if covered[1] is None else max(covered[1], result.end_timestamp)
+                        pending_ids.extend(cid for result in results for cid in result.citation_ids)
+                        offset = 0
+                        for i, queries in enumerate(call_queries):
+                            graph_results[i] = _merge_graph_results(queries, results[offset:offset + len(queries)], evidence) if queries else "No queries were given."
+                            offset += len(queries)
+                    except Exception as e:
+                        print(f"An error occured: {str(e)}")
+                        graph_results = {i: f"An error occured: {str(e)}" for i in range(len(graph_calls))}
+
+                graph_call_index = 0
+                for parsed in function_calls:
+                    fn_name = parsed.get('name')
+                    # A malformed call (e.g. arguments of the wrong type) gets its error as the function response
+                    # instead of ending the run, so the model can correct it.
+                    try:
+                        fn_args = dict(parsed.get('arguments') or {})
+
+                        if fn_name in ("query_graph", "query_graph_batch"):
+                            # Already run, concurrently, with the other graph queries in this response.
+                            result = graph_results[graph_call_index]
+                            graph_call_index += 1
+                            print(f"recieved function response for {fn_name}: {result[:100]}...")
+                            pending.append(function_response(fn_name, result))
+
+                        elif fn_name == "write_to_notepad":
+                            note = fn_args.get('content') or ''
+                            notepad += os.linesep*2 + note
+                            print(f"recieved function call for write_to_notepad with content: {note}")
+                            if prefetcher is not None:
+                                prefetcher.prefetch_planned(note, {**window, 'page': 1, **agent_retrieval_size(history.token_limit - prompt_tokens)})
+                            pending.append(function_response(fn_name, f"Added to notepad: {note}"))
+
+                        elif fn_name == "finish_response":
+                            # The agent is done
+                            content = fn_args.get('content')
+                            if not content or not isinstance(content, str):
+                                print(f"finish_response was called but no valid content was provided, you MUST provide a valid content string. got: {content}")
+                                pending.append(function_response(fn_name, f"finish_response was called but no valid content was provided, you MUST provide a valid content string. got {content}"))
+                                continue
+
+                            proper_finish = True
+                            break
+
+                        else: # Unknown function
+                            print(f"Unknown function name: {fn_name} was called, please call a valid function.")
+                            pending.append(function_response(fn_name, f"Unknown function name: {fn_name} was called, please call a valid function."))
+                    except Exception as e:
+                        print(f"An error occured handling {fn_name}: {str(e)}")
+                        pending.append(function_response(fn_name, f"An error occured: {str(e)}"))
+
+                # No function call, just reasoning text: it is already in the history, the next iteration follows it.
+                report_progress(iteration_queries)
+
+        if not proper_finish:
+
+            max_forced_iterations = 3
+            current_forced_iteration = 1
+            forced_system_instruction = build_system_instruction(forced_finish_instructions, objective, previous)
+            tools = [
+                {
+                    'function_declarations': [finish_response_schema]
+                }
+            ] 
 
-                    fn_name = parsed['name']
-                    fn_args = parsed['arguments']
+            tool_config = {
+                "function_calling_config": {
+                    "mode": "ANY",
+                    "allowed_function_names": ["finish_response"]
+                },
+            }
 
-                    if fn_name == "query_graph":
-                        query = fn_args["query"]
-                        start_date = fn_args.get("start_date", '2024-06-01')
-                        end_date = fn_args.get("end_date", '2025-03-22')
-                        print(f"recieved function call for query_graph with query: {query}, start_date: {start_date}, end_date: {end_date}")
+            forced_exact_counter = GeminiTokenCounter(AGENT_MODEL, api_key=api_key, tools=tools)
 
-                        # Call the perplexity function
-                        result = query_graph(query, start_date=start_date, end_date=end_date)
-                        print(f"recieved function response for query_graph: {result[:100]}...")
-                        # Add result to history
-                        history.append(result)
+            while not proper_finish and current_forced_iteration < max_forced_iterations:
+                with span('agent_iteration', iteration=current_iteration + current_forced_iteration, forced=True):
+                    print(f"----------------current forced iteration: {current_forced_iteration}----------------")
+                    try:
+                        # The agent did not call finish_response before max iterations
+                        print("Agent did not call finish_response before max iterations.")
 
-                        continue
+                        await apply_compaction()
+                        # The forced turn (with as much of the evidence as fits) is sent after the history but not kept in it, retries get a fresh one.
+                        contents, prompt_tokens = await build_forced_finish_contents(history, forced_system_instruction, pending, evidence, notepad, exact_count=forced_exact_counter.count_contents_async)
+                        stats['llm_calls'] += 1
+                        stats['prompt_tokens'] += prompt_tokens
 
-                    elif fn_name == "write_to_notepad":
-                        content = fn_args['content']
-                        notepad += os.linesep*2 + content
-                        print(f"recieved function call for write_to_notepad with content: {content}")
+                        if current_forced_iteration == max_forced_iterations - 1:
+                            print(f"final forced iteration: {current_forced_iteration}, last ditch effort so switching to {FALLBACK_MODELS[0]}")
+                            model_name = FALLBACK_MODELS[0]
+                            returned = await call_gemini_complete_async(contents=contents, model_name = model_name, tools=tools, tool_config=tool_config, system_instruction=forced_system_instruction, api_key=api_key, prompt_tokens=prompt_tokens)
+                        else:
+                            # fails over to the fallback model straight away if flash is unavailable
+                            returned = await call_gemini_complete_async(contents=contents, model_name=AGENT_MODEL, tools=tools, tool_config=tool_config, system_instruction=forced_system_instruction, api_key=api_key, fallback_models=FALLBACK_MODELS, prompt_tokens=prompt_tokens)
 
-                        # Add to history
-                        history.append(f"Added to notepad: {content}")
+                        report_progress()
 
-                        continue
+                        #no longer need to parse becayse already a dictionary            
+                        # #parse the response
+                        # parsed = json_repair.loads(raw_text)
+                        parsed = returned[0]
 
+                        fn_name = parsed['name']
+                        fn_args = parsed['arguments']
 
-                    elif fn_name == "finish_response":
-                        # The agent is done
                         content = fn_args['content']
                         if not content:
-                            print(f"finish_response was called but no valid content was provided, you MUST provide a valid content string. got: {content}")
-                            history.append(f"finish_response was called but no valid content was provided, you MUST provide a valid content string. got {content}")
+                            current_forced_iteration += 1
+                            print(f"finish_response was called but no content was provided, you MUST provide a valid content string. got: {content}")
+                            pending = [f"finish_response was called but no content was provided, you MUST provide a valid content string. got: {content}"]
                             continue
 
                         proper_finish = True
-                        break
-
-                    else: # Unknown function
-                        print(f"Unknown function name: {fn_name} was called, please call a valid function.")
-                        history.append(f"Unknown function name: {fn_name} was called, please call a valid function.")
 
-                        continue
+                        current_forced_iteration += 1
 
-                elif parsed.get("type") == "text":
-                    # No function call, just reasoning text. we already added it to history. Continue
-                    continue
-
-                else:
-                    print(f"Invalid response from model: {parsed}")
-                    history.append(f"Invalid response from model: {parsed}")
-                    continue
-
-            if proper_finish:
-                break
+                        break
 
+                    except Exception as e:
+                        print(f'''An error occured, YOU MAY ONY CALL THE finish_response function exclusively in the format explained do it NOW: {str(e)}''')
+                        pending = [f'''An error occured, YOU MAY ONY CALL THE finish_response function exclusively in the format explained do it NOW: {str(e)}''']
+                        current_forced_iteration += 1
+                        continue
+    finally:
+        if compaction is not None:
+            # finished (or failed) before the summary was needed
+            compaction[2].cancel()
+        if prefetcher is not None:
+            # prefetches the model never asked for
+            stats['prefetch_hits'] += prefetcher.hits
+            prefetcher.discard()
+
+    if content and research_store is not None:
+        # Kept so the next run of this objective only has to research what is new. A run that retrieved nothing
+        # (or only errors) covers up to when it started, its queries searched up to then.
+        # Only the evidence the answer cites is kept, so a run refreshed again and again does not keep growing.
+        cited = cited_evidence(evidence.as_context(), content)
+        run = ResearchRun(
+            objective=objective,
+            answer=content,
+            evidence=cited.to_payload(),
+            citation_ids=cited.citation_ids,
+            start_timestamp=covered[0],
+            end_timestamp=covered[1] if covered[1] is not None else min(run_started, int(time.time())),
+            previous_id=previous.id if previous is not None else None,
+        )
+        try:
+            research_store.save(run)
         except Exception as e:
-            print(f"An error occured: {str(e)}")
-            history.append(f"An error occured: {str(e)}")
-            continue
+            print(f"research store save failed: {str(e)}")
 
-    if not proper_finish:
-
-        max_forced_iterations = 3
-        current_forced_iteration = 1
-        while not proper_finish and current_forced_iteration < max_forced_iterations:
-            print(f"----------------current forced iteration: {current_forced_iteration}----------------")
-            try:
-                # The agent did not call finish_response before max iterations
-                print("Agent did not call finish_response before max iterations.")
-
-                history_for_llm = copy.copy(history)
-                prompt = forced_finish_instructions.format(history=history_for_llm, objective=objective, notepad=notepad, current_date = time.strftime("%Y-%m-%d"))
-                #manage context:
-                while get_tiktoken_token_count(prompt) > 50000 and len(history_for_llm) > 3:
-                    #the only thing we can do is remove from history untill we are under token limit, but we have to leave 3 iterations in, that is the minimum
-                    history_for_llm = history_for_llm[1:]
-                    prompt = forced_finish_instructions.format(history=history_for_llm, objective=objective, notepad=notepad, current_date = time.strftime("%Y-%m-%d"))
-                
-                tools = [
-                    {
-                        'function_declarations': [finish_response_schema]
-                    }
-                ] 
-
-                tool_config = {
-                    "function_calling_config": {
-                        "mode": "ANY",
-                        "allowed_function_names": ["finish_response"]
-                    },
-                }
-
-
-                if current_forced_iteration == max_forced_iterations - 1:
-                    print(f"final forced iteration: {current_forced_iteration}, last ditch effort so switching to gemini-1.5-pro-latest")
-                    model_name = 'gemini-1.5-pro-latest'
-                    returned = call_gemini_complete(prompt, model_name = model_name, tools=tools, tool_config=tool_config)
-                else:
-                    returned = call_gemini_complete(prompt, tools=tools, tool_config=tool_config)
-
-                # Add to history
-                history.extend(returned)
-
-                #no longer need to parse becayse already a dictionary            
-                # #parse the response
-                # parsed = json_repair.loads(raw_text)
-                parsed = returned[0]
-
-                fn_name = parsed['name']
-                fn_args = parsed['arguments']
-
-                content = fn_args['content']
-                if not content:
-                    current_forced_iteration += 1
-                    print(f"finish_response was called but no content was provided, you MUST provide a valid content string. got: {content}")
-                    history.append(f"finish_response was called but no content was provided, you MUST provide a valid content string. got: {content}")
-                    continue
-
-                proper_finish = True
-
-                current_forced_iteration += 1
-
-                break
-                
-            except Exception as e:
-                print(f'''An error occured, YOU MAY ONY CALL THE finish_response function exclusively in the format explained do it NOW: {str(e)}''')
-                history.append(f'''An error occured, YOU MAY ONY CALL THE finish_response function exclusively in the format explained do it NOW: {str(e)}''')
-                current_forced_iteration += 1
-                continue
-    
     print(f"returning content: {content}")
     return content
 
 
+def graph_research_agent(objective, max_iterations = 10, api_key = None, stats = None, prefetch = True, on_progress = None, refresh = True):
+    '''Synchronous entry point, runs graph_research_agent_async on the shared background event loop.'''
+    return run_sync(graph_research_agent_async(objective, max_iterations=max_iterations, api_key=api_key, stats=stats, prefetch=prefetch, on_progress=on_progress, refresh=refresh))
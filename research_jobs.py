@@ -0,0 +1,132 @@
+'''Background research jobs for the Streamlit app.
+
+graph_research_agent takes minutes, far too long to run inside a Streamlit script run (which a rerun would
+also throw away). Jobs run on the process-wide background event loop instead and are tracked by id: the page
+only submits them and polls their progress, so several can run at once and they survive reruns.
+'''
+import os
+import time
+import uuid
+import asyncio
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from functions import run_async
+
+# Defaults, overridable through the environment.
+RESEARCH_JOB_DEADLINE_SECONDS = float(os.environ.get('RESEARCH_JOB_DEADLINE_SECONDS', 900))
+MAX_CONCURRENT_RESEARCH_JOBS = int(os.environ.get('MAX_CONCURRENT_RESEARCH_JOBS', 4))
+# Finished jobs kept for display, the oldest are forgotten first.
+MAX_KEPT_RESEARCH_JOBS = 100
+
+FINISHED_STATUSES = frozenset({'done', 'failed', 'cancelled', 'timed_out'})
+
+
+@dataclass
+class ResearchJob:
+    '''One research objective and its progress. Updated from the background loop, read by the page.'''
+    objective: str
+    max_iterations: int = 10
+    deadline: float = RESEARCH_JOB_DEADLINE_SECONDS  # seconds from when the job starts running
+    id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    status: str = 'queued'  # queued, running, then one of FINISHED_STATUSES
+    created_at: float = field(default_factory=time.time)
+    started_at: float = None
+    finished_at: float = None
+    iteration: int = 0
+    queries: list = field(default_factory=list)
+    notepad: str = ''
+    prompt_tokens: int = 0
+    stats: dict = field(default_factory=dict)
+    content: str = None
+    error: str = None
+    future: object = field(default=None, repr=False)
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    @property
+    def elapsed(self):
+        '''Seconds spent running so far (or in total, once finished).'''
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def on_progress(self, progress):
+        self.iteration = progress['iteration']
+        self.queries.extend(progress['queries'])
+        self.notepad = progress['notepad']
+        self.prompt_tokens = progress['prompt_tokens']
+
+    def cancel(self):
+        '''Cancels the job if it is still queued or running.'''
+        if self.future is not None and self.future.cancel() and self.status == 'queued':
+            # cancelled before it started, so the job itself never gets to record it
+            self.status = 'cancelled'
+            self.finished_at = time.time()
+
+
+class ResearchJobManager:
+    '''Runs research jobs on the shared background event loop, at most max_concurrent at a time.'''
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_RESEARCH_JOBS, max_kept=MAX_KEPT_RESEARCH_JOBS):
+        self.max_concurrent = max_concurrent
+        self.max_kept = max_kept
+        self._jobs = OrderedDict()  # id -> ResearchJob, oldest first
+        self._lock = threading.Lock()
+        self._semaphore = None  # created on the background loop
+
+    def submit(self, objective, api_key=None, max_iterations=10, deadline=RESEARCH_JOB_DEADLINE_SECONDS):
+        '''Queues a research job and returns it straight away.'''
+        job = ResearchJob(objective=objective, max_iterations=max_iterations, deadline=deadline)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget_finished()
+        job.future = run_async(self._run(job, api_key))
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _forget_finished(self):
+        # Must hold _lock.
+        excess = len(self._jobs) - self.max_kept
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished][:max(0, excess)]:
+            del self._jobs[job_id]
+
+    async def _run(self, job, api_key):
+        # Imported here so that importing this module (and so the page) does not load the agent and its SDKs.
+        from graph_research_agent import graph_research_agent_async
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        try:
+            async with self._semaphore:
+                job.status = 'running'
+                job.started_at = time.time()
+                job.content = await asyncio.wait_for(
+                    graph_research_agent_async(job.objective, max_iterations=job.max_iterations, api_key=api_key,
+                                               stats=job.stats, on_progress=job.on_progress),
+                    timeout=job.deadline,
+                )
+                job.status = 'done' if job.content else 'failed'
+                if not job.content:
+                    job.error = "agent finished without content"
+        except asyncio.TimeoutError:
+            job.status = 'timed_out'
+            job.error = f"deadline of {job.deadline:.0f}s reached"
+        except asyncio.CancelledError:
+            job.status = 'cancelled'
+            raise
+        except Exception as e:
+            job.status = 'failed'
+            job.error = f"{type(e).__name__}: {e}"
+        finally:
+            job.finished_at = time.time()
+        return job.content
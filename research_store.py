@@ -0,0 +1,167 @@
+'''Completed research runs, kept so that asking the same objective again only has to research what is new.
+
+A run stores its objective, final answer, the evidence the answer cites (records with their citation ids and
+timestamps) and the time window that evidence covers. Only cited evidence is kept, so refreshing a run over and
+over does not grow what is stored and loaded again. When the same or a similar objective comes back,
+graph_research_agent looks up the latest run, queries only the window since its end_timestamp, merges the new
+evidence into the old and has the model update the earlier answer.
+'''
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+
+from graph_context import GraphContext, record_citation_ids
+from retrieval_cache import normalize_query
+
+# Set to a file path to keep runs across restarts, e.g. '.cache/research_runs.sqlite3'. Without it runs are
+# only kept in memory for the lifetime of the process.
+RESEARCH_STORE_PATH = os.environ.get('RESEARCH_STORE_PATH')
+# How alike (0-1, the overlap of their significant words) two objectives must be to share runs.
+RESEARCH_MATCH_THRESHOLD = float(os.environ.get('RESEARCH_MATCH_THRESHOLD', 0.8))
+# Runs older than this are not refreshed, the objective is researched from scratch instead.
+RESEARCH_REFRESH_MAX_AGE_DAYS = float(os.environ.get('RESEARCH_REFRESH_MAX_AGE_DAYS', 90))
+
+# Most evidence records kept per run, the most recently retrieved of those the answer cites.
+RESEARCH_MAX_STORED_RECORDS = int(os.environ.get('RESEARCH_MAX_STORED_RECORDS', 300))
+
+_CITATION = re.compile(r'\[([^\[\]]+)\]')
+_WORD = re.compile(r'[a-z0-9]+')
+_STOPWORDS = frozenset('a an and are as at be by for from how in is it its of on or the to what whats which who why with latest'.split())
+
+
+def objective_terms(objective):
+    '''The significant words of an objective, the key runs are matched on.'''
+    return frozenset(word for word in _WORD.findall(normalize_query(objective)) if word not in _STOPWORDS)
+
+
+def objective_similarity(a, b):
+    '''Jaccard overlap of the significant words of two objectives, 1.0 for the same objective.'''
+    terms_a, terms_b = objective_terms(a), objective_terms(b)
+    if not terms_a or not terms_b:
+        return float(normalize_query(a) == normalize_query(b))
+    return len(terms_a & terms_b) / len(terms_a | terms_b)
+
+
+def cited_ids(answer):
+    '''The citation ids in the square brackets of an answer, e.g. "[1234][5678]" or "[1234, 5678]".'''
+    return list(dict.fromkeys(cid.strip() for group in _CITATION.findall(answer or '') for cid in group.split(',') if cid.strip()))
+
+
+def cited_evidence(context, answer, max_records=RESEARCH_MAX_STORED_RECORDS):
+    '''The records of a GraphContext that answer cites, at most the last max_records of them, as a GraphContext.'''
+    cited = set(cited_ids(answer))
+    records = [(section, record) for section, record in context.records() if cited.intersection(record_citation_ids(record))]
+    sections = {}
+    for section, record in records[max(0, len(records) - max_records):]:
+        sections.setdefault(section, []).append(record)
+    return GraphContext(sections=sections)
+
+
+@dataclass
+class ResearchRun:
+    '''One completed research run.
+
+    evidence is the payload of the cited evidence (see cited_evidence and GraphContext.to_payload),
+    start_timestamp and end_timestamp the window it was retrieved from. previous_id links a refresh to the run it updated.
+    '''
+    objective: str
+    answer: str
+    evidence: dict = field(default_factory=dict)
+    citation_ids: list = field(default_factory=list)
+    start_timestamp: int = None
+    end_timestamp: int = None
+    created_at: float = field(default_factory=time.time)
+    previous_id: int = None
+    id: int = None
+
+
+class ResearchStore:
+    '''SQLite store of ResearchRuns. Safe to share between threads.'''
+
+    def __init__(self, path=RESEARCH_STORE_PATH, match_threshold=RESEARCH_MATCH_THRESHOLD, max_age_days=RESEARCH_REFRESH_MAX_AGE_DAYS):
+        self.match_threshold = match_threshold
+        self.max_age_days = max_age_days
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        if path:
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS research_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            objective TEXT NOT NULL,
+            terms TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            evidence TEXT NOT NULL,
+            citation_ids TEXT NOT NULL,
+            start_timestamp INTEGER,
+            end_timestamp INTEGER,
+            created_at REAL NOT NULL,
+            previous_id INTEGER
+        )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS research_runs_created_at ON research_runs (created_at)')
+        self._db.commit()
+
+    def save(self, run):
+        '''Stores a run and returns it with its id set.'''
+        with self._lock:
+            cursor = self._db.execute(
+                '''INSERT INTO research_runs (objective, terms, answer, evidence, citation_ids, start_timestamp, end_timestamp, created_at, previous_id)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (run.objective, ' '.join(sorted(objective_terms(run.objective))), run.answer, json.dumps(run.evidence, default=str),
+                 json.dumps(run.citation_ids), run.start_timestamp, run.end_timestamp, run.created_at, run.previous_id))
+            self._db.commit()
+            run.id = cursor.lastrowid
+        return run
+
+    def find(self, objective):
+        '''The latest run for the most similar objective at least match_threshold alike, or None.'''
+        since = time.time() - self.max_age_days * 86400
+        with self._lock:
+            rows = self._db.execute('SELECT id, objective FROM research_runs WHERE created_at >= ? ORDER BY created_at DESC',
+                                    (since,)).fetchall()
+        best_id, best_similarity = None, 0.0
+        for run_id, run_objective in rows:  # newest first, so the newest wins ties
+            similarity = objective_similarity(objective, run_objective)
+            if similarity >= self.match_threshold and (best_id is None or similarity > best_similarity):
+                best_id, best_similarity = run_id, similarity
+        return self.get(best_id) if best_id is not None else None
+
+    def get(self, run_id):
+        with self._lock:
+            row = self._db.execute(
+                '''SELECT objective, answer, evidence, citation_ids, start_timestamp, end_timestamp, created_at, previous_id, id
+                   FROM research_runs WHERE id = ?''', (run_id,)).fetchone()
+        if row is None:
+            return None
+        objective, answer, evidence, citation_ids, start_timestamp, end_timestamp, created_at, previous_id, run_id = row
+        return ResearchRun(objective=objective, answer=answer, evidence=json.loads(evidence), citation_ids=json.loads(citation_ids),
+                           start_timestamp=start_timestamp, end_timestamp=end_timestamp, created_at=created_at,
+                           previous_id=previous_id, id=run_id)
+
+
+_research_store = None
+_research_store_lock = threading.Lock()
+
+
+def get_research_store():
+    '''Returns the process-wide ResearchStore, creating it on first use.'''
+    global _research_store
+    if _research_store is None:
+        with _research_store_lock:
+            if _research_store is None:
+                _research_store = ResearchStore()
+    return _research_store
+
+
+def set_research_store(store):
+    '''Replaces the process-wide ResearchStore.'''
+    global _research_store
+    with _research_store_lock:
+        _research_store = store
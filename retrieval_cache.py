@@ -0,0 +1,170 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Defaults, overridable through the environment.
+RETRIEVAL_CACHE_TTL_SECONDS = float(os.environ.get('RETRIEVAL_CACHE_TTL_SECONDS', 6 * 3600))
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.environ.get('RETRIEVAL_CACHE_MAX_ENTRIES', 512))
+RETRIEVAL_CACHE_MAX_DISK_ENTRIES = int(os.environ.get('RETRIEVAL_CACHE_MAX_DISK_ENTRIES', 10000))
+# Set to a file path to enable the on-disk tier (survives restarts), e.g. '.cache/retrieval_cache.sqlite3'.
+RETRIEVAL_CACHE_PATH = os.environ.get('RETRIEVAL_CACHE_PATH')
+
+SECONDS_PER_DAY = 86400
+
+
+def normalize_query(query):
+    '''Lowercases and collapses whitespace so trivially different phrasings of a query share a cache entry.'''
+    return re.sub(r'\s+', ' ', str(query)).strip().lower()
+
+
+def make_cache_key(project, query, start_timestamp, end_timestamp, k, context_window):
+    '''Builds the cache key for a get_context call.
+
+    Timestamps are bucketed to the day, so "from 2024-06-01 to now" asked twice on the same day is the same entry.
+    '''
+    key = json.dumps([
+        project,
+        normalize_query(query),
+        int(start_timestamp) // SECONDS_PER_DAY,
+        int(end_timestamp) // SECONDS_PER_DAY,
+        int(k),
+        int(context_window),
+    ])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class RetrievalCache:
+    '''Two tier TTL + LRU cache for graph retrieval payloads.
+
+    The memory tier is an LRU bounded by max_entries. The optional disk tier is a SQLite file bounded by
+    max_disk_entries (least recently used rows are evicted). Payloads must be JSON serialisable.
+    Safe to share between threads.
+    '''
+
+    def __init__(self, ttl=RETRIEVAL_CACHE_TTL_SECONDS, max_entries=RETRIEVAL_CACHE_MAX_ENTRIES, path=RETRIEVAL_CACHE_PATH,
+                 max_disk_entries=RETRIEVAL_CACHE_MAX_DISK_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+
+        self._memory = OrderedDict()  # key -> (expires_at, payload)
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'sets': 0, 'evictions': 0, 'expired': 0}
+
+        self._db = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS retrieval_cache (
+                key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS retrieval_cache_accessed_at ON retrieval_cache (accessed_at)')
+            self._db.commit()
+
+    def _set_memory(self, key, expires_at, payload):
+        self._memory[key] = (expires_at, payload)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._counters['evictions'] += 1
+
+    def get(self, key):
+        '''Returns the cached payload for key, or None if it is missing or expired.'''
+        now = time.time()
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None:
+                expires_at, payload = cached
+                if now < expires_at:
+                    self._memory.move_to_end(key)
+                    self._counters['hits'] += 1
+                    self._counters['memory_hits'] += 1
+                    return payload
+                del self._memory[key]
+                self._counters['expired'] += 1
+
+            if self._db is not None:
+                row = self._db.execute('SELECT payload, expires_at FROM retrieval_cache WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    if now < row[1]:
+                        payload = json.loads(row[0])
+                        self._db.execute('UPDATE retrieval_cache SET accessed_at = ? WHERE key = ?', (now, key))
+                        self._db.commit()
+                        self._set_memory(key, row[1], payload)
+                        self._counters['hits'] += 1
+                        self._counters['disk_hits'] += 1
+                        return payload
+                    self._db.execute('DELETE FROM retrieval_cache WHERE key = ?', (key,))
+                    self._db.commit()
+                    self._counters['expired'] += 1
+
+            self._counters['misses'] += 1
+            return None
+
+    def set(self, key, payload, ttl=None):
+        '''Stores payload under key in both tiers.'''
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._set_memory(key, expires_at, payload)
+            self._counters['sets'] += 1
+
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO retrieval_cache (key, payload, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                                 (key, json.dumps(payload), expires_at, now))
+                # Drop expired rows, then the least recently used ones beyond the size bound.
+                self._db.execute('DELETE FROM retrieval_cache WHERE expires_at <= ?', (now,))
+                self._db.execute('''DELETE FROM retrieval_cache WHERE key IN (
+                    SELECT key FROM retrieval_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )''', (self.max_disk_entries,))
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM retrieval_cache')
+                self._db.commit()
+
+    def stats(self):
+        '''Returns the hit / miss counters and current sizes.'''
+        with self._lock:
+            stats = dict(self._counters)
+            stats['memory_entries'] = len(self._memory)
+            if self._db is not None:
+                stats['disk_entries'] = self._db.execute('SELECT COUNT(*) FROM retrieval_cache').fetchone()[0]
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+            return stats
+
+
+_retrieval_cache = None
+_retrieval_cache_lock = threading.Lock()
+
+
+def get_retrieval_cache():
+    '''Returns the process-wide RetrievalCache, creating it on first use.'''
+    global _retrieval_cache
+    if _retrieval_cache is None:
+        with _retrieval_cache_lock:
+            if _retrieval_cache is None:
+                _retrieval_cache = RetrievalCache()
+    return _retrieval_cache
+
+
+def set_retrieval_cache(cache):
+    '''Replaces the process-wide RetrievalCache (e.g. RetrievalCache(ttl=0) to effectively disable caching).'''
+    global _retrieval_cache
+    with _retrieval_cache_lock:
+        _retrieval_cache = cache
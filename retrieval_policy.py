@@ -0,0 +1,93 @@
+'''How much context to ask the graph api for.
+
+Retrieving more than fits in the prompt only costs transfer time and tokens before being trimmed away, so:
+- the agent sizes each query to the prompt budget left after its history (agent_retrieval_size),
+- the chat path sizes its single query by how complex the question looks (chat_retrieval_size),
+- further results for the same query are fetched progressively, a page at a time (page_size).
+'''
+import re
+
+# Roughly how many context tokens one retrieved result takes, used to derive k from a context window.
+TOKENS_PER_RESULT = 200
+
+# Agent queries: never more than the old fixed size, never so little that a query is pointless.
+MAX_AGENT_CONTEXT_WINDOW = 10000
+MIN_CONTEXT_WINDOW = 2000
+MIN_K = 10
+
+# Prompt tokens kept free for the model's reply and the next turn when sizing agent queries.
+RESPONSE_RESERVE_TOKENS = 4000
+
+# Chat answers: from a single fact lookup to a broad comparison across companies and periods.
+MIN_CHAT_CONTEXT_WINDOW = 30000
+MAX_CHAT_CONTEXT_WINDOW = 100000
+MIN_CHAT_K = 30
+MAX_CHAT_K = 100
+
+# Furthest page of results the agent can ask for.
+MAX_PAGE = 5
+
+# Sizes are rounded to these steps, so similar budgets map to the same retrieval cache keys.
+CONTEXT_WINDOW_STEP = 1000
+CHAT_CONTEXT_WINDOW_STEP = 5000
+CHAT_K_STEP = 5
+
+_COMPARISON_WORDS = re.compile(r'\b(and|or|vs|versus|compare|compared|comparison|between|relative|trend|trends|over time|history|impact|effect|why|how)\b', re.IGNORECASE)
+_ENTITY = re.compile(r'\b(?:[A-Z]{2,5}|[A-Z][a-z]+(?:\s+[A-Z][a-z]+)*)\b')
+_PERIOD = re.compile(r'\b(?:19|20)\d{2}\b|\bQ[1-4]\b|\b(?:quarter|year|month|week)s?\b', re.IGNORECASE)
+
+
+def k_for_context_window(context_window):
+    return max(MIN_K, context_window // TOKENS_PER_RESULT)
+
+
+def agent_retrieval_size(remaining_tokens, queries=1):
+    '''k and context_window for each of queries graph queries, sharing what is left of the prompt budget.
+
+    Args:
+        remaining_tokens (int): Prompt tokens left after the history, system instruction and current turn.
+        queries (int): How many queries the budget is shared between.
+
+    Returns:
+        dict: {'k': ..., 'context_window': ...}
+    '''
+    per_query = (remaining_tokens - RESPONSE_RESERVE_TOKENS) // max(1, queries) // CONTEXT_WINDOW_STEP * CONTEXT_WINDOW_STEP
+    context_window = max(MIN_CONTEXT_WINDOW, min(MAX_AGENT_CONTEXT_WINDOW, per_query))
+    return {'k': k_for_context_window(context_window), 'context_window': context_window}
+
+
+def query_complexity(query):
+    '''A rough 0-1 score of how much context a question needs: its length, the entities and periods it names,
+    and words asking for comparisons, trends or explanations.'''
+    words = len(query.split())
+    entities = len(set(_ENTITY.findall(query)))
+    periods = len(_PERIOD.findall(query))
+    comparisons = len(_COMPARISON_WORDS.findall(query))
+    score = min(words, 40) / 40 * 0.3 + min(entities, 4) / 4 * 0.3 + min(periods, 2) / 2 * 0.15 + min(comparisons, 3) / 3 * 0.25
+    return min(1.0, score)
+
+
+def chat_retrieval_size(query):
+    '''k and context_window for a chat question, both scaled between the chat minimum and maximum by query_complexity.
+
+    Returns:
+        dict: {'k': ..., 'context_window': ...}
+    '''
+    complexity = query_complexity(query)
+    k = MIN_CHAT_K + (MAX_CHAT_K - MIN_CHAT_K) * complexity
+    context_window = MIN_CHAT_CONTEXT_WINDOW + (MAX_CHAT_CONTEXT_WINDOW - MIN_CHAT_CONTEXT_WINDOW) * complexity
+    return {
+        'k': round(k / CHAT_K_STEP) * CHAT_K_STEP,
+        'context_window': round(context_window / CHAT_CONTEXT_WINDOW_STEP) * CHAT_CONTEXT_WINDOW_STEP,
+    }
+
+
+def page_size(k, context_window, page=1):
+    '''k and context_window to request for a page of results.
+
+    The graph api has no offset, so page n asks for the top n * k results in n times the context window. The
+    agent's EvidenceStore then shows only the results that were not on the earlier pages, so what reaches the
+    prompt is still about one context window; the earlier pages only cost transfer.
+    '''
+    page = max(1, min(MAX_PAGE, int(page or 1)))
+    return {'k': k * page, 'context_window': context_window * page}
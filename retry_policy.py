@@ -0,0 +1,267 @@
+import os
+import re
+import time
+import random
+import asyncio
+import threading
+import contextvars
+
+from admission import RateLimitExceeded
+from tracing import increment
+
+_retryable_errors = None
+
+# When the RetryPolicy call in progress in this thread / task gives up (time.monotonic()), None without a deadline.
+_deadline_at = contextvars.ContextVar('retry_deadline_at', default=None)
+
+# Retry hints in error messages, e.g. '"retryDelay": "23s"' or 'Please retry in 23.5s'.
+_RETRY_HINT_PATTERNS = (
+    re.compile(r'retry_?delay\W+(\d+(?:\.\d+)?)s', re.IGNORECASE),
+    re.compile(r'retry in (\d+(?:\.\d+)?)\s*s', re.IGNORECASE),
+)
+
+
+def retryable_errors():
+    '''The errors from Gemini that are worth retrying.
+
+    google.api_core (and grpc with it) is imported on first use rather than at startup, like the other SDKs.
+    '''
+    global _retryable_errors
+    if _retryable_errors is None:
+        from google.api_core.exceptions import ResourceExhausted, InternalServerError, ServiceUnavailable, DeadlineExceeded
+        _retryable_errors = (ResourceExhausted, InternalServerError, ServiceUnavailable, DeadlineExceeded)
+    return _retryable_errors
+
+
+def retry_after_hint(error):
+    '''Returns the retry delay (seconds) the server asked for in an error, or None if it did not give one.'''
+    # google.rpc.RetryInfo in the error details (grpc)
+    for detail in getattr(error, 'details', None) or []:
+        retry_delay = getattr(detail, 'retry_delay', None)
+        if retry_delay is not None and hasattr(retry_delay, 'seconds'):
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+
+    # Retry-After header (rest)
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    retry_after = headers.get('Retry-After') if hasattr(headers, 'get') else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+
+    for pattern in _RETRY_HINT_PATTERNS:
+        match = pattern.search(str(error))
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def remaining_deadline():
+    '''Seconds left before the RetryPolicy call in progress gives up, or None outside of one (or without a deadline).
+
+    For waits inside the called function, e.g. a rate limiter, that should not outlast the retries around them.
+    '''
+    deadline_at = _deadline_at.get()
+    return None if deadline_at is None else max(0.0, deadline_at - time.monotonic())
+
+
+class CircuitOpenError(Exception):
+    '''Raised instead of calling a model whose circuit breaker is open.'''
+
+
+class CircuitBreaker:
+    '''Per model circuit breaker.
+
+    Only server side errors (retryable_errors()) count as failures. After failure_threshold consecutive failures the circuit opens and calls to the model are refused
+    (so callers can fail over straight away) until cooldown seconds have passed. Then a single call is let through
+    as a trial while the others are still refused: a success closes the circuit again, a failure keeps it open for
+    another cooldown. A trial that never reports back (e.g. it failed with a non retryable error) is given up on
+    after a cooldown and the next call becomes the trial.
+    '''
+
+    def __init__(self, name, failure_threshold=3, cooldown=60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._trial_started_at = None  # when the trial call of a half open circuit was let through
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None and time.monotonic() - self._opened_at < self.cooldown
+
+    def allow(self):
+        '''Whether a call may be made. Raises CircuitOpenError if not.'''
+        with self._lock:
+            if self._opened_at is None:
+                return
+            now = time.monotonic()
+            if now - self._opened_at >= self.cooldown and (self._trial_started_at is None or now - self._trial_started_at >= self.cooldown):
+                self._trial_started_at = now
+                return
+            failures = self._failures
+        raise CircuitOpenError(f"circuit open for {self.name} after {failures} consecutive failures")
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None or time.monotonic() - self._opened_at >= self.cooldown:
+                    print(f"circuit opened for {self.name} after {self._failures} consecutive failures")
+                self._opened_at = time.monotonic()
+                self._trial_started_at = None
+
+
+_circuit_breakers = {}  # (api key, model name) -> CircuitBreaker
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name, api_key=None):
+    '''Returns the process-wide CircuitBreaker for a model name used with an api key (GOOGLE_API_KEY if None).
+
+    Quota errors belong to a key, so one session exhausting its own key must not open the model for the others.
+    '''
+    key = (api_key or os.environ.get('GOOGLE_API_KEY'), name)
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(key)
+        if breaker is None:
+            breaker = _circuit_breakers[key] = CircuitBreaker(name)
+        return breaker
+
+
+class RetryPolicy:
+    '''Exponential backoff with full jitter, bounded by a number of retries and an overall deadline per call.
+
+    Server retry hints (RetryInfo / Retry-After / "retry in Ns") take precedence over the computed backoff,
+    as long as waiting that long still fits in the deadline.
+    '''
+
+    def __init__(self, max_retries=3, base_delay=1.0, max_delay=30.0, deadline=120.0, retry_on=None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self._retry_on = retry_on
+
+    @property
+    def retry_on(self):
+        '''The errors retried, retryable_errors() unless others were given.'''
+        return self._retry_on if self._retry_on is not None else retryable_errors()
+
+    def next_delay(self, attempt, error, started_at):
+        '''Seconds to wait before retrying after the attempt'th failure, or None if we should give up.'''
+        if attempt >= self.max_retries or not isinstance(error, self.retry_on):
+            return None
+
+        hint = retry_after_hint(error)
+        delay = hint if hint is not None else random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+        remaining = self.deadline - (time.monotonic() - started_at) if self.deadline else float('inf')
+        if delay >= remaining:
+            return None
+        return delay
+
+    def call(self, fn, *args, breaker=None, fail_fast=True, **kwargs):
+        '''Calls fn(*args, **kwargs), retrying retryable errors with time.sleep between attempts.
+
+        If a breaker is given, failures and successes are recorded on it, and with fail_fast a CircuitOpenError
+        is raised instead of making an attempt while the circuit is open. RateLimitExceeded from the caller's own
+        rate limiter is not a failure of the model and is not recorded.
+        '''
+        started_at = time.monotonic()
+        attempt = 0
+        deadline_token = _deadline_at.set(started_at + self.deadline if self.deadline else None)
+        try:
+            while True:
+                if breaker is not None and fail_fast:
+                    breaker.allow()
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception as e:
+                    if breaker is not None and isinstance(e, retryable_errors()):
+                        breaker.record_failure()
+                    delay = self.next_delay(attempt, e, started_at)
+                    if delay is None:
+                        raise
+                    print(f"Retryable error occured: {str(e)}, waiting {delay:.1f} seconds and retrying (attempt {attempt + 1} of {self.max_retries}).")
+                    increment('retries')
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+                if breaker is not None:
+                    breaker.record_success()
+                return result
+        finally:
+            _deadline_at.reset(deadline_token)
+
+    async def call_async(self, fn, *args, breaker=None, fail_fast=True, **kwargs):
+        '''Awaits fn(*args, **kwargs), retrying retryable errors with asyncio.sleep so no thread is blocked while waiting.'''
+        started_at = time.monotonic()
+        attempt = 0
+        deadline_token = _deadline_at.set(started_at + self.deadline if self.deadline else None)
+        try:
+            while True:
+                if breaker is not None and fail_fast:
+                    breaker.allow()
+                try:
+                    result = await fn(*args, **kwargs)
+                except Exception as e:
+                    if breaker is not None and isinstance(e, retryable_errors()):
+                        breaker.record_failure()
+                    delay = self.next_delay(attempt, e, started_at)
+                    if delay is None:
+                        raise
+                    print(f"Retryable error occured: {str(e)}, waiting {delay:.1f} seconds and retrying (attempt {attempt + 1} of {self.max_retries}).")
+                    increment('retries')
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+                if breaker is not None:
+                    breaker.record_success()
+                return result
+        finally:
+            _deadline_at.reset(deadline_token)
+
+
+def call_with_failover(policy, fn, model_names, *args, api_key=None, **kwargs):
+    '''Calls fn(model_name, *args, **kwargs) with the retry policy, failing over to the next model name when
+    a model's circuit is open, its retries are exhausted on a retryable error or the rate limiter did not admit
+    the call in time. The circuit breakers are those of api_key, the key fn calls the models with.
+
+    The last model is always tried, even if its circuit is open, so a single model behaves like a plain retry.
+    '''
+    last_error = None
+    for i, model_name in enumerate(model_names):
+        try:
+            return policy.call(fn, model_name, *args, breaker=get_circuit_breaker(model_name, api_key), fail_fast=i + 1 < len(model_names), **kwargs)
+        except (CircuitOpenError, RateLimitExceeded, *policy.retry_on) as e:
+            last_error = e
+            if i + 1 < len(model_names):
+                print(f"{model_name} unavailable ({e}), failing over to {model_names[i + 1]}")
+                increment('failovers')
+    raise last_error
+
+
+async def call_with_failover_async(policy, fn, model_names, *args, api_key=None, **kwargs):
+    '''Async version of call_with_failover, fn must be a coroutine function.'''
+    last_error = None
+    for i, model_name in enumerate(model_names):
+        try:
+            return await policy.call_async(fn, model_name, *args, breaker=get_circuit_breaker(model_name, api_key), fail_fast=i + 1 < len(model_names), **kwargs)
+        except (CircuitOpenError, RateLimitExceeded, *policy.retry_on) as e:
+            last_error = e
+            if i + 1 < len(model_names):
+                print(f"{model_name} unavailable ({e}), failing over to {model_names[i + 1]}")
+                increment('failovers')
+    raise last_error
@@ -1,7 +1,73 @@
 import streamlit as st
 st.set_page_config(layout="wide")
 import os
-from functions import get_identity_token, call_gemini_complete, get_context
+from concurrent.futures import ThreadPoolExecutor
+from functions import call_gemini_complete, get_context, strip_markdown_fences, build_answer_prompt, prewarm
+from retrieval_policy import chat_retrieval_size
+from research_jobs import ResearchJobManager
+from tracing import trace, serve_metrics
+
+
+def show_timing(timing):
+    '''Per answer timing breakdown: time, call count and token / retry / cache counters per traced step.'''
+    with st.expander("Timing breakdown"):
+        st.dataframe(timing, hide_index=True)
+
+
+@st.cache_resource
+def start_metrics_server():
+    '''Serves Prometheus metrics on METRICS_PORT (once per process) if it is set.'''
+    port = os.environ.get("METRICS_PORT")
+    return serve_metrics(int(port)) if port else None
+
+
+@st.cache_resource
+def start_prewarm():
+    '''Starts the slow startup work (Gemini SDK import, graph api client, first identity token) once per process.
+
+    It runs in the background so the first page renders straight away. Set PREWARM=0 to skip it, everything is
+    then loaded by the first request instead.
+    '''
+    if os.environ.get("PREWARM", "1") == "0":
+        return None
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prewarm")
+    future = executor.submit(prewarm)
+    executor.shutdown(wait=False)
+    return future
+
+
+@st.cache_resource
+def get_research_jobs():
+    '''The process-wide research job manager, shared by every session so jobs outlive reruns.'''
+    return ResearchJobManager()
+
+
+@st.fragment(run_every=2)
+def show_research_jobs():
+    '''This session's research jobs, refreshed every couple of seconds without rerunning the whole page.'''
+    jobs = get_research_jobs()
+    for job_id in reversed(st.session_state.research_jobs):
+        job = jobs.get(job_id)
+        if job is None:
+            continue
+        with st.expander(f"{job.objective[:60]} ({job.status})", expanded=not job.finished):
+            st.caption(f"iteration {job.iteration}/{job.max_iterations} · {len(job.queries)} queries · "
+                       f"{job.prompt_tokens} prompt tokens · {job.elapsed:.0f}s")
+            if job.content:
+                st.markdown(job.content)
+            elif job.error:
+                st.error(job.error)
+            if not job.finished:
+                if job.queries:
+                    st.markdown("Recent queries:\n" + "\n".join(f"- {query}" for query in job.queries[-5:]))
+                if job.notepad:
+                    st.text(job.notepad)
+                if st.button("Cancel", key=f"cancel-{job.id}"):
+                    job.cancel()
+
+
+start_metrics_server()
+warmup = start_prewarm()
 
 # Show title and description.
 st.title("💬 Chatbot")
@@ -10,21 +76,35 @@ st.write(
     "Please provide your GOOGLE API key to continue."
 )
 
-# Fetch the identity token to verify connectivity with the Cloud Run endpoint.
-identity_token = get_identity_token(audience='https://graph-output-api-427867203106.asia-southeast1.run.app')
-if identity_token:
-    st.write("Successfully obtained identity token.")
-else:
-    st.write("Failed to obtain identity token.")
+# The identity token (which verifies connectivity with the Cloud Run endpoint) is fetched by the background
+# warm up and cached process-wide, so reruns never block on it. Report how it went once it is done.
+if warmup is not None:
+    if not warmup.done():
+        st.write("Obtaining identity token...")
+    elif isinstance(warmup.result().get("identity_token"), float):
+        st.write("Successfully obtained identity token.")
+    else:
+        st.write("Failed to obtain identity token.")
 
 # Ask user for their GOOGLE API Key via `st.text_input`.
 google_api_key = st.text_input("GOOGLE API Key", type="password")
+
+# Research objectives run as background jobs (see research_jobs.py), the page only submits and polls them.
+if "research_jobs" not in st.session_state:
+    st.session_state.research_jobs = []
+with st.sidebar:
+    st.header("Research")
+    with st.form("research", clear_on_submit=True):
+        objective = st.text_area("Objective")
+        max_iterations = st.slider("Max iterations", 1, 20, 10)
+        submitted = st.form_submit_button("Start research", disabled=not google_api_key)
+    if submitted and objective.strip():
+        job = get_research_jobs().submit(objective.strip(), api_key=google_api_key, max_iterations=max_iterations)
+        st.session_state.research_jobs.append(job.id)
+    show_research_jobs()
 if not google_api_key:
     st.info("Please add your GOOGLE API key to continue.", icon="🗝️")
 else:
-    # Set the GOOGLE_API_KEY in the environment so that gemini_functions can use it.
-    os.environ["GOOGLE_API_KEY"] = google_api_key
-
     # Create a session state variable to store the chat messages.
     if "messages" not in st.session_state:
         st.session_state.messages = []
@@ -33,6 +113,8 @@ else:
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
+        if message.get("timing"):
+            show_timing(message["timing"])
 
     # Create a chat input field for the user.
     if prompt := st.chat_input("What is up?"):
@@ -41,50 +123,28 @@ else:
         with st.chat_message("user"):
             st.markdown(prompt)
 
-        # Step 1: Retrieve context from Cloud Run using the user prompt.
-        context_data = get_context(prompt)
-
-        # Step 2: Build the Gemini prompt using the user query and the retrieved context.
-        answer_prompt = f'''The user has provided a query. Content has been retrieved from a graph database based on its relevance to the query. Analyze the content and provide an answer to the users query.
-
-        - Your response must be intelligent, logical, and answer the users query fully.
-        - Ensure that you cite the information id's using square brackets in your response. For example: "this is some information [1234]". This is essential for the user to be able to verify the information.
-        - The user does not have access to the content retrieved from the graph database, so you must provide all relevant information in your response. i.e dont say according to [1234] the answer is X. You must actually provide the specific answer in full.
-        - Your output format must be structured markdown. No preliminary comments or markdown tags are allowed, your response must directly answer the users query and be in markdown format.
-
-        QUERY: {prompt}
-
-        CONTENT:
-        {context_data}
-
-        - Your response must be intelligent, logical, and answer the users query fully.
-        - Ensure that you cite the information id's using square brackets in your response. For example: "this is some information [1234]". This is essential for the user to be able to verify the information.
-        - The user does not have access to the content retrieved from the graph database, so you must provide all relevant information in your response. i.e dont say according to [1234] the answer is X. You must actually provide the specific answer in full.
-        - Your output format must be structured markdown. No preliminary comments or markdown tags are allowed, your response must directly answer the users query and be in markdown format.
-        '''
-
-        # Step 3: Query the Gemini API with the constructed prompt.
-        try:
-            response_text = call_gemini_complete(answer_prompt, model_name = 'gemini-2.5-pro-exp-03-25')
-
-            response_text = response_text.strip()
+        # Every step is traced, so the answer can show where its time went (graph api, auth, llm).
+        with trace('chat_answer') as answer_trace:
+            # Step 1: Retrieve context from Cloud Run using the user prompt, as much as the question looks like it needs.
+            context_data = get_context(prompt, **chat_retrieval_size(prompt))
 
-            if response_text.startswith('```markdown'):
-                response_text = response_text.split('```markdown', 1)[1]
-            
-            if response_text.endswith('```'):
-                response_text = response_text.rsplit('```', 1)[0]
+            # Step 2: Build the Gemini prompt using the user query and the retrieved context.
+            answer_prompt = build_answer_prompt(prompt, context_data)
 
-            response_text = response_text.strip()
+            # Step 3 + 4: Query the Gemini API with the constructed prompt and stream the response as it is generated.
+            with st.chat_message("assistant"):
+                try:
+                    chunks = call_gemini_complete(answer_prompt, model_name = 'gemini-2.5-pro-exp-03-25', api_key = google_api_key, stream = True)
+                    response_text = st.write_stream(strip_markdown_fences(chunks))
 
-            if not response_text:
-                response_text = "No response from the model, please try again."
+                    if not response_text:
+                        response_text = "No response from the model, please try again."
+                        st.markdown(response_text)
 
-        except Exception as e:
-            st.error(f"Error call_gemini_complete: {e}")
-            response_text = f"Error call_gemini_complete: {e}"
+                except Exception as e:
+                    st.error(f"Error call_gemini_complete: {e}")
+                    response_text = f"Error call_gemini_complete: {e}"
 
-        # Step 4: Display the Gemini response.
-        with st.chat_message("assistant"):
-            st.markdown(response_text)
-        st.session_state.messages.append({"role": "assistant", "content": response_text})
+        timing = answer_trace.breakdown()
+        show_timing(timing)
+        st.session_state.messages.append({"role": "assistant", "content": response_text, "timing": timing})
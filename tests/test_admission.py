@@ -0,0 +1,86 @@
+'''Process-wide admission control: rate limiter priorities and coalescing of identical calls.'''
+import os
+import sys
+import types
+import asyncio
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admission
+from admission import PRIORITY_BATCH, PRIORITY_INTERACTIVE, RateLimiter, SingleFlight
+
+
+def test_interactive_callers_are_admitted_before_batch(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    real_sleep = asyncio.sleep
+
+    async def sleep(seconds):
+        clock.now += seconds
+        await real_sleep(0)
+
+    monkeypatch.setattr(admission, 'time', types.SimpleNamespace(monotonic=lambda: clock.now))
+    monkeypatch.setattr(admission, 'asyncio', types.SimpleNamespace(sleep=sleep))
+
+    limiter = RateLimiter('test-model', requests_per_minute=1, max_wait=600)
+    admitted = []
+
+    async def caller(name, priority):
+        await limiter.acquire_async(0, priority)
+        admitted.append(name)
+
+    async def run():
+        await limiter.acquire_async(0, PRIORITY_BATCH)  # empties the bucket
+        # the batch callers start waiting first, the interactive one still goes ahead of them
+        await asyncio.gather(caller('batch 1', PRIORITY_BATCH), caller('batch 2', PRIORITY_BATCH), caller('interactive', PRIORITY_INTERACTIVE))
+
+    asyncio.run(run())
+    assert admitted == ['interactive', 'batch 1', 'batch 2']
+    assert limiter.queue_depth() == 0
+
+
+def test_single_flight_shares_one_call(monkeypatch):
+    followers = 4
+    waiting = threading.Condition()
+    state = {'waiting': 0}
+
+    class CountingFuture(admission.Future):
+        def result(self, timeout=None):
+            with waiting:
+                state['waiting'] += 1
+                waiting.notify_all()
+            return super().result(timeout)
+
+    monkeypatch.setattr(admission, 'Future', CountingFuture)
+
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def fetch(query):
+        calls.append(query)
+        started.set()
+        release.wait()
+        return f"results for {query}"
+
+    results = []
+
+    def ask():
+        results.append(flight.do('NVDA suppliers', fetch, 'NVDA suppliers'))
+
+    leader = threading.Thread(target=ask)
+    leader.start()
+    started.wait()
+    threads = [threading.Thread(target=ask) for _ in range(followers)]
+    for thread in threads:
+        thread.start()
+    with waiting:
+        # every follower is waiting on the leader's call before it is let finish
+        waiting.wait_for(lambda: state['waiting'] == followers)
+    release.set()
+    for thread in [leader, *threads]:
+        thread.join()
+
+    assert calls == ['NVDA suppliers']
+    assert sorted(results, key=lambda result: result[1]) == [('results for NVDA suppliers', False)] + [('results for NVDA suppliers', True)] * followers
+    assert flight.in_flight() == 0
@@ -0,0 +1,32 @@
+'''Resuming a batch from an output file left behind by a crash.'''
+import os
+import sys
+import json
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batch_research
+
+
+def test_resume_after_partial_last_line(tmp_path, monkeypatch):
+    ran = []
+
+    async def research(objective, **kwargs):
+        ran.append(objective)
+        return f"answer to {objective}"
+
+    monkeypatch.setattr(batch_research, 'graph_research_agent_async', research)
+
+    input_path, output_path = tmp_path / 'objectives.jsonl', tmp_path / 'results.jsonl'
+    input_path.write_text(''.join(json.dumps({'id': f"o{i}", 'objective': f"objective {i}"}) + '\n' for i in range(4)))
+    # o0 finished, a line without an id, then o1 cut short by the crash
+    output_path.write_text(json.dumps({'id': 'o0', 'content': 'done'}) + '\n' + json.dumps({'note': 'no id'}) + '\n' + '{"id": "o1", "cont')
+
+    asyncio.run(batch_research.run_batch(str(input_path), str(output_path), workers=2))
+    assert sorted(ran) == ['objective 1', 'objective 2', 'objective 3']
+
+    # every result of this run is on a line of its own, so none is lost when resuming again
+    assert batch_research.read_completed(str(output_path)) == {'o0', 'o1', 'o2', 'o3'}
+    asyncio.run(batch_research.run_batch(str(input_path), str(output_path), workers=2))
+    assert len(ran) == 3
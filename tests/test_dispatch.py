@@ -0,0 +1,27 @@
+'''A malformed function call from the model is answered with its error instead of ending the run.'''
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import graph_research_agent as agent
+from test_forced_finish import NoExactCount
+
+
+def test_malformed_notepad_call_becomes_function_response(monkeypatch):
+    turns = []
+
+    async def call_gemini(contents=None, **kwargs):
+        turns.append(contents[-1])
+        if len(turns) == 1:
+            return [{'type': 'function_call', 'name': 'write_to_notepad', 'arguments': {'content': 123}}]
+        return [{'type': 'function_call', 'name': 'finish_response', 'arguments': {'content': '## Answer'}}]
+
+    monkeypatch.setattr(agent, 'call_gemini_complete_async', call_gemini)
+    monkeypatch.setattr(agent, 'GeminiTokenCounter', NoExactCount)
+
+    content = asyncio.run(agent._graph_research_agent("What is the latest on the NVDA supply chain?", 5, None, {}, prefetch=False))
+
+    assert content == '## Answer'
+    assert 'An error occured' in agent.render_turn(turns[1])
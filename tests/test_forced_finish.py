@@ -0,0 +1,60 @@
+'''A long agent run that never calls finish_response has to be forced to finish within the token limit,
+however much evidence it gathered.'''
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import graph_research_agent as agent
+from graph_context import GraphContext
+from token_estimation import get_token_counter
+
+RECORDS_PER_QUERY = 60
+
+
+class NoExactCount:
+    '''Stands in for GeminiTokenCounter, as if exact counts were unavailable.'''
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def count_contents_async(self, contents, system_instruction=None):
+        return None
+
+
+def test_forced_finish_after_long_run_fits_token_limit(monkeypatch):
+    forced_calls = []
+    queries = []
+
+    async def call_gemini(prompt=None, contents=None, system_instruction=None, tool_config=None, prompt_tokens=None, **kwargs):
+        if prompt is not None:
+            return [{'type': 'text', 'text': 'Summary of the earlier research.'}]
+        if tool_config is not None:
+            forced_calls.append((contents, system_instruction, prompt_tokens))
+            return [{'type': 'function_call', 'name': 'finish_response', 'arguments': {'content': '## Answer [1000]'}}]
+        # never finishes on its own
+        return [{'type': 'function_call', 'name': 'query_graph', 'arguments': {'query': f"query {len(queries)}"}}]
+
+    async def query_graph(query, **kwargs):
+        queries.append(query)
+        first = len(queries) * 1000
+        records = [{'id': first + i, 'description': f"{query} finding {i}: " + 'supply capacity orders guidance ' * 12, 'timestamp': 1738000000 + i}
+                   for i in range(RECORDS_PER_QUERY)]
+        return GraphContext.from_payload({'entities': records}, query=query)
+
+    monkeypatch.setattr(agent, 'call_gemini_complete_async', call_gemini)
+    monkeypatch.setattr(agent, 'query_graph_async', query_graph)
+    monkeypatch.setattr(agent, 'GeminiTokenCounter', NoExactCount)
+
+    stats = {}
+    content = asyncio.run(agent._graph_research_agent("What is the latest on the NVDA supply chain?", 26, None, stats, prefetch=False))
+
+    assert content == '## Answer [1000]'
+    assert stats['compactions'] > 0
+    contents, system_instruction, prompt_tokens = forced_calls[0]
+    count = get_token_counter()
+    assert prompt_tokens <= agent.MAX_PROMPT_TOKENS
+    assert count(system_instruction) + sum(count(agent.render_turn(turn)) for turn in contents) <= agent.MAX_PROMPT_TOKENS
+    # the evidence alone would not have fitted, so some of it was left out
+    assert 'were left out for space' in agent.render_turn(contents[-1])
@@ -0,0 +1,32 @@
+'''Asking for page 2 of a query has to show the agent results that page 1 did not.'''
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import graph_research_agent as agent
+from graph_context import EvidenceStore, GraphContext
+from retrieval_policy import TOKENS_PER_RESULT, agent_retrieval_size
+
+
+def test_page_two_shows_records_page_one_did_not(monkeypatch):
+    async def get_context(query, start_date=None, end_date=None, k=50, context_window=10000, **kwargs):
+        # Like the graph api: the top ranked records, as many as k and the context window allow.
+        count = min(k, context_window // TOKENS_PER_RESULT)
+        records = [{'id': 1000 + i, 'description': f"{query} finding {i}", 'timestamp': 1738000000 + i} for i in range(count)]
+        return GraphContext.from_payload({'entities': records}, query=query)
+
+    monkeypatch.setattr(agent, 'get_context_async', get_context)
+
+    size = agent_retrieval_size(20000)
+    evidence = EvidenceStore()
+    first = asyncio.run(agent.query_graph_async("NVDA suppliers", page=1, **size))
+    evidence.add(first)
+    second = asyncio.run(agent.query_graph_async("NVDA suppliers", page=2, **size))
+
+    rendered = evidence.render_new(second)
+    assert 'No new results' not in rendered
+    new_ids = set(second.citation_ids) - set(first.citation_ids)
+    assert new_ids
+    assert all(cid in rendered for cid in new_ids)
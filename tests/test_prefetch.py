@@ -0,0 +1,41 @@
+'''A prefetched graph query is only served when it fits the context window the query is given now.'''
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import graph_research_agent as agent
+from graph_context import GraphContext
+from retrieval_policy import agent_retrieval_size
+
+
+def test_prefetch_larger_than_current_budget_is_not_served(monkeypatch):
+    fetched = []
+
+    async def query_graph(query, context_window=10000, **kwargs):
+        fetched.append(context_window)
+        return GraphContext.from_payload({'entities': [{'id': len(fetched), 'description': query}]}, query=query)
+
+    monkeypatch.setattr(agent, 'query_graph_async', query_graph)
+    params = {'start_date': '2024-06-01', 'end_date': '2025-03-22', 'page': 1}
+
+    async def run():
+        prefetcher = agent.GraphPrefetcher()
+        # planned while the prompt was nearly empty, asked for once it had filled up
+        prefetcher.prefetch_planned("Next query: TSMC CoWoS capacity\nNext query: HBM supply", {**params, **agent_retrieval_size(50000)})
+        await asyncio.sleep(0)
+        small = agent_retrieval_size(8000)
+        large = agent_retrieval_size(50000)
+        results = await agent.run_graph_queries_async([
+            {'query': 'TSMC CoWoS capacity', **params, **small},
+            {'query': 'HBM supply', **params, **large},
+        ], prefetcher=prefetcher)
+        return prefetcher, small, large, results
+
+    prefetcher, small, large, results = asyncio.run(run())
+
+    assert prefetcher.hits == 1
+    # the oversized prefetch was dropped and the query run again within the smaller window
+    assert fetched == [large['context_window'], large['context_window'], small['context_window']]
+    assert all(result.ok for result in results)
@@ -0,0 +1,82 @@
+'''Circuit breaker and failover behaviour, on a fake clock.'''
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import retry_policy
+from admission import RateLimitExceeded
+from retry_policy import CircuitBreaker, CircuitOpenError, RetryPolicy, call_with_failover, get_circuit_breaker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(retry_policy, 'time', types.SimpleNamespace(monotonic=clock.monotonic, sleep=clock.sleep))
+    return clock
+
+
+def admitted(breaker):
+    try:
+        breaker.allow()
+        return True
+    except CircuitOpenError:
+        return False
+
+
+def test_half_open_circuit_admits_one_trial(clock):
+    breaker = CircuitBreaker('model', failure_threshold=2, cooldown=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not admitted(breaker)
+
+    clock.now += 60
+    assert [admitted(breaker) for _ in range(3)] == [True, False, False]
+
+    # a failed trial reopens the circuit for another cooldown
+    breaker.record_failure()
+    clock.now += 30
+    assert not admitted(breaker)
+    clock.now += 30
+    assert admitted(breaker)
+
+    breaker.record_success()
+    assert [admitted(breaker) for _ in range(3)] == [True, True, True]
+
+
+def test_rate_limit_exceeded_fails_over_without_opening_the_circuit(clock):
+    calls = []
+
+    def generate(model_name):
+        calls.append(model_name)
+        if model_name == 'limited':
+            raise RateLimitExceeded("rate limit for limited: not admitted within 60s")
+        return model_name
+
+    policy = RetryPolicy(max_retries=3, deadline=120)
+    for _ in range(5):
+        assert call_with_failover(policy, generate, ['limited', 'fallback'], api_key='test-failover-key') == 'fallback'
+
+    # not retried, and never counted as a failure of the model
+    assert calls == ['limited', 'fallback'] * 5
+    assert admitted(get_circuit_breaker('limited', 'test-failover-key'))
+
+
+def test_breakers_are_per_api_key(clock):
+    get_circuit_breaker('shared-model', 'key-a').record_failure()
+    assert get_circuit_breaker('shared-model', 'key-a') is get_circuit_breaker('shared-model', 'key-a')
+    assert get_circuit_breaker('shared-model', 'key-a') is not get_circuit_breaker('shared-model', 'key-b')
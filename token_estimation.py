@@ -0,0 +1,125 @@
+'''Token estimation for Gemini prompts.
+
+Counting Gemini tokens exactly takes a round trip to the api, so the hot path (context trimming, cache
+thresholds) uses a fast estimate from the utf-8 length of the text, calibrated against exact counts, and
+exact counts are only asked for near a boundary (see AgentContext.build_contents_async).
+
+A token counter is any callable text -> int, so RatioTokenEstimator, CachingTokenCounter, GeminiTokenCounter
+or graph_research_agent.get_tiktoken_token_count can all be installed with set_token_counter.
+'''
+import os
+import math
+import threading
+from collections import OrderedDict
+
+from functions import get_gemini_model, get_gemini_model_async
+
+# Average utf-8 bytes per Gemini token. Fit it to your own prompts with benchmarks/bench_token_count.py.
+GEMINI_BYTES_PER_TOKEN = float(os.environ.get('GEMINI_BYTES_PER_TOKEN', 4.0))
+
+# Estimates within this fraction of a token limit are checked with an exact count.
+EXACT_COUNT_MARGIN = float(os.environ.get('EXACT_COUNT_MARGIN', 0.1))
+
+
+class RatioTokenEstimator:
+    '''Estimates tokens as utf-8 bytes / bytes_per_token. Costs one encode, no tokenizer.'''
+
+    def __init__(self, bytes_per_token=GEMINI_BYTES_PER_TOKEN):
+        self.bytes_per_token = bytes_per_token
+
+    def __call__(self, text):
+        if not text:
+            return 0
+        return math.ceil(len(text.encode('utf-8', 'surrogatepass')) / self.bytes_per_token)
+
+    @classmethod
+    def calibrate(cls, samples):
+        '''Returns an estimator fitted to samples, a list of (text, exact token count) pairs.
+
+        The ratio is total bytes over total tokens, so long texts weigh more, as they do in a prompt budget.
+        '''
+        total_bytes = sum(len(text.encode('utf-8', 'surrogatepass')) for text, _ in samples)
+        total_tokens = sum(tokens for _, tokens in samples)
+        if not total_tokens:
+            raise ValueError("calibration needs samples with a non zero token count")
+        return cls(total_bytes / total_tokens)
+
+
+class CachingTokenCounter:
+    '''Remembers the counts of up to max_entries strings, for counters that are expensive to call (tiktoken, Gemini).
+
+    Strings are keyed by their hash and length rather than kept alive by the cache.
+    '''
+
+    def __init__(self, counter, max_entries=4096):
+        self.counter = counter
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, text):
+        key = (hash(text), len(text))
+        with self._lock:
+            tokens = self._counts.get(key)
+            if tokens is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return tokens
+            self.misses += 1
+
+        tokens = self.counter(text)
+        with self._lock:
+            self._counts[key] = tokens
+            if len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return tokens
+
+
+class GeminiTokenCounter:
+    '''Exact token counts from the Gemini count_tokens api, for one model (and optionally its tools).
+
+    Every count is an api call, so use it for boundary checks, calibration or behind a CachingTokenCounter,
+    not on the hot path. Counts that fail are reported as None by count_contents_async.
+    '''
+
+    def __init__(self, model_name='gemini-2.0-flash', api_key=None, tools=None):
+        self.model_name = model_name
+        self.api_key = api_key
+        self.tools = tools
+
+    def __call__(self, text):
+        model = get_gemini_model(self.model_name, api_key=self.api_key)
+        return model.count_tokens(text).total_tokens
+
+    async def count_contents_async(self, contents, system_instruction=None):
+        '''Exact tokens of a whole request (contents plus system instruction and tools), or None if it cannot be counted.'''
+        try:
+            model = get_gemini_model_async(self.model_name, tools=self.tools, api_key=self.api_key, system_instruction=system_instruction)
+            response = await model.count_tokens_async(contents)
+            return response.total_tokens
+        except Exception as e:
+            print(f"Exact token count failed for {self.model_name}: {e}")
+            return None
+
+
+_token_counter = None
+_token_counter_lock = threading.Lock()
+
+
+def get_token_counter():
+    '''Returns the process-wide token counter used for estimates, a RatioTokenEstimator unless another was set.'''
+    global _token_counter
+    if _token_counter is None:
+        with _token_counter_lock:
+            if _token_counter is None:
+                _token_counter = RatioTokenEstimator()
+    return _token_counter
+
+
+def set_token_counter(counter):
+    '''Replaces the process-wide token counter (any callable text -> int), e.g. a calibrated RatioTokenEstimator.'''
+    global _token_counter
+    with _token_counter_lock:
+        _token_counter = counter
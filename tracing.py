@@ -0,0 +1,256 @@
+'''Lightweight tracing and metrics for the chatbot and the research agent.
+
+Spans are timed with span(name, **attributes). Each finished span is:
+- appended to the current trace (a per answer / per research run collector, see trace()), which is what the
+  Streamlit app shows as a timing breakdown,
+- written to a JSON lines file if TRACE_FILE is set,
+- aggregated into process-wide metrics (counts, total / max duration, and any numeric attributes such as
+  token counts, retries and cache hits), which metrics_snapshot() and prometheus_metrics() expose.
+
+Spans nest: a span started inside another records it as its parent. The current trace and span are held in
+context variables, so concurrent asyncio tasks and threads started with contextvars.copy_context() keep
+their own.
+'''
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Set to a path to export every finished span as a line of JSON.
+TRACE_FILE = os.environ.get('TRACE_FILE')
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        '''Adds attributes to the span, e.g. span.set(prompt_tokens=1234, cache_hit=True).'''
+        self.attributes.update(attributes)
+
+    def add(self, name, value=1):
+        '''Increments a numeric attribute, e.g. span.add('retries').'''
+        self.attributes[name] = self.attributes.get(name, 0) + value
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+class Trace:
+    '''The spans recorded for one answer or research run.'''
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.attributes = attributes
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def breakdown(self):
+        '''Total time, count and summed numeric attributes per span name, in order of first appearance.'''
+        rows = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            row = rows.setdefault(span.name, {'name': span.name, 'count': 0, 'total_ms': 0.0})
+            row['count'] += 1
+            row['total_ms'] += (span.duration or 0) * 1000
+            for key, value in span.attributes.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    row[key] = row.get(key, 0) + value
+                elif isinstance(value, bool):
+                    row[key] = row.get(key, 0) + int(value)
+        for row in rows.values():
+            row['total_ms'] = round(row['total_ms'], 1)
+        return list(rows.values())
+
+    def to_dict(self):
+        with self._lock:
+            return {'name': self.name, 'trace_id': self.trace_id, 'attributes': self.attributes, 'spans': [s.to_dict() for s in self.spans]}
+
+
+class _Metrics:
+    '''Process-wide aggregates of finished spans.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans = {}   # name -> {'count', 'errors', 'duration_seconds_sum', 'duration_seconds_max', <numeric attribute>_sum}
+        self._gauges = {}  # name -> value
+
+    def record(self, span):
+        with self._lock:
+            row = self._spans.setdefault(span.name, {'count': 0, 'errors': 0, 'duration_seconds_sum': 0.0, 'duration_seconds_max': 0.0})
+            row['count'] += 1
+            row['errors'] += int(span.error is not None)
+            row['duration_seconds_sum'] += span.duration
+            row['duration_seconds_max'] = max(row['duration_seconds_max'], span.duration)
+            for key, value in span.attributes.items():
+                if isinstance(value, (int, float)):
+                    row[f"{key}_sum"] = row.get(f"{key}_sum", 0) + value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self):
+        with self._lock:
+            return {'spans': {name: dict(row) for name, row in self._spans.items()}, 'gauges': dict(self._gauges)}
+
+
+METRICS = _Metrics()
+_trace_file_lock = threading.Lock()
+
+
+def _export(span):
+    METRICS.record(span)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(span)
+    if TRACE_FILE:
+        line = json.dumps(span.to_dict(), default=str)
+        with _trace_file_lock:
+            with open(TRACE_FILE, 'a') as f:
+                f.write(line + '\n')
+
+
+@contextmanager
+def span(name, **attributes):
+    '''Times the enclosed block as a span. Yields the Span so attributes can be added while it runs.'''
+    trace = _current_trace.get()
+    parent = _current_span.get()
+    current = Span(name, trace.trace_id if trace is not None else None, parent.span_id if parent is not None else None, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        current.finish()
+        _export(current)
+
+
+@contextmanager
+def trace(name, **attributes):
+    '''Collects every span started in the enclosed block (including in awaited tasks) into a Trace.'''
+    current = Trace(name, **attributes)
+    token = _current_trace.set(current)
+    try:
+        with span(name, **attributes):
+            yield current
+    finally:
+        _current_trace.reset(token)
+
+
+def start_span(name, **attributes):
+    '''Starts a span without making it the current one, for work that does not fit a with block (e.g. consuming
+    a stream). Must be finished with end_span.'''
+    trace = _current_trace.get()
+    parent = _current_span.get()
+    return Span(name, trace.trace_id if trace is not None else None, parent.span_id if parent is not None else None, attributes)
+
+
+def end_span(span, error=None):
+    span.error = error
+    span.finish()
+    _export(span)
+
+
+def current_span():
+    '''The innermost active span, or None.'''
+    return _current_span.get()
+
+
+def annotate(**attributes):
+    '''Adds attributes to the innermost active span, if there is one.'''
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def increment(name, value=1):
+    '''Increments a numeric attribute on the innermost active span, if there is one.'''
+    current = _current_span.get()
+    if current is not None:
+        current.add(name, value)
+
+
+def set_gauge(name, value):
+    METRICS.set_gauge(name, value)
+
+
+def metrics_snapshot():
+    '''Process-wide span aggregates and gauges as a dict.'''
+    return METRICS.snapshot()
+
+
+def _metric_name(name):
+    return ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def prometheus_metrics():
+    '''Process-wide metrics in the Prometheus text exposition format.'''
+    snapshot = metrics_snapshot()
+    lines = []
+    for name, row in snapshot['spans'].items():
+        label = f'{{span="{name}"}}'
+        for key, value in row.items():
+            lines.append(f"fincatch_span_{_metric_name(key)}{label} {value}")
+    for name, value in snapshot['gauges'].items():
+        lines.append(f"fincatch_{_metric_name(name)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(port=9464, addr='0.0.0.0'):
+    '''Serves prometheus_metrics() on http://addr:port/metrics from a daemon thread. Returns the server.'''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            body = prometheus_metrics().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server